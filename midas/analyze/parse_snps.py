@@ -6,6 +6,7 @@
 
 import sys, os, gzip, numpy as np, random, csv
 from midas.utility import print_copyright
+from midas import snp_matrix
 
 class Sample:
 	""" Base class for sample """
@@ -27,9 +28,10 @@ class Sample:
 class Species:
 	""" Base class for species """
 	
-	def __init__(self, dir):
+	def __init__(self, dir, matrix=False):
 		
 		self.dir = dir
+		self.use_matrix = matrix
 		self.id = os.path.basename(self.dir)
 		self.init_paths()
 		self.init_files()
@@ -41,26 +43,50 @@ class Species:
 			self.paths[type] = '%s/snps_%s.txt' % (self.dir, type)
 
 	def init_files(self):
+		""" Open text outputs of merge_midas.py snps, or its binary matrix store (snps_matrix) if requested
+			freqs in the store are not rounded like snps_freq.txt (%.3g), so results may differ slightly
+		"""
 		self.files = {}
+		self.matrix = None
+		if self.use_matrix:
+			if not snp_matrix.is_matrix(snp_matrix.matrix_dir(self.dir)):
+				sys.exit("\nError: no binary matrix store found in %s; run merge_midas.py snps with --matrix\n" % self.dir)
+			self.matrix = snp_matrix.SnpMatrix(snp_matrix.matrix_dir(self.dir))
 		for type in ['freq', 'depth', 'info', 'summary']:
+			if self.matrix is not None and type != 'summary':
+				continue
 			file = open(self.paths[type])
 			if type in ['info', 'summary']:
 				self.files[type] = csv.DictReader(file, delimiter='\t')
 			else:
 				self.files[type] = csv.reader(file, delimiter='\t')
+		self.rows = self.read_rows()
 
 	def init_samples(self):
 		self.sample_ids = None
+		if self.matrix is not None:
+			self.sample_ids = self.matrix.sample_ids
+			return
 		for file in ['freq', 'depth']:
 			self.sample_ids = next(self.files[file])[1:]
 
+	def read_rows(self):
+		""" Yield info, freqs and depths of each site """
+		if self.matrix is not None:
+			for info, freqs, depths in self.matrix.chunks():
+				for row in zip(snp_matrix.info_rows(info), freqs.tolist(), depths.tolist()):
+					yield row
+		else:
+			for info in self.files['info']:
+				yield info, next(self.files['freq'])[1:], next(self.files['depth'])[1:]
+
 
 class GenomicSite:
 	""" Base class for genomic sites """
 	def __init__(self, species, samples):
 		try:
 			# fetch site info
-			self.info = next(species.files['info'])
+			self.info, freqs, depths = next(species.rows)
 			self.id = self.info['site_id']
 			self.ref_allele = self.info['ref_allele']
 			self.minor_allele = self.info['minor_allele']
@@ -75,16 +101,13 @@ class GenomicSite:
 			# fetch site data from freq and depth matrixes
 			#	self.samples[sample.id].freq
 			#	self.samples[sample.id].depth
-			self.fetch_row(species)
+			self.fetch_row(freqs, depths)
 
 		except StopIteration:
 			self.id = None
 		
-	def fetch_row(self, species):
-		""" Fetch next row from freq and depth matrices
-		    Store in sample objects: sample.freq, sample.depth """
-		freqs = next(species.files['freq'])[1:]
-		depths = next(species.files['depth'])[1:]
+	def fetch_row(self, freqs, depths):
+		""" Store row of freq and depth matrices in sample objects: sample.freq, sample.depth """
 		for sample in self.samples.values():
 			self.samples[sample.id].freq = float(freqs[sample.index])
 			self.samples[sample.id].depth = int(depths[sample.index])
@@ -13,7 +13,7 @@ def id_markers(args):
 	""" Pipeline for identifying marker alleles """
 
 	# initialize input data
-	species = parse_snps.Species(args['indir'])
+	species = parse_snps.Species(args['indir'], args['matrix'])
 	samples = parse_snps.fetch_samples(species, keep_samples=args['samples'])
 
 	# open output file & write header
@@ -62,7 +62,7 @@ def count_alleles(site, samples, min_freq, min_reads):
 
 def track_markers(args):
 	# initialize input data
-	species = parse_snps.Species(args['indir'])
+	species = parse_snps.Species(args['indir'], args['matrix'])
 	samples = parse_snps.fetch_samples(species)
 	species.paths['markers'] = args['markers']
 
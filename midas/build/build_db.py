@@ -5,7 +5,8 @@
 # Freely distributed under the GNU General Public License (GPLv3)
 
 import os, subprocess, sys, shutil, gzip
-from midas import utility
+from midas import utility, site_annotation
+from midas.run import shards
 import Bio.SeqIO
 
 class Species:
@@ -105,6 +106,11 @@ genes.ffn
 centroids.ffn
   gene sequences from 99%% identity gene clusters
   used for recruiting metagenomic reads
+
+centroids.npy
+  binary table of gene_id, length, and marker code for each gene in centroids.ffn
+  sorted by gene_id; marker code is the index of marker_id among sorted marker_ids in phyeco.map (-1: not a marker)
+  read by run_midas.py genes instead of parsing centroids.ffn
   
 gene_info.txt
   information for all genes from genes.ffn
@@ -258,7 +264,40 @@ def build_repgenome_db(args, genomes, species):
 		shutil.copy(sp.genomes[sp.rep_genome].files['genes'], '%s/genome.features' % outdir)
 		#build_features_file(sp, fpath='%s/genome.features' % outdir)
 		shutil.copy(sp.genomes[sp.rep_genome].files['fna'], '%s/genome.fna' % outdir)
+		# per-position annotation used by merge_midas.py snps
+		site_annotation.write_annotation(args['outdir'], sp.id)
 		
+def build_genome_index(args, species):
+	""" Build bowtie2 index of all representative genomes, split into partitions of similar size
+		genome_index/partitions.txt maps species_id to partition; index prefix is genome_index/part.{partition}
+	"""
+	outdir = '%s/genome_index' % args['outdir']
+	if not os.path.isdir(outdir): os.makedirs(outdir)
+	sizes = {}
+	for sp in species:
+		sizes[sp.id] = sum([len(r.seq) for r in Bio.SeqIO.parse(sp.genomes[sp.rep_genome].files['fna'], 'fasta')])
+	groups = shards.partition(sizes, args['index_partitions'])
+	for partition, species_ids in enumerate(groups):
+		print("  partition %s: %s species, %s bp" % (partition, len(species_ids), sum([sizes[_] for _ in species_ids])))
+		prefix = '%s/part.%s' % (outdir, partition)
+		outfile = open(prefix+'.fa', 'w')
+		for sp in species:
+			if sp.id not in species_ids: continue
+			for r in Bio.SeqIO.parse(sp.genomes[sp.rep_genome].files['fna'], 'fasta'):
+				outfile.write('>%s\n%s\n' % (r.id, str(r.seq).upper()))
+		outfile.close()
+		command = '%s --threads %s %s.fa %s' % (args['bowtie2-build'], args['threads'], prefix, prefix)
+		process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		utility.check_exit_code(process, command)
+		os.remove(prefix+'.fa')
+	# written last, so its presence marks a complete index
+	outfile = open('%s/partitions.txt' % outdir, 'w')
+	outfile.write('\t'.join(['species_id', 'partition'])+'\n')
+	for partition, species_ids in enumerate(groups):
+		for species_id in species_ids:
+			outfile.write('%s\t%s\n' % (species_id, partition))
+	outfile.close()
+
 def find_gene(gene, contigs):
 	fwd_gene = str(gene).upper()
 	rev_gene = str(gene.reverse_complement()).upper()	
@@ -313,6 +352,19 @@ def build_pangenome_db(args, species):
 		p.clean_up()
 		p.write_readme()
 
+def build_gene_tables(args, species):
+	""" Write per-species table of centroid gene_id, length, and marker code """
+	marker_map = utility.read_marker_map(args['outdir'])
+	marker_list = sorted(set(marker_map.values()))
+	for sp in species:
+		indir = '%s/pan_genomes/%s' % (args['outdir'], sp.id)
+		gene_ids, lengths, marker_ids = [], [], []
+		for rec in Bio.SeqIO.parse('%s/centroids.ffn' % indir, 'fasta'):
+			gene_ids.append(rec.id)
+			lengths.append(len(rec.seq))
+			marker_ids.append(marker_map.get(rec.id))
+		utility.write_gene_table('%s/centroids.npy' % indir, gene_ids, lengths, marker_ids, marker_list)
+
 def write_species_info(args, species):
 	outfile = utility.iopen('%s/species_info.txt' % args['outdir'], 'w')
 	header = ['species_id', 'rep_genome', 'count_genomes']
@@ -337,7 +389,7 @@ def compress(outdir):
 			indir = '%s/%s/%s' % (outdir, module, species)
 			for file in os.listdir(indir):
 				inpath = '%s/%s' % (indir, file)
-				if inpath.split('.')[-1] != 'gz':
+				if inpath.split('.')[-1] not in ['gz', 'npy', 'npz']:
 					outfile = utility.iopen('%s/%s.gz' % (indir, file), 'w')
 					for line in utility.iopen(inpath):
 						outfile.write(line)
@@ -473,9 +525,16 @@ def run_pipeline(args):
 	print("\nBuilding representative genome database")
 	build_repgenome_db(args, genomes, species)
 
+	if args['genome_index']:
+		print("\nBuilding bowtie2 index of representative genomes")
+		build_genome_index(args, species)
+
 	print("\nBuilding marker genes database")
 	build_marker_db(args, genomes, species)
 
+	print("\nBuilding gene metadata tables")
+	build_gene_tables(args, species)
+
 	print("")
 	if args['compress']:
 		print("Compressing data\n")
@@ -4,17 +4,37 @@
 # Copyright (C) 2015 Stephen Nayfach
 # Freely distributed under the GNU General Public License (GPLv3)
 
-import argparse, sys, os, gzip
+import argparse, sys, os, gzip, numpy as np
 from collections import defaultdict
 from midas import utility
 from midas.merge import merge
 
+def read_binary_genes(sp, sample):
+	""" Read binary gene coverage file written by run_midas.py genes --binary
+		returns None if the sample or database lacks the required files, or the sample was run with another gene table
+	"""
+	inpath = '%s/genes/output/%s.genes.npy' % (sample.dir, sp.id)
+	if sp.gene_table is None or not os.path.isfile(inpath):
+		return None
+	# rows of the sidecar refer to the gene table recorded in the manifest
+	manifest = utility.read_manifest('%s/genes/output/%s.manifest' % (sample.dir, sp.id), {'gene_table': sp.gene_table_key})
+	if manifest is None:
+		return None
+	return np.load(inpath)
+
 def build_gene_matrices(sp, min_copy):
 	""" Compute gene copy numbers for samples """
 	for sample in sp.samples:
 		sample.genes = {}
 		for field, dtype in [('presabs',float), ('copynum',float), ('depth',float), ('reads',int)]:
 			sample.genes[field] = defaultdict(dtype)
+		values = read_binary_genes(sp, sample)
+		if values is not None:
+			# aggregate centroids into gene clusters without parsing text
+			for field, column, dtype in [('copynum','copies',float), ('depth','depth',float), ('reads','reads',int)]:
+				totals = np.bincount(sp.cluster_index[values['gene']], weights=values[column], minlength=len(sp.cluster_ids))
+				sample.genes[field].update(zip(sp.cluster_ids, [dtype(_) for _ in totals]))
+			continue
 		inpath = '%s/genes/output/%s.genes.gz' % (sample.dir, sp.id)
 		for r in utility.parse_file(inpath):
 			if 'ref_id' in r: r['gene_id'] = r['ref_id'] # fix old fields if present
@@ -96,6 +116,16 @@ def read_cluster_map(sp, db, pid):
 			sp.gene_info = path
 	for r in utility.parse_file(sp.gene_info):
 		sp.map[r['centroid_99']] =  r['centroid_%s' % pid]
+	# map rows of database gene table to gene clusters (for binary input files)
+	sp.gene_table = None
+	path = '/'.join([db, 'pan_genomes', sp.id, 'centroids.npy'])
+	if os.path.isfile(path):
+		gene_ids = utility.read_gene_table(path)['gene_id']
+		sp.gene_table = gene_ids.astype(str)
+		sp.gene_table_key = utility.gene_table_key(gene_ids)
+		sp.cluster_ids = sorted(set(sp.map.values()))
+		cluster_index = dict([(cluster_id, i) for i, cluster_id in enumerate(sp.cluster_ids)])
+		sp.cluster_index = np.array([cluster_index[sp.map[gene_id]] for gene_id in sp.gene_table], dtype=np.int64)
 
 def run_pipeline(args):
 
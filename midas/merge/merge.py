@@ -25,6 +25,9 @@ class Species:
 		outfile = open('%s/%s/%s_summary.txt' % (outdir, self.id, dtype), 'w')
 		if dtype == 'snps':
 			fields = ['genome_length', 'covered_bases', 'fraction_covered', 'mean_coverage', 'aligned_reads', 'mapped_reads']
+			# depth cap of run_midas.py snps --max_depth
+			if any(['max_depth' in sample.info[self.id] for sample in self.samples]):
+				fields.append('max_depth')
 		else:
 			fields = ['pangenome_size', 'covered_genes', 'fraction_covered', 'mean_coverage', 'marker_coverage', 'aligned_reads', 'mapped_reads']
 		outfile.write('\t'.join(['sample_id']+fields)+'\n')
@@ -32,7 +35,7 @@ class Species:
 			path = '%s/%s/summary.txt' % (sample.dir, dtype)
 			outfile.write(sample.id)
 			for field in fields:
-				value = sample.info[self.id][field]
+				value = sample.info[self.id].get(field, 'NA')
 				outfile.write('\t' + str(value))
 			outfile.write('\n')
 
@@ -115,6 +118,8 @@ def filter_sample_species(sample, species, species_id, args, dtype):
 		return True # skip low-coverage sample
 	elif dtype=='snps' and float(info['fraction_covered']) < args['fract_cov']:
 		return True # skip low-coverage sample
+	elif dtype=='snps' and not any([os.path.isfile('%s/snps/output/%s.%s' % (sample.dir, species_id, ext)) for ext in ['snps.gz', 'snps.bin']]):
+		return True # skip sample without allele counts, e.g. from run_midas.py snps --coverage_only
 	else:
 		return False
 
@@ -4,227 +4,200 @@
 # Copyright (C) 2015 Stephen Nayfach
 # Freely distributed under the GNU General Public License (GPLv3)
 
-import sys, os, shutil
-from midas import utility
-from midas.merge import merge
+import sys, os, shutil, numpy as np
+from midas import utility, snp_counts, snp_matrix, site_annotation
+from midas.merge import merge, snps_store
 from time import time
-from operator import itemgetter
 
-class GenomicSite:
-	def __init__(self, id, values):
+SNP_TYPES = [None, 'mono', 'bi', 'tri', 'quad'] # by number of alleles with pooled frequency >= allele_freq
+READER_MEMORY = 8*2**20 # estimated memory of an open run_midas.py snps count reader
+MIN_TASK_SITES = 100000 # smallest range of sites worth a separate task
+
+class SiteBlock:
+	""" Allele calls and per-sample statistics for a window of consecutive sites of one contig
+
+	counts: ACGT counts of each sample, array (sites x samples x 4)
+	pooled_counts: ACGT counts across all samples, if counts only has some of them (merge_midas.py snps --incremental)
+	statistics are arrays over sites (and samples); alleles are indexes into ACGT, -1 if absent
+	"""
+	def __init__(self, site_id, ref_id, ref_pos, ref_alleles, counts, pooled_counts=None):
 	
 		# initialize
-		self.id = str(id) #values[0].rsplit('|', 1)[0]
-		self.ref_id, self.ref_pos, self.ref_allele  = values[0].rsplit('|', 2)
-		self.ref_pos = int(self.ref_pos)
+		self.site_ids = np.arange(counts.shape[0]) + site_id
+		self.ref_id = ref_id
+		self.ref_pos = np.arange(counts.shape[0]) + ref_pos
+		self.ref_alleles = ref_alleles
 		
 		# per-sample statistics
-		self.sample_counts = [[int(j) for j in i.split(',')] for i in values[1:]] # <list>, per sample allele counts
-		self.sample_mafs = []  # <list>, minor allele frequencies
-		self.sample_depths = [] # <list>, count of major+minor allele frequencies
+		self.sample_counts = counts
+		self.sample_mafs = None # minor allele frequencies (sites x samples)
+		self.sample_depths = None # count of major+minor alleles (sites x samples)
 		
 		# pooled statistics
-		self.total_samples = len(self.sample_counts)
-		self.pooled_counts = self.compute_pooled_counts() # <list>, count of each allele across all samples
-		self.pooled_depth = sum(self.pooled_counts)
-		self.major_allele = None
-		self.minor_allele = None
-		self.snp_type = None # mono, bi, tri, quad
-					
-		# site annotations
-		self.locus_type = None # CDS, tRNA, rRNA, IGR
-		self.site_type = None # 1D, 2D, 3D, 4D
-		self.gene_id = None
-		self.amino_acids = None
-		self.ref_codon = None
-		self.codon_pos = None
+		self.total_samples = counts.shape[1]
+		self.pooled_counts = counts.sum(axis=1) if pooled_counts is None else pooled_counts # count of each allele across all samples
+		self.pooled_depth = self.pooled_counts.sum(axis=1)
+		self.major_index = None
+		self.minor_index = None
+		self.snp_type = None # index in SNP_TYPES
+		self.keep = None
 		
-	def compute_pooled_counts(self):
-		""" Compute count of 4 nucleotides across samples """
-		pooled_counts = []
-		for i in range(4):
-			pooled_counts.append(sum([counts[i] for counts in self.sample_counts]))
-		return pooled_counts
-
 	def call_alleles(self, snp_freq):
-		""" Call major and minor alleles at GenomicSite """
-		
-		# check at least 1 mapped read
-		if self.pooled_depth == 0: return
-		
-		# get sorted counts
-		alleles = list('ACGT')
-		freqs = [float(count)/self.pooled_depth for count in self.pooled_counts]
-		allele_freqs = sorted(zip(alleles, freqs), key=itemgetter(1), reverse=True)
-
-		# major allele
-		if allele_freqs[0][1] > 0:
-			self.major_allele = allele_freqs[0][0]
-			self.major_index = alleles.index(self.major_allele)
-		
-		# minor allele
-		if allele_freqs[1][1] > 0:
-			self.minor_allele = allele_freqs[1][0]
-			self.minor_index = alleles.index(self.minor_allele)
-		
-		# classify SNP
-		snp_types = ['quad', 'tri', 'bi', 'mono']
-		for snp_type, allele_freq in zip(snp_types, allele_freqs[::-1]):
-			allele, freq = allele_freq
-			if freq >= snp_freq:
-				self.snp_type = snp_type
-				break
+		""" Call major and minor alleles at each site """
+		# alleles sorted by pooled count; ties in ACGT order
+		order = np.argsort(-self.pooled_counts, axis=1, kind='stable')
+		sorted_counts = np.take_along_axis(self.pooled_counts, order, axis=1)
+		self.major_index = np.where(sorted_counts[:, 0] > 0, order[:, 0], -1)
+		self.minor_index = np.where(sorted_counts[:, 1] > 0, order[:, 1], -1)
+		# classify SNP: number of alleles with frequency >= snp_freq; sites without reads have no type
+		freqs = sorted_counts / np.maximum(1, self.pooled_depth)[:, None].astype(float)
+		self.snp_type = (freqs >= snp_freq).sum(axis=1)
+		self.snp_type[self.pooled_depth == 0] = 0
 
 	def compute_per_sample_mafs(self):
-		""" Compute per-sample depth (major + minor allele) and minor allele freq at GenomicSite """
-		if self.major_allele is None:
-			self.sample_mafs = [0.0 for counts in self.sample_counts]
-			self.sample_depths = [0 for counts in self.sample_counts]
-		elif self.minor_allele is None:
-			self.sample_mafs = [0.0 for counts in self.sample_counts]
-			self.sample_depths = [counts[self.major_index] for counts in self.sample_counts]
-		else:
-			for counts in self.sample_counts:
-				sample_depth = counts[self.major_index] + counts[self.minor_index]
-				sample_maf = float(counts[self.minor_index])/sample_depth if sample_depth > 0 else 0.0
-				self.sample_mafs.append(sample_maf)
-				self.sample_depths.append(sample_depth)
+		""" Compute per-sample depth (major + minor allele) and minor allele freq at each site """
+		def allele_counts(index):
+			counts = np.take_along_axis(self.sample_counts, np.maximum(0, index)[:, None, None], axis=2)[:, :, 0]
+			return counts * (index >= 0)[:, None]
+		major_counts = allele_counts(self.major_index)
+		minor_counts = allele_counts(self.minor_index)
+		self.sample_depths = major_counts + minor_counts
+		self.sample_mafs = np.where(self.sample_depths > 0, minor_counts / np.maximum(1, self.sample_depths).astype(float), 0.0)
+
+	def count_passing(self, mean_depths, min_depth, max_ratio):
+		""" Count samples where each site passes depth filters """
+		ratios = self.sample_depths / np.array(mean_depths, dtype=float)
+		pass_qc = (self.sample_depths >= min_depth) & ~(ratios > max_ratio)
+		return pass_qc.sum(axis=1)
 
 	def compute_prevalence(self, mean_depths, min_depth, max_ratio):
-		""" Compute the fraction of samples where site passes all filters """
-		pass_qc = []
-		for mean_depth, site_depth in zip(mean_depths, self.sample_depths):
-			if site_depth < min_depth:
-				pass_qc.append(0)
-			elif site_depth/mean_depth > max_ratio:
-				pass_qc.append(0)
-			else:
-				pass_qc.append(1)
-		self.count_samples = sum(pass_qc)
-		self.prevalence = sum(pass_qc)/float(len(pass_qc))
+		""" Compute the fraction of samples where each site passes all filters """
+		self.count_samples = self.count_passing(mean_depths, min_depth, max_ratio)
+		self.prevalence = self.count_samples / float(self.total_samples)
 
 	def flag(self, min_prev, snp_types):
-		""" Filter genomic site based on MAF and prevalence """
-		if self.prevalence < min_prev:
-			self.flag = (True, 'min_prev')
-		elif ('any' not in snp_types and 
-				self.snp_type not in snp_types):
-			self.flag = (True, 'snp_type')
-		else:
-			self.flag = (False, None)
-
-	def annotate(self, genes):
-		""" Annotate variant and reference site """
-		# genes = {'list': list of genes, 'index':index position in list}
-		# each element in 'list' is sorted by scaffold_id (asc), start (asc), end (desc)
-		# each element is a dictionary with gene info
-		while True:
-			# 1. fetch next gene
-			#    if there are no more genes, snp must be intergenic so break
-			if genes['index'] < len(genes['list']):
-				gene = genes['list'][genes['index']]
-			else:
-				self.locus_type = 'IGR'
-				return
-			# 2. if snp is upstream of next gene, snp must be intergenic so break
-			if (self.ref_id < gene['scaffold_id'] or
-			   (self.ref_id == gene['scaffold_id'] and self.ref_pos < gene['start'])):
-				self.locus_type = 'IGR'
-				return
-			# 3. if snp is downstream of next gene, pop gene, check (1) and (2) again
-			if (self.ref_id > gene['scaffold_id'] or
-			   (self.ref_id == gene['scaffold_id'] and self.ref_pos > gene['end'])):
-				genes['index'] += 1
-				continue
-			# 4. snp in coding gene: annotate (1D-4D)
-			elif gene['gene_type'] == 'CDS':
-				self.locus_type = gene['gene_type']
-				self.gene_id = gene['gene_id']
-				if len(gene['seq']) % 3 != 0: # gene must by divisible by 3 to id codons
-					return
-				self.ref_codon, self.codon_pos = self.fetch_ref_codon(gene)
-				if not all([_ in ['A','T','C','G'] for _ in self.ref_codon]): # codon can't contain weird characters
-					return
-				self.amino_acids = []
-				for allele in ['A','C','G','T']: # + strand
-					codon = utility.index_replace(self.ref_codon, allele, self.codon_pos, gene['strand']) # +/- strand
-					amino_acid = utility.translate(codon)
-					self.amino_acids.append(amino_acid)
-				unique_aa = set(self.amino_acids)
-				degeneracy = 4 - len(unique_aa) + 1
-				self.site_type = '%sD' % degeneracy
-				self.amino_acids = ','.join(self.amino_acids)
-				# AA's identical: degeneracy = 4 - 1 + 1 = 4
-				# AA's all different, degeneracy = 4 - 4 + 1 = 1
-				return
-			# 5. snp in non-coding gene
-			else:
-				self.locus_type = gene['gene_type']
-				self.gene_id = gene['gene_id']
-				return
-
-	def fetch_ref_codon(self, gene):
-		""" Fetch codon within gene for given site """
-		# position of site in gene
-		gene_pos = self.ref_pos - gene['start'] if gene['strand'] == '+' else gene['end'] - self.ref_pos
-		# position of site in codon
-		codon_pos = gene_pos % 3
-		# gene sequence (oriented start to stop)
-		ref_codon = gene['seq'][gene_pos-codon_pos:gene_pos-codon_pos+3]
-		return ref_codon, codon_pos
-						
-	def write(self, files):
-		""" Store data for GenomicSite in Species"""
-		# snps_info
-		count_a, count_c, count_g, count_t = [str(_) for _ in self.pooled_counts]
-		info = [self.id,
-				self.ref_id,
-				str(self.ref_pos),
-				self.ref_allele,
-				self.major_allele,
-				self.minor_allele,
-				str(self.count_samples),
-				count_a, count_c, count_g, count_t,
-				self.locus_type,
-				self.gene_id,
-				self.snp_type,
-				self.site_type,
-				self.amino_acids,
-				]
-		info = '\t'.join([replace_none(_) for _ in info])+'\n'
-		files['info'].write(info)
-		# snps_freq
-		freq = self.id + '\t' + '\t'.join(['{0:.3g}'.format(freq) for freq in self.sample_mafs])+'\n'
-		files['freq'].write(freq)
-		# snps_depth
-		depth = self.id + '\t' + '\t'.join([str(depth) for depth in self.sample_depths])+'\n'
-		files['depth'].write(depth)
-
-def parallel(function, argument_list, threads):
-	""" Based on: https://gist.github.com/admackin/003dd646e5fadee8b8d6 """
+		""" Keep sites passing prevalence and SNP type filters """
+		self.keep = ~(self.prevalence < min_prev)
+		if 'any' not in snp_types:
+			self.keep &= np.isin(self.snp_type, [i for i, snp_type in enumerate(SNP_TYPES) if snp_type in snp_types])
+
+	def format_info(self, sites, annotation):
+		""" Annotate sites and return their snps_info rows """
+		alleles = ['A', 'C', 'G', 'T', None]
+		site_ids = self.site_ids[sites].tolist()
+		rows = []
+		annotations = zip(*site_annotation.annotate_sites(annotation, site_ids))
+		for i, site, site_id, ref_pos, site_annotations in zip(sites.tolist(), self.pooled_counts[sites].tolist(), site_ids, self.ref_pos[sites].tolist(), annotations):
+			locus_type, gene_id, site_type, amino_acids = site_annotations
+			info = [str(site_id),
+					self.ref_id,
+					str(ref_pos),
+					self.ref_alleles[i],
+					alleles[self.major_index[i]],
+					alleles[self.minor_index[i]],
+					str(self.count_samples[i])] + [str(_) for _ in site] + [
+					locus_type,
+					gene_id,
+					SNP_TYPES[self.snp_type[i]],
+					site_type,
+					amino_acids,
+					]
+			rows.append('\t'.join([replace_none(_) for _ in info])+'\n')
+		return rows
+
+	def info_table(self, sites, annotation, dtype):
+		""" Annotate sites and return their snps_info rows as structured array (see snp_matrix.info_dtype) """
+		alleles = np.array(['A', 'C', 'G', 'T', ''])
+		info = np.zeros(len(sites), dtype=dtype)
+		info['site_id'] = self.site_ids[sites]
+		info['ref_id'] = self.ref_id
+		info['ref_pos'] = self.ref_pos[sites]
+		info['ref_allele'] = [self.ref_alleles[i] for i in sites.tolist()]
+		info['major_allele'] = alleles[self.major_index[sites]]
+		info['minor_allele'] = alleles[self.minor_index[sites]]
+		info['count_samples'] = self.count_samples[sites]
+		for i, field in enumerate(['count_a', 'count_c', 'count_g', 'count_t']):
+			info[field] = self.pooled_counts[sites, i]
+		info['snp_type'] = [replace_none(SNP_TYPES[i], '') for i in self.snp_type[sites].tolist()]
+		columns = site_annotation.annotate_sites(annotation, self.site_ids[sites].tolist())
+		for field, column in zip(['locus_type', 'gene_id', 'site_type', 'amino_acids'], columns):
+			info[field] = [replace_none(_, '') for _ in column]
+		return info
+
+	def format_samples(self, ftype, sites):
+		""" Per-sample values of sites in snps_freq or snps_depth rows, each starting with a tab """
+		values, format = (self.sample_mafs, '\t%.3g') if ftype == 'freq' else (self.sample_depths, '\t%s')
+		row = format * self.total_samples
+		return [row % tuple(site) for site in values[sites].tolist()]
+
+	def write(self, files, annotation, matrix=None):
+		""" Annotate kept sites and write their rows, also to matrix store if given (snp_matrix.MatrixWriter) """
+		sites = np.flatnonzero(self.keep)
+		if len(sites) == 0:
+			return
+		files['info'].write(''.join(self.format_info(sites, annotation)))
+		for ftype in ['freq', 'depth']:
+			site_ids = self.site_ids[sites].tolist()
+			files[ftype].write(''.join(['%s%s\n' % row for row in zip(site_ids, self.format_samples(ftype, sites))]))
+		if matrix is not None:
+			matrix.write(self.info_table(sites, annotation, matrix.info_dtype), self.sample_mafs[sites], self.sample_depths[sites])
+
+def schedule(generators, threads, memory):
+	""" Run tasks of several species concurrently on a pool of processes
+		each generator yields phases: lists of tasks (function, arguments, cost, memory); it is sent the results of a
+		phase once all its tasks are done, and yields its next phase. Ready tasks start largest estimated cost first,
+		as long as the estimated memory of running tasks stays within memory
+	"""
 	import multiprocessing as mp
+	import queue
 	import signal
-	import time
 	
 	def init_worker():
 		signal.signal(signal.SIGINT, signal.SIG_IGN)
-
-	pool = mp.Pool(threads, init_worker)
 	
+	ready, running, order = [], {}, [0]
+	done = queue.Queue() # (task number, result, error) of finished tasks, put by callbacks of the pool
+	def start_phase(generator, results):
+		try:
+			tasks = generator.send(results)
+		except StopIteration:
+			return
+		if len(tasks) == 0:
+			return start_phase(generator, [])
+		phase = {'generator':generator, 'results':[None for task in tasks], 'pending':len(tasks)}
+		for index, (function, arguments, cost, task_memory) in enumerate(tasks):
+			ready.append((-cost, order[0], function, arguments, task_memory, phase, index))
+			order[0] += 1
+	
+	pool = mp.Pool(threads, init_worker)
 	try:
-		results = []
-		for arguments in argument_list:
-			p = pool.apply_async(function, args=arguments)
-			results.append(p)
+		for generator in generators:
+			start_phase(generator, None)
+		while len(ready) > 0 or len(running) > 0:
+			# start tasks that fit in memory; the largest one always starts when nothing else is running
+			ready.sort(key=lambda task: task[:2])
+			used = sum([task[0] for task in running.values()])
+			for task in list(ready):
+				if len(running) >= threads:
+					break
+				if len(running) == 0 or used + task[4] <= memory:
+					ready.remove(task)
+					running[task[1]] = (task[4], task[5], task[6])
+					pool.apply_async(task[2], args=task[3],
+						callback=lambda result, number=task[1]: done.put((number, result, None)),
+						error_callback=lambda error, number=task[1]: done.put((number, None, error)))
+					used += task[4]
+			# wait for a task to finish; errors in child processes are raised here
+			number, result, error = done.get()
+			if error is not None:
+				raise error
+			task_memory, phase, index = running.pop(number)
+			phase['results'][index] = result
+			phase['pending'] -= 1
+			if phase['pending'] == 0:
+				start_phase(phase['generator'], phase['results'])
 		pool.close()
-		
-		while True:
-			if all(r.ready() for r in results):
-				for r in results: # catches errors in child process
-					r.get()
-				return
-			time.sleep(1)
-
+		pool.join()
 	except KeyboardInterrupt:
 		pool.terminate()
 		pool.join()
@@ -233,59 +206,79 @@ def parallel(function, argument_list, threads):
 def replace_none(input_string, replace_string="NA"):
 	return input_string if input_string is not None else replace_string
 
-def read_run_midas_snps(species_id, samples):
-	""" Open SNP files for species across samples """
-	infiles = []
-	for sample in samples:
-		path = '%s/snps/output/%s.snps.gz' % (sample.dir, species_id)
-		file = utility.iopen(path)
-		next(file)
-		infiles.append(file)
-	return infiles
-
-def build_temp_count_matrix(tempdir, species_id, samples, split_num, max_sites):
-	""" Build SNP matrices using a subset of total samples """
-	sample_ids = [s.id for s in samples]
-	midas_files = read_run_midas_snps(species_id, samples)
-	matrix_file = open('%s/acgt_counts.%s.txt' % (tempdir, split_num), 'w')
-	matrix_file.write('\t'.join(['site_id']+sample_ids)+'\n')
-	nsites = 0
+def read_count_window(readers, contig_id, start, end):
+	""" ACGT counts for 0-based positions start..end-1 of contig across samples: array (sites x samples x 4)
+		a reader of a count matrix contributes one column per sample it contains
+	"""
+	windows = [reader.fetch(contig_id, start, end).reshape(end-start, -1, 4) for reader in readers]
+	return np.concatenate(windows, axis=1) if len(windows) > 0 else np.zeros((end-start, 0, 4), dtype=np.int64)
+
+def genome_windows(genome, offsets, site_from, site_to, window):
+	""" Yield (contig_id, start, end) windows of at most <window> sites covering genome coordinates site_from..site_to-1 """
+	for contig_id in sorted(genome.keys()):
+		offset = offsets[contig_id]
+		start = max(0, site_from - offset)
+		stop = min(len(genome[contig_id]), site_to - offset)
+		for window_start in range(start, stop, window):
+			yield contig_id, window_start, min(stop, window_start+window)
+
+def merge_memory(threads):
+	""" Memory budget (bytes) of each thread: half of available memory, or 1 GB if unknown """
+	memory = utility.available_memory()
+	return memory//(2*threads) if memory else 2**30
+
+def merge_window(num_samples, memory):
+	""" Number of sites read at once: counts of all samples and per-sample statistics must fit in memory """
+	return int(max(100, min(max(1000, 2000000//num_samples), memory//(num_samples*4*8*4))))
+
+def merge_plan(num_samples, window, max_open, memory):
+	""" Plan k-way merge of sample count files into count matrices, so no thread has more than max_open inputs open
+		returns levels, each a list of [first, last) ranges of inputs (samples, then matrices of previous level) merged
+		into one matrix; inputs left after the last level are read together to call SNPs; no levels if all fit at once
+		fan-in of a level is bounded by open files and by memory of its readers, which grows with samples per matrix
+	"""
+	plan, num_inputs, samples_per_input = [], num_samples, 1
 	while True:
-		records = []
-		for file in midas_files:
-			try:
-				record = next(file).rstrip('\n').split('\t')
-				records.append(record)
-			except StopIteration:
-				matrix_file.close()
-				for file in midas_files: file.close()
-				return
-		if nsites >= max_sites:
-			matrix_file.close()
-			for file in midas_files: file.close()
-			return
-		else:
-			nsites += 1
-			site_id = '|'.join(records[0][0:3])
-			allele_counts = [','.join(r[-4:]) for r in records]
-			matrix_file.write(site_id+'\t'+'\t'.join(allele_counts)+'\n')
-
-def parallel_build_temp_count_matrixes(species, args):
-	""" Split up samples into batches, merge each batch, merge together batches """
-	argument_list = []
-	for split_num, sample_ids in enumerate(species.sample_lists):
-		arguments=(species.tempdir, species.id, sample_ids, split_num, args['max_sites'])
-		argument_list.append(arguments)
-	parallel(build_temp_count_matrix, argument_list, args['threads'])
-
-def	read_count_matrixes(species, args):
-	""" Open matrices for reading and skip headers """
-	files = []
-	for split_num in range(species.num_splits):
-		path = '%s/acgt_counts.%s.txt' % (species.tempdir, split_num)
-		files.append(open(path))
-		next(files[split_num])
-	return files
+		reader_memory = READER_MEMORY if len(plan) == 0 else window*samples_per_input*4*(4+8)
+		fan_in = max(2, min(max_open, memory//reader_memory))
+		if num_inputs <= fan_in:
+			return plan
+		num_groups = (num_inputs + fan_in - 1)//fan_in
+		bounds = [num_inputs*i//num_groups for i in range(num_groups+1)]
+		plan.append(list(zip(bounds[:-1], bounds[1:])))
+		samples_per_input *= (num_inputs + num_groups - 1)//num_groups
+		num_inputs = num_groups
+
+def plan_merge(species, args):
+	""" Set window and merge plan of species (see merge_plan) for merging counts of all its samples """
+	memory = merge_memory(args['threads'])
+	species.window = merge_window(len(species.samples), memory)
+	species.merge_plan = merge_plan(len(species.samples), species.window, utility.max_open_files(args['threads'], reserved=16), memory)
+	if len(species.merge_plan) > 0:
+		print("  %s: merging counts of %s samples in %s levels" % (species.id, len(species.samples), len(species.merge_plan)+1))
+
+def merge_counts(species, inputs, open_input, genome, offsets, thread, site_from, site_to):
+	""" Run levels of species.merge_plan for sites with genome coordinates site_from..site_to-1
+		inputs: allele counts of each sample, opened by open_input(input, offsets)
+		returns readers of inputs left after the last level, in sample order
+	"""
+	sizes = [1 for input in inputs]
+	for level, groups in enumerate(species.merge_plan):
+		paths = []
+		for group, (first, last) in enumerate(groups):
+			path = '%s/counts.%s.%s.%s' % (species.tempdir, thread, level, group)
+			readers = [open_input(input, offsets) for input in inputs[first:last]]
+			writer = snp_counts.MatrixCountWriter(path, sum(sizes[first:last]))
+			for contig_id, start, end in genome_windows(genome, offsets, site_from, site_to, species.window):
+				writer.write(offsets[contig_id]+start, read_count_window(readers, contig_id, start, end))
+			writer.close()
+			for reader in readers: reader.close()
+			paths.append(path)
+		if level > 0:
+			for input in inputs: os.remove(input)
+		inputs, sizes = paths, [sum(sizes[first:last]) for first, last in groups]
+		open_input = snp_counts.MatrixCountReader
+	return [open_input(input, offsets) for input in inputs]
 
 def write_merge_midas(species, args, thread=None):
 	""" Open output files for species """
@@ -321,90 +314,237 @@ def write_merge_midas(species, args, thread=None):
 	files['info'].write('\t'.join(info_fields)+'\n')
 	return files
 
-def build_sharded_tables(species, args, thread, line_from, line_to):
-	""" Build merged output files for species using every <thread>th site"""
-	infiles = read_count_matrixes(species, args)
+def build_sharded_tables(species, args, thread, site_from, site_to):
+	""" Build merged output files for species using sites with genome coordinates site_from..site_to-1 """
+	genome = utility.read_genome(args['db'], species.id)
+	offsets, genome_length = snp_counts.genome_offsets(genome)
+	inputs = ['%s/snps/output/%s' % (sample.dir, species.id) for sample in species.samples]
+	readers = merge_counts(species, inputs, snp_counts.open_counts, genome, offsets, thread, site_from, site_to)
 	outfiles = write_merge_midas(species, args, thread)
-	genes = utility.read_genes(species.id, args['db'])
+	annotation = site_annotation.read_annotation(species.annotation)
+	matrix = None
+	if args['matrix']:
+		info_dtype = snp_matrix.info_dtype(genome.keys(), annotation['gene_ids'], annotation['locus_types'])
+		matrix = snp_matrix.MatrixWriter(snp_matrix.matrix_dir('%s/%s' % (args['outdir'], species.id)), thread, info_dtype, args['matrix'])
 	
-	line_num = -1
-	while True:
-				
-		# fetch allele counts for next site
-		try:
-			lines = [next(file) for file in infiles]
-		except StopIteration:
-			break
+	# allele counts of all samples are read into memory one window of sites at a time
+	for contig_id, start, end in genome_windows(genome, offsets, site_from, site_to, species.window):
+		counts = read_count_window(readers, contig_id, start, end)
+		# call alleles and filter all sites of window at once
+		block = SiteBlock(offsets[contig_id]+start+1, contig_id, start+1, str(genome[contig_id][start:end]), counts)
+		block.call_alleles(args['allele_freq'])
+		block.compute_per_sample_mafs()
+		block.compute_prevalence(species.sample_depth, args['site_depth'], args['site_ratio'])
+		block.flag(args['site_prev'], args['snp_type'])
+		block.write(outfiles, annotation, matrix)
+	
+	# finish up
+	for reader in readers: reader.close()
+	for file in outfiles.values(): file.close()
+	if matrix: matrix.close()
+
+def setup_species(species, args):
+	""" Locate annotation, read genome length, open merge store (with --incremental) and plan merge of species
+		run as a task, so that the scheduler does not read genomes; returns attributes set on species
+	"""
+	species.annotation = site_annotation.annotation_file(args['db'], species.id, '%s/%s' % (args['outdir'], species.id))
+	genome = utility.read_genome(args['db'], species.id)
+	offsets, species.genome_length = snp_counts.genome_offsets(genome)
+	keys = ['annotation', 'genome_length', 'window', 'merge_plan']
+	if args['incremental']:
+		species.num_stored = snps_store.open_store(args, species, species.genome_length)
+		print("  %s: %s samples in merge store, %s new" % (species.id, species.num_stored, len(species.samples) - species.num_stored))
+		keys += ['num_stored', 'samples', 'sample_depth']
+	plan_merge(species, args)
+	return dict([(key, getattr(species, key)) for key in keys])
+
+def setup_task(species, args):
+	genome_length = int(species.genome_info.get('length', 0))
+	return (setup_species, (species, args), genome_length, genome_length*32)
+
+def build_phases(species, args):
+	""" Phases of merging all samples of species (see schedule): setup, one task per range of sites, finishing """
+	for key, value in (yield [setup_task(species, args)])[0].items():
+		setattr(species, key, value)
+	num_sites = int(min(species.genome_length, args['max_sites']))
+	species.site_ranges = site_ranges(num_sites, task_count(num_sites, args['threads']))
+	print("  %s: calling SNPs in %s tasks" % (species.id, len(species.site_ranges)))
+	
+	task_memory = species.window*len(species.samples)*4*8*4
+	tasks = []
+	for thread, (site_from, site_to) in enumerate(species.site_ranges):
+		tasks.append((build_sharded_tables, (species, args, thread, site_from, site_to), len(species.samples)*(site_to-site_from), task_memory))
+	yield tasks
+	yield [finish_task(species, args, num_sites)]
+
+def update_sharded_tables(species, args, thread, site_from, site_to):
+	""" Build merged output files for sites with genome coordinates site_from..site_to-1 from merge store and new samples
+		pooled counts and alleles are updated with counts of new samples; values of stored samples are copied from
+		the previous merge, and computed from stored counts only for sites whose alleles changed or that were not kept
+		returns number of rows written and (row, offset in snps_freq, offset in snps_depth) of every
+		snps_store.ROW_BLOCK-th row of the sharded tables
+	"""
+	genome = utility.read_genome(args['db'], species.id)
+	offsets, genome_length = snp_counts.genome_offsets(genome)
+	dir = snps_store.store_dir(args, species.id)
+	# with a merge plan, readers of count matrices span stored and new samples, so all counts are read at once
+	inputs = [snps_store.count_path(args, species.id, i) for i in range(len(species.samples))]
+	readers = merge_counts(species, inputs, snps_store.open_counts, genome, offsets, thread, site_from, site_to)
+	stored_readers, new_readers = readers[:species.num_stored], readers[species.num_stored:]
+	state, next_state = snps_store.read_state(dir), snps_store.read_state(dir+'/next', 'r+')
+	previous = snps_store.open_rows(args, species.id, site_from) if species.num_stored > 0 else None
+	outfiles = write_merge_midas(species, args, thread)
+	annotation = site_annotation.read_annotation(species.annotation)
+	num_rows, row_index = 0, []
+	
+	for contig_id, start, end in genome_windows(genome, offsets, site_from, site_to, species.window):
+		lo, hi = offsets[contig_id]+start, offsets[contig_id]+end
+		seq = str(genome[contig_id][start:end])
+		old = dict([(name, np.asarray(state[name][lo:hi])) for name in state])
 		
-		# control which lines are processed
-		line_num += 1
-		if line_num < line_from:
-			continue
-		elif line_num >= line_to:
-			break
+		# call alleles from updated pooled counts; sites with unchanged alleles add pass counts of new samples
+		if len(species.merge_plan) > 0:
+			all_counts = read_count_window(readers, contig_id, start, end)
+			counts = all_counts[:, species.num_stored:]
+		else:
+			counts = read_count_window(new_readers, contig_id, start, end)
+		block = SiteBlock(lo+1, contig_id, start+1, seq, counts, old['pooled'] + counts.sum(axis=1))
+		block.call_alleles(args['allele_freq'])
+		block.compute_per_sample_mafs()
+		block.count_samples = old['count_samples'] + block.count_passing(species.sample_depth[species.num_stored:], args['site_depth'], args['site_ratio'])
+		block.prevalence = block.count_samples / float(len(species.samples))
+		block.flag(args['site_prev'], args['snp_type'])
+		
+		# all samples for sites with changed alleles, and for sites kept for the first time
+		changed = (block.major_index != old['major']) | (block.minor_index != old['minor'])
+		rows = changed | (block.keep & ~old['kept'])
+		if rows.any():
+			if len(species.merge_plan) > 0:
+				stored_counts = all_counts[rows, :species.num_stored]
+			else:
+				stored_counts = read_count_window(stored_readers, contig_id, start, end)[rows]
+			full = SiteBlock(lo+1, contig_id, start+1, seq, np.concatenate([stored_counts, counts[rows]], axis=1), block.pooled_counts[rows])
+			full.call_alleles(args['allele_freq'])
+			full.compute_per_sample_mafs()
+			full.compute_prevalence(species.sample_depth, args['site_depth'], args['site_ratio'])
+			block.count_samples[rows] = full.count_samples
+			block.prevalence = block.count_samples / float(len(species.samples))
+			block.flag(args['site_prev'], args['snp_type'])
 		
-		# initialize GenomicSite
-		values = sum([line.rstrip().split()[1:] for line in lines], [lines[0].split()[0]])
-		site_id = line_num+1
-		site = GenomicSite(site_id, values)
-		site.call_alleles(args['allele_freq'])
-		site.compute_per_sample_mafs()
-		site.compute_prevalence(species.sample_depth, args['site_depth'], args['site_ratio'])
-		site.flag(args['site_prev'], args['snp_type'])
+		# write rows: previous rows of stored samples are extended with new samples
+		kept = np.flatnonzero(block.keep)
+		outfiles['info'].write(''.join(block.format_info(kept, annotation)))
+		old_row, full_row = np.cumsum(old['kept']) - 1, np.cumsum(rows) - 1
+		row_offsets = {}
+		for ftype in ['freq', 'depth']:
+			lines = [next(previous[ftype]) for i in range(int(old['kept'].sum()))] if previous else []
+			values = block.format_samples(ftype, kept)
+			full_values = full.format_samples(ftype, np.arange(int(rows.sum()))) if rows.any() else []
+			out = []
+			for i, site_values in zip(kept.tolist(), values):
+				if rows[i]:
+					out.append('%s%s\n' % (lo+i+1, full_values[full_row[i]]))
+				else:
+					out.append(lines[old_row[i]].rstrip('\n') + site_values + '\n')
+			row_offsets[ftype] = outfiles[ftype].tell() + np.cumsum([0] + [len(line) for line in out])
+			outfiles[ftype].write(''.join(out))
+		for i in range((-num_rows) % snps_store.ROW_BLOCK, len(kept), snps_store.ROW_BLOCK):
+			row_index.append((num_rows+i, int(row_offsets['freq'][i]), int(row_offsets['depth'][i])))
+		num_rows += len(kept)
 		
-		# decide what to do with site
-		if site.flag[0] is True:
-			continue
-		else:
-			site.annotate(genes)
-			site.write(outfiles)
+		# next state of store
+		next_state['pooled'][lo:hi] = block.pooled_counts
+		next_state['major'][lo:hi] = block.major_index
+		next_state['minor'][lo:hi] = block.minor_index
+		next_state['count_samples'][lo:hi] = block.count_samples
+		next_state['kept'][lo:hi] = block.keep
 	
 	# finish up
-	for file in infiles: file.close()
+	for array in next_state.values(): array.flush()
+	for reader in readers: reader.close()
 	for file in outfiles.values(): file.close()
-
-def parallel_build_sharded_tables(species, args):
-	""" """
-	# get number of total lines to process
-	infiles = read_count_matrixes(species, args)
-	num_lines = 0
-	for line in infiles[0]:
-		num_lines += 1
-	for file in infiles:
-		file.close()
-
-	lines_per = max(1, num_lines/args['threads'])
-	line_ranges = [[thread * lines_per, thread * lines_per + lines_per] for thread in range(args['threads'])]
-	line_ranges[-1][-1] = num_lines
-
-	argument_list = []
-	for thread, line_range in enumerate(line_ranges):
-		line_from, line_to = line_range
-		arguments=(species, args, thread, line_from, line_to)
-		argument_list.append(arguments)
+	if previous:
+		for file in previous.values(): file.close()
+	return num_rows, row_index
+
+def site_ranges(num_sites, threads):
+	""" Split genome coordinates 0..num_sites-1 into one range per thread """
+	sites_per = max(1, num_sites//threads)
+	site_ranges = [[min(num_sites, thread * sites_per), min(num_sites, thread * sites_per + sites_per)] for thread in range(threads)]
+	site_ranges[-1][-1] = num_sites
+	return site_ranges
+
+def task_count(num_sites, threads):
+	""" Number of ranges of sites of a species: up to one per thread, of at least MIN_TASK_SITES sites each """
+	return max(1, min(threads, num_sites//MIN_TASK_SITES))
+
+def update_phases(species, args):
+	""" Phases of adding new samples of species to merge store (see schedule): setup, import of new samples,
+		one task per range of sites, finishing
+	"""
+	for key, value in (yield [setup_task(species, args)])[0].items():
+		setattr(species, key, value)
+	num_sites = int(min(species.genome_length, args['max_sites']))
 	
-	parallel(build_sharded_tables, argument_list, args['threads'])
-
-def merge_sharded_tables(species, args):
-	""" Merge N sets of sharded tables, where N is the number of threads"""
-	# open output tables
-	outfiles = write_merge_midas(species, args)
-	# open input sharded tables
-	infiles = {}
-	for thread in range(args['threads']):
-		infiles[thread] = {}
-		for ftype in ['freq', 'depth', 'info']:
-			path = '%s/%s/temp/snps_%s.%s.txt' % (args['outdir'], species.id, ftype, thread)
-			infiles[thread][ftype] = open(path)
-	# skip headers
-	for thread in range(args['threads']):
-		for ftype in ['freq', 'depth', 'info']:
-			next(infiles[thread][ftype])
-	# write remainder of lines
-	for thread in range(args['threads']):
-		for ftype in ['freq', 'depth', 'info']:
-			for line in infiles[thread][ftype]:
-				outfiles[ftype].write(line)
+	# new samples are read once, into the store, while the next state is initialized
+	tasks = [(snps_store.reset_next_state, (args, species.id, species.genome_length), species.genome_length, READER_MEMORY)]
+	for i, sample in enumerate(species.samples[species.num_stored:]):
+		arguments = (args, species.id, sample.dir, snps_store.count_path(args, species.id, species.num_stored+i))
+		tasks.append((snps_store.import_sample, arguments, species.genome_length, READER_MEMORY))
+	yield tasks
+	
+	species.site_ranges = site_ranges(num_sites, task_count(num_sites, args['threads']))
+	task_memory = species.window*len(species.samples)*4*8*4
+	tasks = []
+	for thread, (site_from, site_to) in enumerate(species.site_ranges):
+		tasks.append((update_sharded_tables, (species, args, thread, site_from, site_to), len(species.samples)*(site_to-site_from), task_memory))
+	shard_rows = yield tasks
+	yield [finish_task(species, args, num_sites, shard_rows)]
+
+def finish_task(species, args, num_sites, shard_rows=None):
+	return (finish_species, (species, args, shard_rows), len(species.samples)*num_sites, READER_MEMORY)
+
+def finish_species(species, args, shard_rows=None):
+	""" Write output files of species from its sharded tables and clean up """
+	row_index = merge_sharded_tables(species, args, shard_rows)
+	write_snps_readme(args, species)
+	species.write_sample_info(dtype='snps', outdir=args['outdir'])
+	if args['matrix']:
+		dir = snp_matrix.matrix_dir('%s/%s' % (args['outdir'], species.id))
+		snp_matrix.write_index(dir, [sample.id for sample in species.samples], args['matrix'])
+	if args['incremental']:
+		snps_store.commit_store(args, species, row_index)
+	shutil.rmtree(species.tempdir)
+	print("  %s: done" % species.id)
+
+def merge_sharded_tables(species, args, shard_rows=None):
+	""" Concatenate sharded tables of each range of sites of species, without their headers; bytes are copied by the kernel
+		shard_rows: number of rows and row index of each shard (see update_sharded_tables), to index rows of outputs
+		returns (row, offset in snps_freq.txt, offset in snps_depth.txt) of indexed rows, if shard_rows is given
+	"""
+	# headers
+	for file in write_merge_midas(species, args).values():
+		file.close()
+	# shard start in outputs and header length of each shard
+	starts, headers = {}, {}
+	for ftype in ['freq', 'depth', 'info']:
+		starts[ftype], headers[ftype] = [], []
+		with open('%s/%s/snps_%s.txt' % (args['outdir'], species.id, ftype), 'ab') as outfile:
+			for thread in range(len(species.site_ranges)):
+				path = '%s/%s/temp/snps_%s.%s.txt' % (args['outdir'], species.id, ftype, thread)
+				with open(path, 'rb') as infile:
+					headers[ftype].append(len(infile.readline()))
+				starts[ftype].append(outfile.tell())
+				utility.append_file(outfile, path, headers[ftype][-1])
+	# shift row index of shards to outputs
+	row_index, rows = [], 0
+	for thread, (num_rows, index) in enumerate(shard_rows or []):
+		for row, freq_offset, depth_offset in index:
+			row_index.append((rows + row,
+				starts['freq'][thread] + freq_offset - headers['freq'][thread],
+				starts['depth'][thread] + depth_offset - headers['depth'][thread]))
+		rows += num_rows
+	return row_index
 
 def write_snps_readme(args, sp):
 	outfile = open('%s/%s/readme.txt' % (args['outdir'], sp.id), 'w')
@@ -483,26 +623,16 @@ def run_pipeline(args):
 		print("    count samples: %s" % len(species.samples))
 	
 	print("\nMerging snps")
+	generators = []
 	for species in species_list:
-	
-		print("  %s" % species.id)
 		species.tempdir = '%s/%s/temp' % (args['outdir'], species.id)
 		if not os.path.isdir(species.tempdir): os.mkdir(species.tempdir)
-		species.sample_lists = utility.batch_samples(species.samples, threads=args['threads'])
-		species.num_splits = len(species.sample_lists)
 		
-		print("    merging count data")
-		parallel_build_temp_count_matrixes(species, args)
-
-		print("    calling SNPs")
-		parallel_build_sharded_tables(species, args)
-
-		print("    writing output files")
-		merge_sharded_tables(species, args)
-
-		print("    finishing")
-		write_snps_readme(args, species)
-		species.write_sample_info(dtype='snps', outdir=args['outdir'])
-		shutil.rmtree(species.tempdir)
-
-
+		matrix_dir = snp_matrix.matrix_dir('%s/%s' % (args['outdir'], species.id))
+		if os.path.isdir(matrix_dir): shutil.rmtree(matrix_dir)
+		if args['matrix']: os.mkdir(matrix_dir)
+		
+		generators.append(update_phases(species, args) if args['incremental'] else build_phases(species, args))
+	
+	# tasks of all species share one pool of processes
+	schedule(generators, args['threads'], merge_memory(args['threads'])*args['threads'])
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+# MIDAS: Metagenomic Intra-species Diversity Analysis System
+# Copyright (C) 2015 Stephen Nayfach
+# Freely distributed under the GNU General Public License (GPLv3)
+
+import os, shutil, itertools, numpy as np
+from midas import utility, snp_counts
+
+# merge store of merge_midas.py snps --incremental: {OUTDIR}/{SPECIES_ID}/store
+#   samples.txt: directory and allele count file identity of merged samples, in column order
+#   counts/sample.{N}.snps.bin: allele counts of N-th sample (see snp_counts.BinaryCountWriter)
+#   {name}.npy for each name in STATE: arrays over genome coordinates (site_id - 1)
+#     pooled: ACGT counts across merged samples
+#     major, minor: index of allele in ACGT, -1 if none
+#     count_samples: number of samples where site passes site filters
+#     kept: site has a row in snps_info.txt, snps_freq.txt and snps_depth.txt
+#   rows.npy: row number and byte offsets in snps_freq.txt and snps_depth.txt of indexed rows: every ROW_BLOCK-th row
+#             of each range of sites merged by one task
+#   manifest: parameters and identity of output files; written last, so its presence marks a complete store
+STORE_VERSION = 1
+STORE_PARAMS = ['db', 'allele_freq', 'site_depth', 'site_ratio', 'site_prev', 'snp_type', 'max_sites']
+STATE = [('pooled', np.int64, (4,), 0), ('major', np.int8, (), -1), ('minor', np.int8, (), -1),
+	('count_samples', np.int32, (), 0), ('kept', np.bool_, (), False)]
+ROW_BLOCK = 4096
+
+def store_dir(args, species_id):
+	return '%s/%s/store' % (args['outdir'], species_id)
+
+def output_paths(args, species_id):
+	return ['%s/%s/snps_%s.txt' % (args['outdir'], species_id, ftype) for ftype in ['info', 'freq', 'depth']]
+
+def sample_identity(sample, species_id):
+	""" Identity of allele counts of sample from run_midas.py snps """
+	basepath = '%s/snps/output/%s' % (sample.dir, species_id)
+	return utility.file_identity([basepath+'.snps.bin' if os.path.isfile(basepath+'.snps.bin') else basepath+'.snps.gz'])
+
+def manifest_values(args, species_id):
+	values = {'version':STORE_VERSION, 'species_id':species_id, 'params':utility.format_params(args, STORE_PARAMS)}
+	paths = output_paths(args, species_id)
+	values['outputs'] = utility.file_identity(paths) if all([os.path.isfile(path) for path in paths]) else 'missing'
+	return values
+
+def count_path(args, species_id, index):
+	return '%s/counts/sample.%s.snps.bin' % (store_dir(args, species_id), index)
+
+def open_store(args, species, genome_length):
+	""" Order samples of species as in the merge store, followed by new samples; return number of stored samples
+		the store is reset when it is incomplete, was built with other parameters, or a stored sample was
+		removed from the input or rerun
+	"""
+	dir = store_dir(args, species.id)
+	selected = dict([(os.path.abspath(sample.dir), sample) for sample in species.samples])
+	stored = []
+	if utility.read_manifest(dir+'/manifest', manifest_values(args, species.id)):
+		for line in open(dir+'/samples.txt'):
+			sample_dir, identity = line.rstrip('\n').split('\t')
+			if sample_dir not in selected or sample_identity(selected[sample_dir], species.id) != identity:
+				print("    sample %s was removed or rerun; rebuilding merge store" % sample_dir)
+				stored = []
+				break
+			stored.append(selected[sample_dir])
+	if len(stored) == 0:
+		reset_store(dir, genome_length)
+	else:
+		# store is updated in place from here on
+		os.remove(dir+'/manifest')
+	species.samples = stored + [sample for sample in species.samples if sample not in stored]
+	species.fetch_sample_depth()
+	return len(stored)
+
+def reset_store(dir, genome_length):
+	""" Empty store: no samples and initial state of every site """
+	if os.path.isdir(dir): shutil.rmtree(dir)
+	os.makedirs(dir+'/counts')
+	create_state(dir, genome_length)
+
+def create_state(dir, genome_length):
+	""" Write state arrays with initial values to dir; threads fill in their sites """
+	for name, dtype, shape, value in STATE:
+		array = np.lib.format.open_memmap('%s/%s.npy' % (dir, name), mode='w+', dtype=dtype, shape=(genome_length,)+shape)
+		array[:] = value
+		del array
+
+def reset_next_state(args, species_id, genome_length):
+	""" Initial next state of store, filled in by snps.update_sharded_tables and committed by commit_store """
+	dir = store_dir(args, species_id)+'/next'
+	if os.path.isdir(dir): shutil.rmtree(dir)
+	os.mkdir(dir)
+	create_state(dir, genome_length)
+
+def read_state(dir, mode='r'):
+	""" Memory-mapped state arrays of store (or of next state) """
+	return dict([(name, np.load('%s/%s.npy' % (dir, name), mmap_mode=mode)) for name, dtype, shape, value in STATE])
+
+def import_sample(args, species_id, sample_dir, path):
+	""" Copy allele counts of sample from run_midas.py snps output into store as binary container """
+	basepath = '%s/snps/output/%s' % (sample_dir, species_id)
+	if os.path.isfile(basepath+'.snps.bin'):
+		shutil.copy(basepath+'.snps.bin', path)
+		return
+	genome = utility.read_genome(args['db'], species_id)
+	offsets, genome_length = snp_counts.genome_offsets(genome)
+	reader = snp_counts.CountReader(basepath+'.snps.gz', offsets)
+	writer = snp_counts.BinaryCountWriter(path)
+	for contig_id in sorted(genome.keys()):
+		writer.write_contig(contig_id, reader.fetch(contig_id, 0, len(genome[contig_id])).T)
+	writer.close()
+	reader.close()
+
+def open_counts(path, offsets):
+	""" Open allele counts of a sample in the store (offsets are not needed; see snps.merge_counts) """
+	return snp_counts.BinaryCountReader(path)
+
+def open_rows(args, species_id, site_from):
+	""" Open snps_freq.txt and snps_depth.txt of previous merge at first row of site_from or later """
+	dir = store_dir(args, species_id)
+	row = int(np.count_nonzero(np.load(dir+'/kept.npy', mmap_mode='r')[:site_from]))
+	index = np.load(dir+'/rows.npy')
+	i = np.searchsorted(index[:, 0], row, 'right') - 1
+	files = {}
+	for j, ftype in enumerate(['freq', 'depth']):
+		files[ftype] = open('%s/%s/snps_%s.txt' % (args['outdir'], species_id, ftype))
+		if i >= 0:
+			# nearest indexed row at or before row
+			files[ftype].seek(int(index[i, j+1]))
+			for line in itertools.islice(files[ftype], row - int(index[i, 0])):
+				pass
+	return files
+
+def commit_store(args, species, row_index):
+	""" Replace state with next state, record samples and row index of outputs, and mark store complete """
+	dir = store_dir(args, species.id)
+	for name, dtype, shape, value in STATE:
+		os.rename('%s/next/%s.npy' % (dir, name), '%s/%s.npy' % (dir, name))
+	os.rmdir(dir+'/next')
+	np.save(dir+'/rows.npy', np.array(row_index, dtype=np.int64).reshape(-1, 3))
+	with open(dir+'/samples.txt', 'w') as file:
+		for sample in species.samples:
+			file.write('%s\t%s\n' % (os.path.abspath(sample.dir), sample_identity(sample, species.id)))
+	utility.write_manifest(dir+'/manifest', manifest_values(args, species.id))
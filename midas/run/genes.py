@@ -4,21 +4,19 @@
 # Copyright (C) 2015 Stephen Nayfach
 # Freely distributed under the GNU General Public License (GPLv3)
 
-import sys, os, subprocess, gzip, csv, Bio.SeqIO, numpy as np
-from collections import defaultdict
+import sys, os, subprocess, gzip, Bio.SeqIO, numpy as np
 from time import time
 from midas import utility
+from midas.run import shards
 
 class Species:
 	""" Base class for species """
 	def __init__(self, id):
 		self.id = id
 		self.paths = {}
-		self.genes = []
 		self.pangenome_size = 0
 		self.aligned_reads = 0
 		self.mapped_reads = 0
-		self.markers = defaultdict(float)
 		
 	def init_ref_db(self, ref_db):
 		""" Set paths to input files """
@@ -28,6 +26,7 @@ class Species:
 				inpath = '%s/%s%s' % (self.dir, file, ext)
 				if os.path.isfile(inpath):
 					self.paths[file] = inpath
+		self.paths['centroids.npy'] = '%s/centroids.npy' % self.dir
 
 def initialize_species(args):
 	""" Initialize Species objects """
@@ -47,39 +46,74 @@ def initialize_species(args):
 		sp.init_ref_db(args['db'])
 	return species
 
-class Gene:
-	""" Base class for gene """
-	def __init__(self, id):
-		self.id = id
-		self.aligned_reads = 0
-		self.mapped_reads = 0
-		self.depth = 0.0
-		self.length = 0
-		self.copies = 0.0
-		self.marker_id = None
+class GeneTable:
+	""" Columnar table of genes across species
+		genes from each species occupy a contiguous range of rows, sorted by gene_id
+	"""
+	def __init__(self, species):
+		self.species_ids = []
+		self.gene_ids = [] # per-species arrays of gene_ids
+		lengths, markers, species_index = [], [], []
+		row = 0
+		for index, sp in enumerate(species):
+			table = utility.read_gene_table(sp.paths['centroids.npy'])
+			sp.index = index
+			sp.start, sp.end = row, row + len(table)
+			sp.pangenome_size = len(table)
+			row = sp.end
+			self.species_ids.append(sp.id)
+			self.gene_ids.append(table['gene_id'])
+			lengths.append(table['length'])
+			markers.append(table['marker'])
+			species_index.append(np.full(len(table), index, dtype=np.int32))
+		self.size = row
+		self.length = np.concatenate(lengths).astype(np.uint32) if row else np.zeros(0, dtype=np.uint32)
+		self.marker = np.concatenate(markers).astype(np.int8) if row else np.zeros(0, dtype=np.int8)
+		self.species = np.concatenate(species_index) if row else np.zeros(0, dtype=np.int32)
+		self.aligned_reads = np.zeros(self.size, dtype=np.uint32)
+		self.mapped_reads = np.zeros(self.size, dtype=np.uint32)
+		self.depth = np.zeros(self.size, dtype=np.float64)
+		self.copies = np.zeros(self.size, dtype=np.float64)
+
+	def lookup(self, names):
+		""" Map list of gene_ids (e.g. BAM reference names) to rows; -1 if not found """
+		rows = np.full(len(names), -1, dtype=np.int64)
+		if self.size == 0 or len(names) == 0:
+			return rows
+		ids = np.concatenate(self.gene_ids)
+		order = np.argsort(ids, kind='mergesort')
+		names = np.array([name.encode('ascii') for name in names])
+		pos = np.minimum(np.searchsorted(ids, names, sorter=order), len(ids) - 1)
+		found = ids[order[pos]] == names
+		rows[found] = order[pos[found]]
+		return rows
 
 def initialize_genes(args, species):
-	""" Initialize Gene objects """
-	genes = {}
-	# fetch gene_id, species_id, gene length
+	""" Initialize GeneTable """
+	marker_map = None
 	for sp in species.values():
-		path = sp.paths['centroids.ffn']
-		file = utility.iopen(path)
-		for seq in Bio.SeqIO.parse(file, 'fasta'):
-			genes[seq.id] = Gene(seq.id)
-			genes[seq.id].species_id = sp.id
-			genes[seq.id].length = len(seq.seq)
-			sp.pangenome_size += 1
-		file.close()
-	# fetch marker_id
-	path = '%s/marker_genes/phyeco.map' % args['db']
-	file = utility.iopen(path)
-	reader = csv.DictReader(file, delimiter='\t')
-	for r in reader:
-		if r['gene_id'] in genes:
-			genes[r['gene_id']].marker_id=r['marker_id']
+		if not os.path.isfile(sp.paths['centroids.npy']):
+			if marker_map is None:
+				marker_map = utility.read_marker_map(args['db'])
+			build_gene_table(args, sp, marker_map)
+	return GeneTable(list(species.values()))
+
+def build_gene_table(args, sp, marker_map):
+	""" Build missing gene table for species from centroids.ffn and phyeco.map """
+	marker_list = sorted(set(marker_map.values()))
+	gene_ids, lengths, marker_ids = [], [], []
+	file = utility.iopen(sp.paths['centroids.ffn'])
+	for seq in Bio.SeqIO.parse(file, 'fasta'):
+		gene_ids.append(seq.id)
+		lengths.append(len(seq.seq))
+		marker_ids.append(marker_map.get(seq.id))
 	file.close()
-	return genes
+	# cache table in database if writable; otherwise write to temp directory
+	try:
+		utility.write_gene_table(sp.paths['centroids.npy'], gene_ids, lengths, marker_ids, marker_list)
+	except (IOError, OSError):
+		sp.paths['centroids.npy'] = '%s/genes/temp/%s.centroids.npy' % (args['outdir'], sp.id)
+		utility.write_gene_table(sp.paths['centroids.npy'], gene_ids, lengths, marker_ids, marker_list)
 
 def build_pangenome_db(args, species):
 	""" Build FASTA and BT2 database from pangene species centroids """
@@ -89,22 +123,34 @@ def build_pangenome_db(args, species):
 	pangenome_fasta = open('/'.join([outdir, 'pangenomes.fa']), 'w')
 	pangenome_map = open('/'.join([outdir, 'pangenomes.map']), 'w')
 	db_stats = {'total_length':0, 'total_seqs':0, 'species':0}
+	ranges, sizes, offset = {}, {}, 0 # byte range and length of each species in fasta
 	for sp in species.values():
 		db_stats['species'] += 1
+		start, sizes[sp.id] = offset, 0
 		infile = utility.iopen(sp.paths['centroids.ffn'])
 		for r in Bio.SeqIO.parse(infile, 'fasta'):
-			pangenome_fasta.write('>%s\n%s\n' % (r.id, str(r.seq).upper()))
+			record = '>%s\n%s\n' % (r.id, str(r.seq).upper())
+			pangenome_fasta.write(record)
 			pangenome_map.write('%s\t%s\n' % (r.id, sp.id))
+			offset += len(record)
+			sizes[sp.id] += len(r.seq)
 			db_stats['total_length'] += len(r.seq)
 			db_stats['total_seqs'] += 1
 		infile.close()
+		ranges[sp.id] = (start, offset)
 	pangenome_fasta.close()
 	pangenome_map.close()
 	# print out database stats
 	print("  total species: %s" % db_stats['species'])
 	print("  total genes: %s" % db_stats['total_seqs'])
 	print("  total base-pairs: %s" % db_stats['total_length'])
-	# bowtie2 database
+	# fasta database only needed to decode input CRAM
+	if args['input_bam']:
+		return
+	# bowtie2 database, optionally split into shards
+	if int(args['shards']) > 1:
+		shards.build_shards(args, outdir, '/'.join([outdir, 'pangenomes.fa']), ranges, sizes)
+		return
 	command = '%s ' % args['bowtie2-build']
 	command += '--threads %s ' % args['threads']
 	command += '%s/genes/temp/pangenomes.fa ' % args['outdir']
@@ -115,132 +161,264 @@ def build_pangenome_db(args, species):
 
 def pangenome_align(args):
 	""" Use Bowtie2 to map reads to all specified genome species """
-	# Bowtie2
-	command = '%s --no-unal ' % args['bowtie2']
-	command += '-x %s ' % '/'.join([args['outdir'], 'genes/temp/pangenomes']) # index
-	if args['max_reads']: command += '-u %s ' % args['max_reads'] # max num of reads
-	if args['trim']: command += '--trim3 %s ' % args['trim'] # trim 3'
-	command += '--%s' % args['speed'] # alignment speed
-	command += '-local ' if args['mode'] == 'local' else ' ' # global/local alignment
-	command += '--threads %s ' % args['threads'] #   threads
-	command += '-f ' if args['file_type'] == 'fasta' else '-q ' # input type
-	if args['m2']: # -1 and -2 contain paired reads
-		command += '-1 %s -2 %s ' % (args['m1'], args['m2']) 
-	elif args['interleaved']: # -1 contains paired reads
-		command += '--interleaved %s ' % args['m1'] 
-	else: # -1 contains unpaired reads
-		command += '-U %s ' % args['m1'] 
-	# Output unsorted bam
 	bampath = '/'.join([args['outdir'], 'genes/temp/pangenomes.bam'])
-	command += '| %s view ' % args['samtools']
-	command += '--threads %s ' % args['threads']
-	command += '-b - > %s' % bampath
-	# Run command
-	args['log'].write('command: '+command+'\n')
-	process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	# Check for errors
-	utility.check_exit_code(process, command)
+	if int(args['shards']) > 1:
+		tempdir = '/'.join([args['outdir'], 'genes/temp'])
+		shards.align_shards(args, shards.read_shards(tempdir), tempdir, bampath)
+	else:
+		# Bowtie2
+		command = utility.bowtie2_command(args, '/'.join([args['outdir'], 'genes/temp/pangenomes']), args['threads'])
+		# Output unsorted bam
+		command += '| %s view ' % args['samtools']
+		command += '--threads %s ' % args['threads']
+		command += '-b - > %s' % bampath
+		# Run command
+		args['log'].write('command: '+command+'\n')
+		process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		# Check for errors
+		utility.check_exit_code(process, command)
 	print("  finished aligning")
 	print("  checking bamfile integrity")
 	utility.check_bamfile(args, bampath)
 
-def pangenome_coverage(args, species, genes):
-	""" Compute coverage of pangenome for species_id and write results to disk """
+def pangenome_coverage(args, species, genes, pending):
+	""" Compute coverage of pangenome for species_id and write results of pending species to disk """
 	count_mapped_bp(args, species, genes)
 	normalize(args, species, genes)
-	write_results(args, species, genes)
-
-def keep_read(aln, min_pid, min_readq, min_mapq, min_aln_cov):
-	align_len = len(aln.query_alignment_sequence)
-	query_len = aln.query_length
-	# min pid
-	if 100*(align_len-dict(aln.tags)['NM'])/float(align_len) < min_pid:
-		return False
-	# min read quality
-	elif np.mean(aln.query_qualities) < min_readq:
-		return False
-	# min map quality
-	elif aln.mapping_quality < min_mapq:
-		return False
-	# min aln cov
-	elif align_len/float(query_len)  < min_aln_cov:
-		return False
+	write_results(args, pending, genes)
+
+def prepare_input_bam(args):
+	""" Locate index of sorted BAM/CRAM input, or build one in the temp directory """
+	args['bam_index'] = None
+	if not utility.is_sorted_bam(args['input_bam']):
+		print("  input is not coordinate-sorted: streaming all alignments")
+		return
+	args['bam_index'] = utility.find_bam_index(args['input_bam'])
+	if args['bam_index'] is None:
+		args['bam_index'] = '%s/genes/temp/input.%s' % (args['outdir'], 'crai' if utility.is_cram(args['input_bam']) else 'bai')
+		command = '%s index %s %s' % (args['samtools'], args['input_bam'], args['bam_index'])
+		args['log'].write('command: '+command+'\n')
+		process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		utility.check_exit_code(process, command)
+	print("  input is coordinate-sorted: fetching selected genes by region")
+
+def keep_reads(alns, min_pid, min_readq, min_mapq, min_aln_cov):
+	""" Boolean mask of alignments in summary table that pass filters """
+	align_len = alns['align_len'].astype(np.float64)
+	query_len = alns['query_len'].astype(np.float64)
+	keep = 100*(align_len-alns['nm'])/align_len >= min_pid
+	keep &= alns['qual_sum']/query_len >= min_readq
+	keep &= alns['mapq'] >= min_mapq
+	keep &= align_len/query_len >= min_aln_cov
+	return keep
+
+def bam_path(args):
+	""" Path to alignments: user-supplied BAM/CRAM or output of pangenome_align """
+	if args['input_bam']:
+		return args['input_bam']
 	else:
-		return True
-		
+		return '/'.join([args['outdir'], 'genes/temp/pangenomes.bam'])
+
+def bam_reference(args):
+	""" Path to FASTA used to decode CRAM input """
+	path = '/'.join([args['outdir'], 'genes/temp/pangenomes.fa'])
+	return path if os.path.isfile(path) else None
+
+def check_input_bam(args, genes):
+	""" Check that user-supplied BAM/CRAM was aligned to pangenomes of selected species """
+	bamfile = utility.open_bam(bam_path(args), reference=bam_reference(args))
+	rows = genes.lookup(bamfile.references)
+	lengths = np.array(bamfile.lengths, dtype=np.int64)
+	bamfile.close()
+	found = np.zeros(genes.size, dtype=bool)
+	found[rows[rows >= 0]] = True
+	different = (rows >= 0) & (lengths != genes.length[np.maximum(rows, 0)])
+	if not found.all() or different.any():
+		error = "\nError: reference sequences in %s do not match the selected species\n" % bam_path(args)
+		error += "%s gene(s) not found in header; %s gene(s) have different lengths\n" % ((~found).sum(), different.sum())
+		error += "Make sure reads were aligned to pangenomes from the MIDAS reference database specified by -d\n"
+		sys.exit(error)
+
+def fetch_alignments(args, bamfile, rows):
+	""" Yield alignments to selected genes; use region queries for sorted, indexed input """
+	if args.get('bam_index'):
+		for tid in np.flatnonzero(rows >= 0):
+			for aln in bamfile.fetch(bamfile.references[tid]):
+				yield aln
+	else:
+		for aln in bamfile.fetch(until_eof = True):
+			yield aln
+
+ALIGNMENT_DTYPE = np.dtype([('ref', '<i4'), ('align_len', '<u4'), ('nm', '<u4'),
+	('qual_sum', '<u8'), ('mapq', '<u1'), ('query_len', '<u4')])
+ALIGNMENT_CHUNK = 1000000 # alignments per chunk of summarize_alignments
+
+def alignment_table_path(args):
+	return '/'.join([args['outdir'], 'genes/temp/alignments.npz'])
+
+def summarize_alignments(args, genes):
+	""" Read BAM once and write columnar summary of alignments to selected genes """
+	index = args.get('bam_index')
+	bamfile = utility.open_bam(bam_path(args), index=index, reference=bam_reference(args))
+	rows = genes.lookup(bamfile.references)
+	# alignments are stored in fixed-size chunks of the final dtype, so memory stays close to the size of the table
+	chunks, chunk, n = [], np.zeros(ALIGNMENT_CHUNK, dtype=ALIGNMENT_DTYPE), 0
+	for aln in fetch_alignments(args, bamfile, rows):
+		if args['input_bam'] and not utility.is_primary(aln):
+			continue
+		if rows[aln.reference_id] < 0: # reference not in selected species
+			continue
+		chunk[n] = (
+			aln.reference_id,
+			aln.query_alignment_length,
+			aln.get_tag('NM'),
+			np.sum(aln.query_qualities),
+			aln.mapping_quality,
+			aln.query_length)
+		n += 1
+		if n == ALIGNMENT_CHUNK:
+			chunks.append(chunk)
+			chunk, n = np.zeros(ALIGNMENT_CHUNK, dtype=ALIGNMENT_DTYPE), 0
+	chunks.append(chunk[:n])
+	alns = np.concatenate(chunks)
+	del chunks, chunk
+	references = np.array(bamfile.references, dtype=bytes)
+	bamfile.close()
+	# write to temp file first so an interrupted run never leaves a partial table
+	path = alignment_table_path(args)
+	with open(path+'.tmp', 'wb') as f:
+		np.savez(f, references=references, alignments=alns)
+	os.rename(path+'.tmp', path)
+	return references, alns
+
+def read_alignments(args):
+	""" Read cached summary of alignments written by summarize_alignments """
+	with np.load(alignment_table_path(args)) as data:
+		return data['references'], data['alignments']
+
 def count_mapped_bp(args, species, genes):
 	""" Count number of bp mapped to each gene across pangenomes """
-	import pysam
-	bam_path = '/'.join([args['outdir'], 'genes/temp/pangenomes.bam'])
-	bamfile = pysam.AlignmentFile(bam_path, "rb")
-
-	# loop over alignments, sum values per gene
-	for index, aln in enumerate(bamfile.fetch(until_eof = True)):
-			
-		gene = genes[bamfile.getrname(aln.reference_id)]
-		species[gene.species_id].aligned_reads += 1
-		gene.aligned_reads += 1
-		
-		if not keep_read(aln, args['mapid'], args['readq'], args['mapq'], args['aln_cov']):
-			continue
-		else:
-			species[gene.species_id].mapped_reads += 1			
-			gene.mapped_reads += 1
-			gene.depth += len(aln.query_alignment_sequence)/float(gene.length)
-	
-	print("  total aligned reads: %s" % sum([sp.aligned_reads for sp in species.values()]))
-	print("  total mapped reads: %s" % sum([sp.mapped_reads for sp in species.values()]))
+	if args['refilter']:
+		references, alns = read_alignments(args)
+		print("  read %s cached alignments" % len(alns))
+	else:
+		references, alns = summarize_alignments(args, genes)
+	rows = genes.lookup([ref.decode('ascii') for ref in references])[alns['ref']]
+	alns = alns[rows >= 0] # references not in selected species
+	rows = rows[rows >= 0]
+	genes.aligned_reads[:] = np.bincount(rows, minlength=genes.size)
 	
-	# loop over genes, sum values per species
-	for gene in genes.values():
-		species[gene.species_id].genes.append(gene.depth)
+	# apply read filters, sum values per gene
+	keep = keep_reads(alns, args['mapid'], args['readq'], args['mapq'], args['aln_cov'])
+	rows = rows[keep]
+	genes.mapped_reads[:] = np.bincount(rows, minlength=genes.size)
+	genes.depth[:] = np.bincount(rows, weights=alns['align_len'][keep]/genes.length[rows].astype(np.float64), minlength=genes.size)
 	
 	# loop over species, compute summaries
 	for sp in species.values():
-		non_zero_genes = [_ for _ in sp.genes if _ > 0]
-		sp.covered_genes = len(non_zero_genes)
-		sp.mean_coverage = np.mean(non_zero_genes) if len(non_zero_genes) > 0 else 0
+		depth = genes.depth[sp.start:sp.end]
+		sp.aligned_reads = int(genes.aligned_reads[sp.start:sp.end].sum())
+		sp.mapped_reads = int(genes.mapped_reads[sp.start:sp.end].sum())
+		sp.covered_genes = int((depth > 0).sum())
+		sp.mean_coverage = np.mean(depth[depth > 0]) if sp.covered_genes > 0 else 0
 		sp.fraction_covered = sp.covered_genes/float(sp.pangenome_size)
+	
+	print("  total aligned reads: %s" % sum([sp.aligned_reads for sp in species.values()]))
+	print("  total mapped reads: %s" % sum([sp.mapped_reads for sp in species.values()]))
 
 def normalize(args, species, genes):
-	""" Count number of bp mapped to each marker gene """
-	# compute marker depth
-	for gene in genes.values():
-		if gene.marker_id is not None:
-			species[gene.species_id].markers[gene.marker_id] += gene.depth
-	# compute median marker depth
+	""" Normalize gene depth by median depth of marker genes """
 	for sp in species.values():
-		sp.marker_coverage = np.median(list(sp.markers.values()))
-	# normalize genes by median marker depth
-	for gene in genes.values():
-		sp = species[gene.species_id]
+		depth = genes.depth[sp.start:sp.end]
+		marker = genes.marker[sp.start:sp.end]
+		# compute marker depth
+		codes = np.unique(marker[marker >= 0])
+		marker_depth = [depth[marker == code].sum() for code in codes]
+		# compute median marker depth
+		sp.marker_coverage = np.median(marker_depth)
+		# normalize genes by median marker depth
 		if sp.marker_coverage > 0:
-			gene.copies = gene.depth/sp.marker_coverage
+			genes.copies[sp.start:sp.end] = depth/sp.marker_coverage
+
+def write_species_results(outdir, species_id, gene_ids, reads, depths, copies, binary):
+	""" Write gene coverage for one species; values are formatted in bulk """
+	header = ['gene_id', 'count_reads', 'coverage', 'copy_number']
+	path = '/'.join([outdir, 'genes/output/%s' % species_id])
+	outfile = utility.iopen(path+'.genes.tmp.gz', 'w')
+	outfile.write('\t'.join(header)+'\n')
+	if len(gene_ids) > 0:
+		columns = [gene_ids.astype(str), reads.astype(str), depths.astype(str), copies.astype(str)]
+		outfile.write('\n'.join(['\t'.join(values) for values in zip(*columns)])+'\n')
+	outfile.close()
+	os.rename(path+'.genes.tmp.gz', path+'.genes.gz')
+	# optional binary sidecar: covered genes only, indexed by row of gene table in database
+	if binary:
+		index = np.flatnonzero((reads > 0) | (depths > 0))
+		dtype = [('gene', '<u4'), ('reads', '<u4'), ('depth', '<f4'), ('copies', '<f4')]
+		table = np.zeros(len(index), dtype=dtype)
+		table['gene'] = index
+		table['reads'] = reads[index]
+		table['depth'] = depths[index]
+		table['copies'] = copies[index]
+		with open(path+'.genes.npy.tmp', 'wb') as file:
+			np.save(file, table)
+		os.rename(path+'.genes.npy.tmp', path+'.genes.npy')
 
 def write_results(args, species, genes):
 	""" Write results to disk """
-	# open outfiles for each species_id
-	header = ['gene_id', 'count_reads', 'coverage', 'copy_number']
+	# write output files for species in parallel
+	argument_list = []
 	for sp in species.values():
-		path = '/'.join([args['outdir'], 'genes/output/%s.genes.gz' % sp.id])
-		sp.out = utility.iopen(path, 'w')
-		sp.out.write('\t'.join(header)+'\n')
-	# write to output files
-	for gene_id in sorted(genes):
-		gene = genes[gene_id]
-		sp = species[gene.species_id]
-		values = [gene.id, gene.mapped_reads, gene.depth, gene.copies]
-		sp.out.write('\t'.join([str(_) for _ in values])+'\n')
-	# close output files
+		argument_list.append([args['outdir'], sp.id,
+			np.asarray(genes.gene_ids[sp.index]),
+			genes.mapped_reads[sp.start:sp.end],
+			genes.depth[sp.start:sp.end],
+			genes.copies[sp.start:sp.end],
+			args['binary']])
+	utility.parallel(write_species_results, argument_list, args['threads'])
+	# record completed species once their output files are in place
 	for sp in species.values():
-		sp.out.close()
-	# summary stats
+		values = manifest_values(args, sp.id)
+		values.update(zip(SUMMARY_FIELDS[1:], [str(getattr(sp, _)) for _ in SUMMARY_FIELDS[1:]]))
+		# rows of gene table that the binary sidecar refers to
+		if args['binary']:
+			values['gene_table'] = utility.gene_table_key(genes.gene_ids[sp.index])
+		utility.write_manifest('/'.join([args['outdir'], 'genes/output/%s.manifest' % sp.id]), values)
+
+SUMMARY_FIELDS = ['species_id', 'pangenome_size', 'covered_genes', 'fraction_covered', 'mean_coverage', 'marker_coverage', 'aligned_reads', 'mapped_reads']
+COVERAGE_PARAMS = ['db', 'mapid', 'readq', 'mapq', 'aln_cov', 'trim', 'binary']
+
+def coverage_input(args, species):
+	""" Identity of the input that coverage is computed from: the reads when this run aligns them, otherwise the alignments """
+	if args['align']:
+		return utility.reads_identity(args, species)
+	elif os.path.isfile(bam_path(args)):
+		return utility.file_identity([bam_path(args)])
+	else:
+		return utility.file_identity([alignment_table_path(args)])
+
+def manifest_values(args, species_id):
+	return {'species_id':species_id, 'params':utility.format_params(args, COVERAGE_PARAMS), 'input':args['coverage_input']}
+
+def pending_species(args, species):
+	""" Load summary stats of species completed by a previous run with the same parameters and input; return the others """
+	pending = {}
+	for sp in species.values():
+		manifest = utility.read_manifest('/'.join([args['outdir'], 'genes/output/%s.manifest' % sp.id]), manifest_values(args, sp.id))
+		if manifest and os.path.isfile('/'.join([args['outdir'], 'genes/output/%s.genes.gz' % sp.id])):
+			for field in SUMMARY_FIELDS[1:]:
+				setattr(sp, field, manifest[field])
+		else:
+			pending[sp.id] = sp
+	return pending
+
+def write_summary(args, species):
+	""" Write summary stats of all species """
 	path = '/'.join([args['outdir'], 'genes/summary.txt'])
 	file = open(path, 'w')
-	header = ['species_id', 'pangenome_size', 'covered_genes', 'fraction_covered', 'mean_coverage', 'marker_coverage', 'aligned_reads', 'mapped_reads']
-	file.write('\t'.join(header)+'\n')
+	file.write('\t'.join(SUMMARY_FIELDS)+'\n')
 	for sp in species.values():
-		values = [sp.id, sp.pangenome_size, sp.covered_genes, sp.fraction_covered, sp.mean_coverage, sp.marker_coverage, sp.aligned_reads, sp.mapped_reads]
+		values = [sp.id] + [getattr(sp, _) for _ in SUMMARY_FIELDS[1:]]
 		file.write('\t'.join([str(_) for _ in values])+'\n')
 	file.close()
 
@@ -260,8 +438,17 @@ def run_pipeline(args):
 	print("  %s minutes" % round((time() - start)/60, 2) )
 	print("  %s Gb maximum memory" % utility.max_mem_usage())
 
+	# Species completed by a previous run with the same parameters and input are not rewritten;
+	# reads are not realigned when no species is left to compute
+	if args['cov']:
+		args['coverage_input'] = coverage_input(args, species)
+		pending = pending_species(args, species)
+		if args['align'] and not pending:
+			args['build_db'] = args['align'] = False
+
 	# Build pangenome database for selected species
-	if args['build_db']:
+	# with --input_bam, only the FASTA database is built to decode CRAM input
+	if args['build_db'] and (not args['input_bam'] or utility.is_cram(args['input_bam'])):
 		print("\nBuilding pangenome database")
 		args['log'].write("\nBuilding pangenome database\n")
 		start = time()
@@ -283,7 +470,14 @@ def run_pipeline(args):
 		start = time()
 		print("\nComputing coverage of pangenomes")
 		args['log'].write("\nComputing coverage of pangenomes\n")
-		pangenome_coverage(args, species, genes)
+		if len(pending) < len(species):
+			print("  skipping %s species completed by a previous run" % (len(species) - len(pending)))
+		if pending and args['input_bam'] and not args['refilter']:
+			check_input_bam(args, genes)
+			prepare_input_bam(args)
+		if pending:
+			pangenome_coverage(args, species, genes, pending)
+		write_summary(args, species)
 		print("  %s minutes" % round((time() - start)/60, 2) )
 		print("  %s Gb maximum memory" % utility.max_mem_usage())
 
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+# MIDAS: Metagenomic Intra-species Diversity Analysis System
+# Copyright (C) 2015 Stephen Nayfach
+# Freely distributed under the GNU General Public License (GPLv3)
+
+import os, subprocess, hashlib, shutil, zlib
+from midas import utility
+
+def partition(sizes, n):
+	""" Split species into at most n groups of similar total size (largest first, into smallest group) """
+	groups = [[] for i in range(n)]
+	totals = [0 for i in range(n)]
+	for species_id in sorted(sizes, key=lambda x: (-sizes[x], x)):
+		i = totals.index(min(totals))
+		groups[i].append(species_id)
+		totals[i] += sizes[species_id]
+	return [sorted(group) for group in groups if len(group) > 0]
+
+def shard_key(species_ids, ranges):
+	""" Name of shard directory; changes when species or sequence content change """
+	key = '\n'.join(['%s\t%s' % (i, ranges[i][1]-ranges[i][0]) for i in species_ids])
+	return hashlib.md5(key.encode('ascii')).hexdigest()[:16]
+
+def write_shard_fasta(fasta, ranges, species_ids, outpath):
+	""" Copy FASTA records of species in shard from combined FASTA """
+	with open(fasta, 'rb') as infile, open(outpath, 'wb') as outfile:
+		for species_id in species_ids:
+			start, end = ranges[species_id]
+			infile.seek(start)
+			remaining = end - start
+			while remaining > 0:
+				block = infile.read(min(remaining, 1024*1024))
+				outfile.write(block)
+				remaining -= len(block)
+
+def build_shards(args, tempdir, fasta, ranges, sizes):
+	""" Build size-balanced bowtie2 index shards in parallel; reuse shards built by previous runs """
+	groups = partition(sizes, int(args['shards']))
+	threads = max(1, int(args['threads'])//len(groups))
+	prefixes, processes = [], []
+	for species_ids in groups:
+		shard_dir = '%s/shards/%s' % (tempdir, shard_key(species_ids, ranges))
+		prefix = '%s/db' % shard_dir
+		prefixes.append(prefix)
+		if os.path.isfile('%s/done' % shard_dir):
+			print("  shard %s: %s species (cached)" % (len(prefixes), len(species_ids)))
+			continue
+		print("  shard %s: %s species, %s bp" % (len(prefixes), len(species_ids), sum([sizes[i] for i in species_ids])))
+		if os.path.isdir(shard_dir): shutil.rmtree(shard_dir)
+		os.makedirs(shard_dir)
+		write_shard_fasta(fasta, ranges, species_ids, prefix+'.fa')
+		command = '%s ' % args['bowtie2-build']
+		command += '--threads %s ' % threads
+		command += '%s.fa %s ' % (prefix, prefix)
+		args['log'].write('command: '+command+'\n')
+		process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		processes.append((process, command, shard_dir, species_ids))
+	for process, command, shard_dir, species_ids in processes:
+		utility.check_exit_code(process, command)
+		with open('%s/done' % shard_dir, 'w') as f:
+			f.write('\n'.join(species_ids)+'\n')
+	with open('%s/shards.txt' % tempdir, 'w') as f:
+		f.write('\n'.join(prefixes)+'\n')
+
+def read_shards(tempdir):
+	""" List of bowtie2 index prefixes written by build_shards """
+	return [line.rstrip() for line in open('%s/shards.txt' % tempdir)]
+
+def align_shards(args, prefixes, tempdir, outpath):
+	""" Align reads to index shards (bowtie2 prefixes) concurrently and merge alignments into unsorted BAM """
+	threads = max(1, int(args['threads'])//len(prefixes))
+	processes, bampaths = [], []
+	for i, prefix in enumerate(prefixes):
+		bampath = '%s/shard.%s.bam' % (tempdir, i)
+		bampaths.append(bampath)
+		# keep unaligned reads and input order so shards can be read in lockstep
+		command = utility.bowtie2_command(args, prefix, threads, no_unal=False)
+		command += '--reorder '
+		command += '| %s view -b - > %s' % (args['samtools'], bampath)
+		args['log'].write('command: '+command+'\n')
+		process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		processes.append((process, command))
+	for process, command in processes:
+		utility.check_exit_code(process, command)
+	stats = merge_alignments(bampaths, outpath)
+	print("  %s reads aligned to best of %s shards; %s tied across shards" % (stats['aligned'], len(prefixes), stats['tied']))
+	for bampath in bampaths:
+		os.remove(bampath)
+
+def read_groups(bamfile):
+	""" Yield records of each read (or read pair) from bowtie2 output """
+	group = []
+	for aln in bamfile.fetch(until_eof=True):
+		if aln.is_secondary or aln.is_supplementary:
+			continue
+		group.append(aln)
+		if not aln.is_paired or len(group) == 2:
+			yield group
+			group = []
+
+def score(group):
+	""" Rank read alignments by number of aligned mates, then total alignment score """
+	aligned = [aln for aln in group if not aln.is_unmapped]
+	return (len(aligned), sum([aln.get_tag('AS') for aln in aligned]))
+
+def merge_alignments(bampaths, outpath):
+	""" Keep best-scoring shard for each read; reads tied across shards get mapping quality 0
+		among tied shards, one is picked by a hash of the read name, as bowtie2 picks among equally good hits at random
+	"""
+	import pysam
+	infiles = [pysam.AlignmentFile(path, 'rb', check_sq=False) for path in bampaths]
+	references = []
+	for infile in infiles:
+		references += [{'SN':name, 'LN':length} for name, length in zip(infile.references, infile.lengths)]
+	header = pysam.AlignmentHeader.from_dict({'HD':{'VN':'1.0', 'SO':'unsorted'}, 'SQ':references})
+	outfile = pysam.AlignmentFile(outpath, 'wb', header=header)
+	stats = {'aligned':0, 'tied':0}
+	for groups in zip(*[read_groups(infile) for infile in infiles]):
+		scores = [score(group) for group in groups]
+		best = max(scores)
+		if best[0] == 0: # unaligned in all shards
+			continue
+		tied = [i for i, value in enumerate(scores) if value == best]
+		index = tied[zlib.crc32(groups[0][0].query_name.encode('ascii')) % len(tied)]
+		stats['aligned'] += 1
+		stats['tied'] += int(len(tied) > 1)
+		for aln in groups[index]:
+			if len(tied) > 1 and not aln.is_unmapped: aln.mapping_quality = 0
+			# reference names are unique across shards, so records move to the merged header by name (pysam
+			# checks reference ids against the header of the shard)
+			outfile.write(pysam.AlignedSegment.fromstring(aln.to_string(), header))
+	outfile.close()
+	for infile in infiles:
+		infile.close()
+	return stats
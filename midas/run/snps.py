@@ -4,10 +4,11 @@
 # Copyright (C) 2015 Stephen Nayfach
 # Freely distributed under the GNU General Public License (GPLv3)
 
-import sys, os, subprocess, shutil, csv
+import sys, os, subprocess, shutil, csv, zlib, itertools
 import Bio.SeqIO, pysam, numpy as np
 from time import time
-from midas import utility
+from midas import utility, snp_counts
+from midas.run import shards
 
 class Species:
 	""" Base class for species """
@@ -72,20 +73,33 @@ def build_genome_db(args, species):
 	# fasta database
 	outfile = open('/'.join([args['outdir'], 'snps/temp/genomes.fa']), 'w')
 	db_stats = {'total_length':0, 'total_seqs':0, 'species':0}
+	ranges, sizes, offset = {}, {}, 0 # byte range and length of each species in fasta
 	for sp in species.values():
 		db_stats['species'] += 1
+		start, sizes[sp.id] = offset, 0
 		infile = utility.iopen(sp.paths['fna'])
 		for r in Bio.SeqIO.parse(infile, 'fasta'):
-			outfile.write('>%s\n%s\n' % (r.id, str(r.seq).upper()))
+			record = '>%s\n%s\n' % (r.id, str(r.seq).upper())
+			outfile.write(record)
+			offset += len(record)
+			sizes[sp.id] += len(r.seq)
 			db_stats['total_length'] += len(r.seq)
 			db_stats['total_seqs'] += 1
 		infile.close()
+		ranges[sp.id] = (start, offset)
 	outfile.close()
 	# print out database stats
 	print("  total genomes: %s" % db_stats['species'])
 	print("  total contigs: %s" % db_stats['total_seqs'])
 	print("  total base-pairs: %s" % db_stats['total_length'])
-	# bowtie2 database
+	# fasta database only needed to decode input CRAM, or with prebuilt bowtie2 database
+	if args['input_bam'] or args['db_index']:
+		return
+	# bowtie2 database, optionally split into shards
+	tempdir = '/'.join([args['outdir'], 'snps/temp'])
+	if int(args['shards']) > 1:
+		shards.build_shards(args, tempdir, '/'.join([tempdir, 'genomes.fa']), ranges, sizes)
+		return
 	command = '%s ' % args['bowtie2-build']
 	command += '--threads %s ' % args['threads']
 	command += '%s/snps/temp/genomes.fa ' % args['outdir']
@@ -94,28 +108,42 @@ def build_genome_db(args, species):
 	process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 	utility.check_exit_code(process, command)
 
-def genome_align(args):
+def db_index_prefixes(args, species):
+	""" Prefixes of partitions of prebuilt bowtie2 database (build_midas_db.py --genome_index) with selected species """
+	path = '%s/genome_index/partitions.txt' % args['db']
+	if not os.path.isfile(path):
+		sys.exit("\nError: Could not locate prebuilt bowtie2 database: %s\nTry running build_midas_db.py with --genome_index\n" % path)
+	partitions = dict([(r['species_id'], r['partition']) for r in utility.parse_file(path)])
+	missing = [species_id for species_id in species if species_id not in partitions]
+	if len(missing) > 0:
+		sys.exit("\nError: %s selected species not found in prebuilt bowtie2 database, e.g.: %s\n" % (len(missing), ', '.join(missing[:3])))
+	return ['%s/genome_index/part.%s' % (args['db'], p) for p in sorted(set([partitions[_] for _ in species]), key=int)]
+
+def index_prefixes(args, species):
+	""" Prefixes of bowtie2 databases that reads are aligned to """
+	if args['db_index']:
+		return db_index_prefixes(args, species)
+	elif int(args['shards']) > 1:
+		return shards.read_shards('%s/snps/temp' % args['outdir'])
+	else:
+		return ['%s/snps/temp/genomes' % args['outdir']]
+
+def genome_align(args, species):
 	""" Use Bowtie2 to map reads to representative genomes """
 	# Bowtie2
 	bam_path = os.path.join(args['outdir'], 'snps/temp/genomes.bam')
-	command = '%s --no-unal ' % args['bowtie2']
-	command += '-x %s ' % '/'.join([args['outdir'], 'snps/temp/genomes']) # index
-	if args['max_reads']: command += '-u %s ' % args['max_reads'] # max num of reads
-	if args['trim']: command += '--trim3 %s ' % args['trim'] # trim 3'
-	command += '--%s' % args['speed'] # alignment speed
-	command += '-local ' if args['mode'] == 'local' else ' ' # global/local alignment
-	command += '--threads %s ' % args['threads'] 
-	command += '-f ' if args['file_type'] == 'fasta' else '-q ' # input type
-	if args['m2']: # -1 and -2 contain paired reads
-		command += '-1 %s -2 %s ' % (args['m1'], args['m2']) 
-	elif args['interleaved']: # -1 contains paired reads
-		command += '--interleaved %s ' % args['m1'] 
-	else: # -1 contains unpaired reads
-		command += '-U %s ' % args['m1'] 
-	# Pipe to samtools
-	command += '| %s view -b - ' % args['samtools'] # convert to bam
-	command += '--threads %s ' % args['threads']
-	command += '| %s sort - ' % args['samtools']
+	prefixes = index_prefixes(args, species)
+	if len(prefixes) > 1:
+		# merge best alignments across index shards, then sort
+		unsorted_path = os.path.join(args['outdir'], 'snps/temp/genomes.unsorted.bam')
+		shards.align_shards(args, prefixes, os.path.join(args['outdir'], 'snps/temp'), unsorted_path)
+		command = '%s sort %s ' % (args['samtools'], unsorted_path)
+	else:
+		command = utility.bowtie2_command(args, prefixes[0], args['threads'])
+		# Pipe to samtools
+		command += '| %s view -b - ' % args['samtools'] # convert to bam
+		command += '--threads %s ' % args['threads']
+		command += '| %s sort - ' % args['samtools']
 	command += '--threads %s ' % args['threads']
 	command += '-o %s ' % bam_path
 	# Run command
@@ -123,10 +151,54 @@ def genome_align(args):
 	process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 	# Check for errors
 	utility.check_exit_code(process, command)
+	if len(prefixes) > 1:
+		os.remove(unsorted_path)
 	print("  finished aligning")
 	print("  checking bamfile integrity")
 	utility.check_bamfile(args, bam_path)
 
+def bam_path(args):
+	""" Path to sorted alignments: user-supplied BAM/CRAM or output of genome_align """
+	if args['input_bam'] and args['input_sorted']:
+		return args['input_bam']
+	else:
+		return '%s/snps/temp/genomes.bam' % args['outdir']
+
+def bam_reference(args):
+	""" Path to FASTA used to decode CRAM input """
+	path = '%s/snps/temp/genomes.fa' % args['outdir']
+	return path if os.path.isfile(path) else None
+
+def prepare_input_bam(args, contigs):
+	""" Check user-supplied BAM/CRAM; sort unsorted input and locate or build index for sorted input """
+	start = time()
+	print("\nPreparing input alignments")
+	args['log'].write("\nPreparing input alignments\n")
+	references = dict([(contig.id, contig.length) for contig in contigs.values()])
+	utility.check_bam_references(args['input_bam'], references, bam_reference(args))
+	args['input_sorted'] = utility.is_sorted_bam(args['input_bam'])
+	if args['input_sorted']:
+		print("  input is coordinate-sorted: fetching selected contigs by region")
+		args['bam_index'] = utility.find_bam_index(args['input_bam'])
+		if args['bam_index'] is None:
+			args['bam_index'] = '%s/snps/temp/input.%s' % (args['outdir'], 'crai' if utility.is_cram(args['input_bam']) else 'bai')
+			command = '%s index %s %s' % (args['samtools'], args['input_bam'], args['bam_index'])
+			args['log'].write('command: '+command+'\n')
+			process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+			utility.check_exit_code(process, command)
+	else:
+		print("  input is not coordinate-sorted: sorting alignments")
+		command = '%s sort ' % args['samtools']
+		if bam_reference(args): command += '--reference %s ' % bam_reference(args)
+		command += '--threads %s ' % args['threads']
+		command += '-o %s %s' % (bam_path(args), args['input_bam'])
+		args['log'].write('command: '+command+'\n')
+		process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		utility.check_exit_code(process, command)
+		index_bam(args)
+	print("  %s minutes" % round((time() - start)/60, 2) )
+	print("  %s Gb maximum memory" % utility.max_mem_usage())
+
 def index_bam(args):
 	start = time()
 	print("\nIndexing bamfile")
@@ -139,8 +211,12 @@ def index_bam(args):
 	print("  %s Gb maximum memory" % utility.max_mem_usage())
 
 def keep_read(aln):
-	global aln_stats, global_args
-	aln_stats['aligned_reads'] += 1
+	global aln_stats, global_args, window_start
+	if global_args['input_bam'] and not utility.is_primary(aln):
+		return False
+	# reads overlapping several windows are only counted in the first window they overlap
+	counted = aln.reference_start >= window_start
+	if counted: aln_stats['aligned_reads'] += 1
 	# align and query length
 	align_len = len(aln.query_alignment_sequence)
 	query_len = aln.query_length
@@ -158,96 +234,656 @@ def keep_read(aln):
 		return False
 	# read passes all filters
 	else:
-		aln_stats['mapped_reads'] += 1
+		if counted: aln_stats['mapped_reads'] += 1
 		return True
-	
-def species_pileup(args, species_id, contigs):
-	
+
+def write_pileup(out_file, contig, depth, counts, sparse, offset=0, sites=None, chunk_size=100000):
+	""" Write one row per position (or per covered position if sparse) of contig window starting at offset
+		sites: optional positions within window to write; other positions are skipped
+		out_file: snp_counts.TextCountWriter; each chunk of rows is an indexed gzip member
+	"""
+	row = contig.id + '\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n'
+	positions = np.arange(len(depth)) if sites is None else sites
+	if sparse: positions = positions[depth[positions] > 0]
+	columns = np.vstack([positions+offset+1, depth[positions], counts[:, positions]])
+	alleles = np.frombuffer(contig.seq[offset:offset+len(depth)].encode('ascii'), dtype='S1')[positions]
+	for start in range(0, len(positions), chunk_size):
+		end = min(start+chunk_size, len(positions))
+		chunk = [columns[0, start:end].tolist(), alleles[start:end].astype('U1').tolist()]
+		chunk += [column.tolist() for column in columns[1:, start:end]]
+		out_file.write((row * (end-start)) % tuple([value for values in zip(*chunk) for value in values]), contig.id, chunk[0][0])
+
+def site_intervals(sites, max_gap=1000):
+	""" Merge sorted site positions of each contig into intervals; nearby sites share an interval so reads are fetched once """
+	intervals = {}
+	for contig_id, positions in sites.items():
+		if len(positions) == 0: continue
+		breaks = np.flatnonzero(np.diff(positions) > max_gap)
+		starts = np.concatenate([[positions[0]], positions[breaks+1]])
+		ends = np.concatenate([positions[breaks], [positions[-1]]]) + 1
+		intervals[contig_id] = list(zip(starts.tolist(), ends.tolist()))
+	return intervals
+
+def pileup_tasks(args, species, contigs, intervals=None):
+	""" Split contigs (or intervals of contigs) of all species into tasks of similar cost
+		each task is a run of consecutive windows of one species
+	"""
+	# estimated cost of contig: 1 per base-pair + READ_COST per mapped read (from BAM index, if available)
+	READ_COST = 20
+	reads = {}
+	with utility.open_bam(bam_path(args), index=args['bam_index'], reference=bam_reference(args)) as bamfile:
+		if bamfile.has_index():
+			for stat in bamfile.get_index_statistics():
+				reads[stat.contig] = stat.mapped
+	if intervals is None:
+		intervals = dict([(c.id, [(0, c.length)]) for c in contigs.values()])
+	costs = dict([(c.id, c.length + READ_COST*reads.get(c.id, 0)) for c in contigs.values() if c.species_id in species])
+	total = sum([costs[id]*(end-start)/float(max(1, contigs[id].length)) for id in intervals if id in costs for start, end in intervals[id]])
+	target = max(100000, int(total)//(4*int(args['threads'])))
+	tasks = []
+	for species_id in sorted(species):
+		task, task_cost = [], 0
+		for contig_id in sorted([c.id for c in contigs.values() if c.species_id == species_id and c.id in intervals]):
+			cost_per_bp = costs[contig_id]/float(max(1, contigs[contig_id].length))
+			for start, stop in intervals[contig_id]:
+				while start < stop:
+					size = int((target - task_cost)/cost_per_bp) + 1
+					end = min(stop, start+size)
+					task.append((contig_id, start, end))
+					task_cost += (end-start)*cost_per_bp
+					start = end
+					if task_cost >= target:
+						tasks.append((species_id, task))
+						task, task_cost = [], 0
+		if len(task) > 0:
+			tasks.append((species_id, task))
+	return tasks
+
+def pileup_windows(windows, contigs, sites, last_end):
+	""" Arguments for task_pileup from windows of pileup_tasks: (contig, start, end, count_from, sites)
+		last_end: end of previous window of each contig; updated as windows are visited in order
+	"""
+	task_windows = []
+	for contig_id, start, end in windows:
+		# reads are counted in stats once: in the first window they overlap
+		count_from = last_end.get(contig_id, 0)
+		last_end[contig_id] = end
+		positions = None
+		if sites is not None:
+			positions = sites[contig_id]
+			positions = positions[np.searchsorted(positions, start):np.searchsorted(positions, end)] - start
+		task_windows.append((contigs[contig_id], start, end, count_from, positions))
+	return task_windows
+
+def task_path(args, species_id, task_num):
+	""" Temporary output of pileup task """
+	ext = 'npy' if args['binary'] else 'gz'
+	return '%s/snps/temp/pileup/%s.%s.%s' % (args['outdir'], species_id, task_num, ext)
+
+DEPTH_CAP_SEED = 20150101
+MAX_MATE_DISTANCE = 10000
+
+PAIR_FIELDS = ['flag', 'start', 'end', 'next_reference_id', 'next_start']
+
+def pair_arrays(alns, reference_id):
+	""" Fields of a batch of alignments on one reference needed to select read pairs (PAIR_FIELDS, and pair start)
+		end is -1 for alignments without CIGAR; leftmost start of read and mate, if the mate is mapped to the same
+		contig within MAX_MATE_DISTANCE
+	"""
+	values = []
+	for aln in alns:
+		end = aln.reference_end
+		values.extend((aln.flag, aln.reference_start, -1 if end is None else end, aln.next_reference_id, aln.next_reference_start))
+	reads = dict(zip(PAIR_FIELDS, np.array(values, dtype=np.int64).reshape(-1, len(PAIR_FIELDS)).T))
+	paired = ((reads['flag'] & 0x1) != 0) & ((reads['flag'] & 0x8) == 0) & (reads['next_reference_id'] == reference_id)
+	paired &= np.abs(reads['next_start'] - reads['start']) <= MAX_MATE_DISTANCE
+	reads['pair_start'] = np.where(paired, np.minimum(reads['start'], reads['next_start']), reads['start'])
+	return reads
+
+def depth_at(bamfile, contig_id, position):
+	""" Number of mapped alignments covering position; does not disturb other iterators over bamfile """
+	return sum([1 for aln in bamfile.fetch(contig_id, position, position+1, multiple_iterators=True)
+		if not aln.is_unmapped and aln.reference_end is not None and aln.reference_start <= position < aln.reference_end])
+
+def capped_counts(args, bamfile, contig, start, end, window_start):
+	""" Count alleles in window from a seeded random subset of reads with expected depth of about max_depth
+		each read pair is kept with probability max_depth / depth at the start of its leftmost mate, decided by a hash of
+		the read name, so mates are kept or skipped together; selection does not depend on how contigs are split into windows
+		depth counts all mapped alignments; aligned_reads counts reads whether they are kept or not, as without a cap
+		reads are selected in batches of STREAM_BATCH, and only kept reads are filtered and counted (see read_arrays);
+		alignments starting up to MAX_MATE_DISTANCE before the window are only used for depth. As alignments are
+		sorted, depth at a pair start is complete once a later start was read
+		returns counts and stats (aligned_reads, mapped_reads)
+	"""
+	counts = np.zeros(4*(end-start), dtype=np.int64)
+	stats = {'aligned_reads':0, 'mapped_reads':0}
+	cap = int(args['max_depth'])
+	first = max(0, start - MAX_MATE_DISTANCE)
+	alns = iter(bamfile.fetch(contig.id, first, end))
+	reference_id = bamfile.get_tid(contig.id)
+	starts, ends = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+	held, outside = [], {}
+	while True:
+		batch = list(itertools.islice(alns, STREAM_BATCH))
+		if len(held) + len(batch) == 0:
+			break
+		alns_batch = held + batch
+		reads = pair_arrays(alns_batch, reference_id)
+		mapped = ((reads['flag'] & 0x4) == 0) & (reads['end'] >= 0)
+		new = np.arange(len(alns_batch)) >= len(held)
+		starts = np.concatenate([starts, reads['start'][new & mapped]])
+		ends = np.sort(np.concatenate([ends, reads['end'][new & mapped]]))
+		# reads in window; later alignments may still cover pair starts at the last start read
+		positions = reads['pair_start']
+		ready = mapped & (reads['end'] > start)
+		if len(batch) == STREAM_BATCH:
+			ready &= positions < reads['start'][-1]
+		held = [alns_batch[i] for i in np.flatnonzero(mapped & (reads['end'] > start) & ~ready)]
+		depth = np.searchsorted(starts, positions, 'right') - np.searchsorted(ends, positions, 'right')
+		for i in np.flatnonzero(ready & (positions < first)): # pair starts before alignments read for depth
+			if positions[i] not in outside:
+				outside[positions[i]] = depth_at(bamfile, contig.id, int(positions[i]))
+			depth[i] = outside[positions[i]]
+		selected = ready & (depth <= cap)
+		capped = np.flatnonzero(ready & (depth > cap))
+		hashes = np.array([zlib.crc32(alns_batch[i].query_name.encode('ascii'), DEPTH_CAP_SEED) for i in capped], dtype=np.float64)
+		selected[capped] = hashes/4294967296.0 < cap/depth[capped].astype(float)
+		# reads overlapping several windows are only counted in the first window they overlap
+		stats['aligned_reads'] += int((ready & is_aligned(args, reads['flag']) & (reads['start'] >= window_start)).sum())
+		reads = read_arrays([alns_batch[i] for i in np.flatnonzero(selected)])
+		aligned, keep = filter_reads(args, reads)
+		stats['mapped_reads'] += int((keep & (reads['start'] >= window_start)).sum())
+		read, reference, bases = aligned_bases(args, reads, keep)
+		inside = (reference >= start) & (reference < end)
+		counts += np.bincount(bases[inside].astype(np.int64)*(end-start) + reference[inside] - start, minlength=len(counts))
+		if len(batch) < STREAM_BATCH:
+			break
+	return counts.reshape(4, end-start), stats
+
+def task_pileup(args, species_id, task_num, windows):
+	""" Count alleles in consecutive windows of one species; write text rows or counts array to temp file
+		windows: list of (contig, start, end, count_from, sites); reads starting at or after count_from are counted
+		in alignment stats; sites (positions within window) restrict output to known sites, or None
+	"""
 	# Set global variables for read filtering
-	global global_args # need global for keep_read function
+	global global_args, aln_stats, window_start # need global for keep_read function
 	global_args = args
-
-	# summary stats
-	global aln_stats
 	aln_stats = {'genome_length':0,
 				 'total_depth':0,
 				 'covered_bases':0,
 				 'aligned_reads':0,
 				 'mapped_reads':0}
 	
-	# open outfiles
-	out_path = '%s/snps/output/%s.snps.gz' % (args['outdir'], species_id)
-	out_file = utility.iopen(out_path, 'w')
-	header = ['ref_id', 'ref_pos', 'ref_allele', 'depth', 'count_a', 'count_c', 'count_g', 'count_t']
-	out_file.write('\t'.join(header)+'\n')
-	
 	# compute coverage
-	bampath = '%s/snps/temp/genomes.bam' % args['outdir']
-	with pysam.AlignmentFile(bampath, 'rb') as bamfile:
-		for contig_id in sorted(list(contigs.keys())):
-		
-			contig = contigs[contig_id]
-		
-			if contig.species_id != species_id: 
-				continue
-						
-			counts = bamfile.count_coverage(
-				contig.id, 
-				start=0, 
-				end=contig.length, 
-				quality_threshold=args['baseq'], 
-				read_callback=keep_read)
-				
-			for i in range(0, contig.length):
-				ref_pos = i+1
-				ref_allele = contig.seq[i]
-				depth = sum([counts[_][i] for _ in range(4)])
-				count_a = counts[0][i]
-				count_c = counts[1][i]
-				count_g = counts[2][i]
-				count_t = counts[3][i]
-				row = [contig.id, ref_pos, ref_allele, depth, count_a, count_c, count_g, count_t]
-				out_file.write('\t'.join([str(_) for _ in row])+'\n')
-				aln_stats['genome_length'] += 1
-				aln_stats['total_depth'] += depth
-				if depth > 0: aln_stats['covered_bases'] += 1
-		
-	out_file.close()
+	results = []
+	out_path = task_path(args, species_id, task_num)
+	out_file = None if args['binary'] else snp_counts.TextCountWriter(out_path)
+	with utility.open_bam(bam_path(args), index=args['bam_index'], reference=bam_reference(args)) as bamfile:
+		for contig, start, end, window_start, sites in windows:
+			if args['max_depth']:
+				counts, stats = capped_counts(args, bamfile, contig, start, end, window_start)
+				for key in stats:
+					aln_stats[key] += stats[key]
+			else:
+				counts = np.array(bamfile.count_coverage(
+					contig.id, 
+					start=start, 
+					stop=end, 
+					quality_threshold=args['baseq'], 
+					read_callback=keep_read), dtype=np.int64)
+			depth = counts.sum(axis=0)
+			if sites is not None:
+				mask = np.zeros(end-start, dtype=bool)
+				mask[sites] = True
+				counts[:, ~mask] = 0
+				depth[~mask] = 0
+			if args['binary']:
+				results.append(counts.astype(np.uint32))
+			else:
+				write_pileup(out_file, contig, depth, counts, args['sparse'], start, sites)
+			aln_stats['genome_length'] += end - start if sites is None else len(sites)
+			aln_stats['total_depth'] += int(depth.sum())
+			aln_stats['covered_bases'] += int((depth > 0).sum())
+	if args['binary']:
+		np.save(out_path, np.hstack(results) if results else np.zeros((4, 0), dtype=np.uint32))
+	else:
+		out_file.close()
 	return (species_id, aln_stats)
-				
-	
-def pysam_pileup(args, species, contigs):
+
+def remove_outputs(args, species_id):
+	""" Remove output of a previous run, which may be in the other format """
+	for ext in ['snps.gz', 'snps.gz.idx', 'snps.bin']:
+		path = '%s/snps/output/%s.%s' % (args['outdir'], species_id, ext)
+		if os.path.isfile(path): os.remove(path)
+
+def stitch_pileups(args, species_id, tasks, contigs):
+	""" Concatenate temporary outputs of pileup tasks in sorted contig order """
+	remove_outputs(args, species_id)
+	if args['binary']:
+		out_file = snp_counts.BinaryCountWriter('%s/snps/output/%s.snps.bin' % (args['outdir'], species_id))
+		# windows cover whole contigs, or only intervals with known sites (zeros elsewhere)
+		contig_id, contig_counts = None, None
+		for task_num, windows in tasks:
+			counts = np.load(task_path(args, species_id, task_num))
+			for window_id, start, end in windows:
+				if window_id != contig_id:
+					if contig_id is not None:
+						out_file.write_contig(contig_id, contig_counts)
+					contig_id = window_id
+					contig_counts = np.zeros((4, contigs[contig_id].length), dtype=np.uint32)
+				contig_counts[:, start:end] = counts[:, :end-start]
+				counts = counts[:, end-start:]
+			os.remove(task_path(args, species_id, task_num))
+		if contig_id is not None:
+			out_file.write_contig(contig_id, contig_counts)
+		out_file.close()
+	else:
+		# concatenated gzip members are a valid gzip file; member offsets of tasks are shifted into the output index
+		out_file = snp_counts.TextCountWriter('%s/snps/output/%s.snps.gz' % (args['outdir'], species_id))
+		snp_counts.write_header(out_file, output_layout(args))
+		for task_num, windows in tasks:
+			out_file.append(task_path(args, species_id, task_num))
+			os.remove(task_path(args, species_id, task_num))
+			os.remove(snp_counts.index_path(task_path(args, species_id, task_num)))
+		out_file.close()
+
+def pysam_pileup(args, species, contigs, sites=None):
 	start = time()
 	print("\nCounting alleles")
 	args['log'].write("\nCounting alleles\n")
+	
+	# split genomes (or intervals with known sites) into windows of similar cost and run pileups in parallel
+	tasks = pileup_tasks(args, species, contigs, None if sites is None else site_intervals(sites))
+	print("  %s tasks across %s species" % (len(tasks), len(species)))
+	tempdir = '%s/snps/temp/pileup' % args['outdir']
+	if not os.path.isdir(tempdir): os.makedirs(tempdir)
+	argument_list, last_end = [], {}
+	for task_num, task in enumerate(tasks):
+		species_id, windows = task
+		argument_list.append([args, species_id, task_num, pileup_windows(windows, contigs, sites, last_end)])
+	
+	# stitch and commit outputs of each species as soon as all of its tasks are done
+	remaining = dict([(species_id, 0) for species_id in species])
+	totals = dict([(species_id, dict([(k, 0) for k in STATS])) for species_id in species])
+	for species_id, task in tasks:
+		remaining[species_id] += 1
+	def commit(species_id):
+		species_tasks = [(task_num, task[1]) for task_num, task in enumerate(tasks) if task[0] == species_id]
+		stitch_pileups(args, species_id, species_tasks, contigs)
+		update_species_stats(species[species_id], totals[species_id])
+		commit_species(args, species[species_id])
+	for species_id in [_ for _ in species if remaining[_] == 0]: # no known sites
+		commit(species_id)
+	for species_id, stats in utility.parallel_ordered(task_pileup, argument_list, args['threads']):
+		for key in STATS:
+			totals[species_id][key] += stats[key]
+		remaining[species_id] -= 1
+		if remaining[species_id] == 0:
+			commit(species_id)
+		
+	print("  %s minutes" % round((time() - start)/60, 2) )
+	print("  %s Gb maximum memory" % utility.max_mem_usage())
+
+READ_FIELDS = ['flag', 'reference_id', 'start', 'mapq', 'nm', 'align_len', 'query_len']
 
-	# run pileups per species in parallel
-	argument_list = []
+def read_arrays(alns):
+	""" Collect a batch of alignments into arrays for filter_reads and aligned_bases
+		per read: READ_FIELDS, offset in the concatenated bases and quals, sum of base qualities, number of CIGAR operations
+		per CIGAR operation: ops and op_lengths
+	"""
+	values, cigars, num_ops, seqs, quals = [], [], [], [], []
+	for aln in alns:
+		cigar = aln.cigartuples or []
+		values.extend((aln.flag, aln.reference_id, aln.reference_start, aln.mapping_quality,
+			0 if aln.is_unmapped else aln.get_tag('NM'), aln.query_alignment_length, aln.query_length))
+		for op in cigar:
+			cigars.extend(op)
+		num_ops.append(len(cigar))
+		seqs.append(aln.query_sequence or '')
+		qualities = aln.query_qualities
+		quals.append(qualities.tobytes() if qualities is not None else b'\0'*aln.query_length)
+	reads = dict(zip(READ_FIELDS, np.array(values, dtype=np.int64).reshape(-1, len(READ_FIELDS)).T))
+	reads['offset'] = np.cumsum(reads['query_len']) - reads['query_len']
+	# trailing 0 keeps offsets of reads without sequence within bounds
+	reads['quals'] = np.frombuffer(b''.join(quals + [b'\0']), dtype=np.uint8)
+	reads['qual_sum'] = np.add.reduceat(reads['quals'], reads['offset'], dtype=np.int64)
+	reads['bases'] = np.frombuffer(''.join(seqs).encode('ascii'), dtype=np.uint8)
+	reads['num_ops'] = np.array(num_ops, dtype=np.int64)
+	cigars = np.array(cigars, dtype=np.int64).reshape(-1, 2)
+	reads['ops'], reads['op_lengths'] = cigars[:, 0], cigars[:, 1]
+	return reads
+
+def is_aligned(args, flags):
+	""" Mask of reads counted in aligned_reads: mapped, and primary alignments if reads were aligned by another program """
+	aligned = (flags & 0x4) == 0
+	if args['input_bam']:
+		aligned &= (flags & 0x900) == 0 # not secondary or supplementary
+	return aligned
+
+def filter_reads(args, reads):
+	""" keep_read over a batch of reads from read_arrays: masks of aligned reads (counted in aligned_reads) and of reads passing filters """
+	aligned = is_aligned(args, reads['flag'])
+	align_len, query_len = reads['align_len'], reads['query_len'].astype(float)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		keep = aligned & (query_len > 0)
+		keep &= 100*(align_len-reads['nm'])/align_len.astype(float) >= args['mapid']
+		keep &= reads['qual_sum']/query_len >= args['readq']
+		keep &= reads['mapq'] >= args['mapq']
+		keep &= align_len/query_len >= args['aln_cov']
+	return aligned, keep
+
+def aligned_bases(args, reads, keep):
+	""" Aligned A/C/G/T bases with quality >= baseq of reads in keep: read index, reference position and base (0-3: ACGT) """
+	base_index = np.full(256, 4, dtype=np.int8)
+	for i, base in enumerate('ACGT'):
+		base_index[ord(base)] = i
+	# positions of CIGAR operations within their read and on the reference
+	ops, lengths, num_ops = reads['ops'], reads['op_lengths'], reads['num_ops']
+	read = np.repeat(np.arange(len(num_ops)), num_ops)
+	first_op = np.cumsum(num_ops) - num_ops
+	qpos = np.concatenate([[0], np.cumsum(lengths*np.isin(ops, [0, 1, 4, 7, 8]))]) # M, I, S, =, X
+	rpos = np.concatenate([[0], np.cumsum(lengths*np.isin(ops, [0, 2, 3, 7, 8]))]) # M, D, N, =, X
+	qpos = qpos[:-1] - qpos[first_op[read]]
+	rpos = rpos[:-1] - rpos[first_op[read]]
+	# aligned blocks of kept reads, expanded to bases
+	block = np.isin(ops, [0, 7, 8]) & keep[read] # M, =, X
+	read, lengths = read[block], lengths[block]
+	within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+	reference = np.repeat(reads['start'][read] + rpos[block], lengths) + within
+	query = np.repeat(reads['offset'][read] + qpos[block], lengths) + within
+	bases = base_index[reads['bases'][query]]
+	mask = (reads['quals'][query] >= args['baseq']) & (bases < 4)
+	return np.repeat(read, lengths)[mask], reference[mask], bases[mask]
+
+def task_coverage(args, species_id, task_num, windows):
+	""" Depth pass over consecutive windows of one species: coverage stats of reads passing filters, without allele counts
+		depth counts aligned A/C/G/T bases with quality >= baseq, as in task_pileup; the reads of a window are
+		filtered and expanded to bases with array operations
+	"""
+	aln_stats = dict([(key, 0) for key in STATS])
+	with utility.open_bam(bam_path(args), index=args['bam_index'], reference=bam_reference(args)) as bamfile:
+		for contig, start, end, window_start, sites in windows:
+			reads = read_arrays(bamfile.fetch(contig.id, start, end))
+			aligned, keep = filter_reads(args, reads)
+			# reads overlapping several windows are only counted in the first window they overlap
+			counted = aligned & (reads['start'] >= window_start)
+			aln_stats['aligned_reads'] += int(counted.sum())
+			aln_stats['mapped_reads'] += int((counted & keep).sum())
+			read, reference, bases = aligned_bases(args, reads, keep)
+			reference = reference[(reference >= start) & (reference < end)]
+			depth = np.bincount(reference - start, minlength=end-start)
+			if sites is not None:
+				depth = depth[sites]
+			aln_stats['genome_length'] += len(depth)
+			aln_stats['total_depth'] += int(depth.sum())
+			aln_stats['covered_bases'] += int((depth > 0).sum())
+	return (species_id, aln_stats)
+
+def coverage_pass(args, species, contigs, sites=None):
+	""" Compute coverage stats of species without counting alleles (--coverage_only) """
+	start = time()
+	print("\nComputing genome coverage")
+	args['log'].write("\nComputing genome coverage\n")
+	tasks = pileup_tasks(args, species, contigs, None if sites is None else site_intervals(sites))
+	print("  %s tasks across %s species" % (len(tasks), len(species)))
+	argument_list, last_end = [], {}
+	for task_num, task in enumerate(tasks):
+		species_id, windows = task
+		argument_list.append([args, species_id, task_num, pileup_windows(windows, contigs, sites, last_end)])
+	totals = dict([(species_id, dict([(k, 0) for k in STATS])) for species_id in species])
+	for species_id, stats in utility.parallel(task_coverage, argument_list, args['threads']):
+		for key in STATS:
+			totals[species_id][key] += stats[key]
 	for species_id in species:
-		argument_list.append([args, species_id, contigs])
-	aln_stats = utility.parallel(species_pileup, argument_list, args['threads'])
+		update_species_stats(species[species_id], totals[species_id])
+	print("  %s minutes" % round((time() - start)/60, 2) )
+	print("  %s Gb maximum memory" % utility.max_mem_usage())
+
+STREAM_BATCH = 100000
+
+def add_counts(counts, contig_id, bases, positions):
+	""" Add alleles to the uint16 counts of a contig, promoted to uint32 once a count would overflow """
+	contig_counts = counts[contig_id]
+	index = bases.astype(np.int64)*contig_counts.shape[1] + positions
+	lo, hi = index.min(), index.max()+1
+	if hi - lo <= len(index): # dense: count over the range of positions
+		added = np.bincount(index - lo, minlength=hi-lo)
+		keys = np.flatnonzero(added)
+		keys, added = keys + lo, added[keys]
+	else:
+		keys, added = np.unique(index, return_counts=True)
+	values = contig_counts.reshape(-1)[keys] + added
+	if contig_counts.dtype == np.uint16 and values.max() >= 2**16:
+		contig_counts = counts[contig_id] = contig_counts.astype(np.uint32)
+	contig_counts.reshape(-1)[keys] = values
+
+def stream_counts(args, bamfile, species, contigs):
+	""" Count alleles from alignments in any order, in batches of STREAM_BATCH reads
+		return per-contig count arrays (uint16, or uint32 where needed) and per-species read stats
+	"""
+	species_ids = sorted(species)
+	stats = dict([(species_id, {'aligned_reads':0, 'mapped_reads':0}) for species_id in species_ids])
+	counts = dict([(contig.id, np.zeros((4, contig.length), dtype=np.uint16)) for contig in contigs.values()])
+	references = [contigs.get(name) for name in bamfile.references]
+	# species index of each reference; -1 for references of other species and for unmapped reads (reference_id -1)
+	reference_species = np.array([-1 if contig is None else species_ids.index(contig.species_id) for contig in references] + [-1])
+	alns = iter(bamfile.fetch(until_eof=True))
+	while True:
+		reads = read_arrays(itertools.islice(alns, STREAM_BATCH))
+		if len(reads['flag']) == 0:
+			break
+		read_species = reference_species[reads['reference_id']]
+		aligned, keep = filter_reads(args, reads)
+		aligned &= read_species >= 0
+		keep &= aligned
+		aligned = np.bincount(read_species[aligned], minlength=len(species_ids))
+		mapped = np.bincount(read_species[keep], minlength=len(species_ids))
+		for i, species_id in enumerate(species_ids):
+			stats[species_id]['aligned_reads'] += int(aligned[i])
+			stats[species_id]['mapped_reads'] += int(mapped[i])
+		read, positions, bases = aligned_bases(args, reads, keep)
+		reference_ids = reads['reference_id'][read]
+		order = np.argsort(reference_ids, kind='stable')
+		reference_ids, positions, bases = reference_ids[order], positions[order], bases[order]
+		ids, firsts = np.unique(reference_ids, return_index=True)
+		for reference_id, first, last in zip(ids, firsts, list(firsts[1:]) + [len(reference_ids)]):
+			add_counts(counts, references[reference_id].id, bases[first:last], positions[first:last])
+	return counts, stats
+
+def stream_memory(contigs):
+	""" Check that allele counts of all selected genomes (8 bytes per base-pair) fit in available memory """
+	needed = 8*sum([contig.length for contig in contigs.values()])
+	memory = utility.available_memory()
+	if memory is not None and needed > memory:
+		error = "\nError: --stream needs %s GB of memory for allele counts of %s bp of genomes," % (round(needed/1e9, 2), needed//8)
+		error += " but only %s GB are available" % round(memory/1e9, 2)
+		error += "\nRun without --stream, or select fewer species\n"
+		sys.exit(error)
+
+def write_species_counts(args, species_id, contigs, counts, sites=None):
+	""" Write allele counts of species from stream_counts, optionally at known sites only; return coverage stats """
+	stats = {'genome_length':0, 'total_depth':0, 'covered_bases':0}
+	remove_outputs(args, species_id)
+	if args['binary']:
+		out_file = snp_counts.BinaryCountWriter('%s/snps/output/%s.snps.bin' % (args['outdir'], species_id))
+	else:
+		out_file = snp_counts.TextCountWriter('%s/snps/output/%s.snps.gz' % (args['outdir'], species_id))
+		snp_counts.write_header(out_file, output_layout(args))
+	for contig_id in sorted([c.id for c in contigs.values() if c.species_id == species_id]):
+		contig_counts = counts[contig_id].astype(np.int64)
+		positions = None if sites is None else sites.get(contig_id, np.zeros(0, dtype=np.int64))
+		if positions is not None:
+			mask = np.zeros(contigs[contig_id].length, dtype=bool)
+			mask[positions] = True
+			contig_counts[:, ~mask] = 0
+		depth = contig_counts.sum(axis=0)
+		if args['binary']:
+			out_file.write_contig(contig_id, contig_counts)
+		else:
+			write_pileup(out_file, contigs[contig_id], depth, contig_counts, args['sparse'], 0, positions)
+		stats['genome_length'] += contigs[contig_id].length if positions is None else len(positions)
+		stats['total_depth'] += int(depth.sum())
+		stats['covered_bases'] += int((depth > 0).sum())
+	out_file.close()
+	return stats
+
+def stream_pileup(args, species, contigs, sites=None):
+	""" Count alleles without sorting or indexing: read the bowtie2 stream (with --align) or an unsorted BAM """
+	start = time()
+	print("\nCounting alleles from unsorted alignments")
+	args['log'].write("\nCounting alleles from unsorted alignments\n")
+	stream_memory(contigs)
+	process = None
+	prefixes = index_prefixes(args, species) if args['align'] else []
+	if args['align'] and len(prefixes) == 1:
+		args['file_type'] = utility.auto_detect_file_type(args['m1'])
+		command = utility.bowtie2_command(args, prefixes[0], args['threads'])
+		args['log'].write('command: '+command+'\n')
+		process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		bamfile = pysam.AlignmentFile(process.stdout, 'r')
+	elif args['align']:
+		args['file_type'] = utility.auto_detect_file_type(args['m1'])
+		shards.align_shards(args, prefixes, '/'.join([args['outdir'], 'snps/temp']), '%s/snps/temp/genomes.unsorted.bam' % args['outdir'])
+		bamfile = pysam.AlignmentFile('%s/snps/temp/genomes.unsorted.bam' % args['outdir'], 'rb')
+	else:
+		if args['input_bam']:
+			references = dict([(contig.id, contig.length) for contig in contigs.values()])
+			utility.check_bam_references(args['input_bam'], references, bam_reference(args))
+		path = args['input_bam'] if args['input_bam'] else '%s/snps/temp/genomes.bam' % args['outdir']
+		bamfile = utility.open_bam(path, reference=bam_reference(args))
+	# optionally keep alignments from the aligner; sorted once counting is done
+	keep_path = '%s/snps/temp/genomes.unsorted.bam' % args['outdir']
+	if process and args['keep_bam']:
+		bamfile = KeepAlignments(bamfile, keep_path)
+	counts, read_stats = stream_counts(args, bamfile, species, contigs)
+	bamfile.close()
+	if process:
+		utility.check_exit_code(process, command)
+	if args['align'] and (args['keep_bam'] or len(prefixes) > 1):
+		if args['keep_bam']:
+			command = '%s sort --threads %s -o %s/snps/temp/genomes.bam %s' % (args['samtools'], args['threads'], args['outdir'], keep_path)
+			args['log'].write('command: '+command+'\n')
+			process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+			utility.check_exit_code(process, command)
+		os.remove(keep_path)
+	
+	# write outputs and update alignment stats for species objects
+	for sp in species.values():
+		stats = write_species_counts(args, sp.id, contigs, counts, sites)
+		stats.update(read_stats[sp.id])
+		update_species_stats(sp, stats)
+		commit_species(args, sp)
 	
-	# update alignment stats for species objects
-	for species_id, stats in aln_stats:
-		sp = species[species_id]
-		sp.genome_length = stats['genome_length']
-		sp.covered_bases = stats['covered_bases']
-		sp.total_depth = stats['total_depth']
-		sp.aligned_reads = stats['aligned_reads']
-		sp.mapped_reads = stats['mapped_reads']
-		if sp.genome_length > 0:
-			sp.fraction_covered = sp.covered_bases/float(sp.genome_length) 	
-		if sp.covered_bases > 0:
-			sp.mean_coverage = sp.total_depth/float(sp.covered_bases) 
-		
 	print("  %s minutes" % round((time() - start)/60, 2) )
 	print("  %s Gb maximum memory" % utility.max_mem_usage())
-				
+
+class KeepAlignments:
+	""" Pass alignments through while writing them to an unsorted BAM """
+	def __init__(self, bamfile, path):
+		self.bamfile = bamfile
+		self.references = bamfile.references
+		self.outfile = pysam.AlignmentFile(path, 'wb', template=bamfile)
+
+	def fetch(self, until_eof=True):
+		for aln in self.bamfile.fetch(until_eof=True):
+			self.outfile.write(aln)
+			yield aln
+
+	def close(self):
+		self.outfile.close()
+		self.bamfile.close()
+
+STATS = ['genome_length', 'covered_bases', 'total_depth', 'aligned_reads', 'mapped_reads']
+PILEUP_PARAMS = ['db', 'db_index', 'mapid', 'mapq', 'baseq', 'readq', 'aln_cov', 'trim', 'sparse', 'binary', 'max_depth']
+
+def output_layout(args):
+	""" Layout of text output recorded in its format line """
+	if args['sites']:
+		return 'sites'
+	return 'sparse' if args['sparse'] else 'dense'
+
+def read_sites(path, contigs):
+	""" Read known sites: map contig id to sorted, unique 0-based positions
+		path: tab-delimited with header fields ref_id and ref_pos (1-based; e.g. snps_info.txt from merge_midas.py snps)
+		or BED intervals without header (ref_id, 0-based start, end); sites on contigs of other species are ignored
+	"""
+	sites, skipped, bed = {}, 0, None
+	for line in utility.iopen(path):
+		if line.startswith('#') or len(line.strip()) == 0:
+			continue
+		values = line.rstrip('\n').split('\t')
+		if bed is None:
+			bed = 'ref_id' not in values or 'ref_pos' not in values
+			if not bed:
+				id_col, pos_col = values.index('ref_id'), values.index('ref_pos')
+				continue
+		contig_id = values[0] if bed else values[id_col]
+		if contig_id not in contigs:
+			skipped += 1
+			continue
+		try:
+			start, end = (int(values[1]), int(values[2])) if bed else (int(values[pos_col])-1, int(values[pos_col]))
+		except (IndexError, ValueError):
+			sys.exit("\nError: Could not parse line in sites file %s:\n%s\n" % (path, line.rstrip('\n')))
+		if start < 0 or end > contigs[contig_id].length or start >= end:
+			sys.exit("\nError: Site outside of contig %s (length %s) in sites file %s:\n%s\n" % (contig_id, contigs[contig_id].length, path, line.rstrip('\n')))
+		sites.setdefault(contig_id, []).append(np.arange(start, end))
+	for contig_id in sites:
+		sites[contig_id] = np.unique(np.concatenate(sites[contig_id])).astype(np.int64)
+	print("  %s sites on %s contigs of selected species" % (sum([len(_) for _ in sites.values()]), len(sites)))
+	if skipped > 0:
+		print("  %s sites on other contigs ignored" % skipped)
+	return sites
+
+def update_species_stats(sp, stats):
+	""" Set alignment stats of species from pileup totals """
+	for key in STATS:
+		setattr(sp, key, int(stats[key]))
+	if sp.genome_length > 0:
+		sp.fraction_covered = sp.covered_bases/float(sp.genome_length)
+	if sp.covered_bases > 0:
+		sp.mean_coverage = sp.total_depth/float(sp.covered_bases)
+
+def pileup_input(args, species):
+	""" Identity of the input that pileups are computed from: the reads when this run aligns them, otherwise the alignments """
+	if args['align']:
+		return utility.reads_identity(args, species)
+	elif args['input_bam']:
+		return utility.file_identity([args['input_bam']])
+	else:
+		return utility.file_identity(['%s/snps/temp/genomes.bam' % args['outdir']])
+
+def manifest_values(args, species_id):
+	values = {'species_id':species_id, 'params':utility.format_params(args, PILEUP_PARAMS), 'input':args['pileup_input']}
+	if args['sites']:
+		values['sites'] = utility.file_identity([args['sites']])
+	return values
+
+def commit_species(args, sp):
+	""" Record completed pileup of species; written after its output file is in place """
+	values = manifest_values(args, sp.id)
+	for key in STATS:
+		values[key] = getattr(sp, key)
+	utility.write_manifest('%s/snps/output/%s.manifest' % (args['outdir'], sp.id), values)
+
+def pending_species(args, species):
+	""" Load stats of species completed by a previous run with the same parameters and input; return the others """
+	pending = {}
+	ext = 'snps.bin' if args['binary'] else 'snps.gz'
+	for sp in species.values():
+		manifest = utility.read_manifest('%s/snps/output/%s.manifest' % (args['outdir'], sp.id), manifest_values(args, sp.id))
+		if manifest and os.path.isfile('%s/snps/output/%s.%s' % (args['outdir'], sp.id, ext)):
+			update_species_stats(sp, manifest)
+		else:
+			pending[sp.id] = sp
+	return pending
 
 def snps_summary(args, species):
 	""" Get summary of mapping statistics """
 	
 	fields = ['species_id', 'genome_length', 'covered_bases', 'fraction_covered', 'mean_coverage', 'aligned_reads', 'mapped_reads']
+	# depth cap applied by the pileup, so that merge filters on depth can be interpreted
+	if args['max_depth']: fields.append('max_depth')
 	outfile = open(args['outdir'] + '/snps/summary.txt', 'w')
 	outfile.write('\t'.join(fields)+'\n')
 	
@@ -258,7 +894,9 @@ def snps_summary(args, species):
 		outfile.write(str(sp.fraction_covered)+'\t')
 		outfile.write(str(sp.mean_coverage)+'\t')
 		outfile.write(str(sp.aligned_reads)+'\t')
-		outfile.write(str(sp.mapped_reads)+'\n')
+		outfile.write(str(sp.mapped_reads))
+		if args['max_depth']: outfile.write('\t'+str(args['max_depth']))
+		outfile.write('\n')
 	outfile.close()
 
 def remove_tmp(args):
@@ -275,9 +913,21 @@ def run_pipeline(args):
 	contigs = initialize_contigs(species)
 	print("  %s minutes" % round((time() - start)/60, 2) )
 	print("  %s Gb maximum memory" % utility.max_mem_usage())
+
+	# Species completed by a previous run with the same parameters and input are skipped;
+	# reads are not realigned when no species is left to count
+	pileup = (args['call'] and not args['coverage_only']) or (args['stream'] and args['align'])
+	if pileup:
+		args['pileup_input'] = pileup_input(args, species)
+		pending = pending_species(args, species)
+		if len(pending) < len(species):
+			print("\nSkipping %s species completed by a previous run" % (len(species) - len(pending)))
+		if args['align'] and not pending:
+			args['build_db'] = args['align'] = False
 	
 	# Build genome database for selected species
-	if args['build_db']:
+	# with --input_bam, only the FASTA database is built to decode CRAM input
+	if args['build_db'] and (not args['input_bam'] or utility.is_cram(args['input_bam'])):
 		print("\nBuilding database of representative genomes")
 		args['log'].write("\nBuilding database of representative genomes\n")
 		start = time()
@@ -286,19 +936,48 @@ def run_pipeline(args):
 		print("  %s Gb maximum memory" % utility.max_mem_usage())
 
 	# Use bowtie2 to map reads to a representative genome for each species
-	if args['align']:
+	# with --stream, reads are aligned while counting alleles
+	if args['align'] and not args['stream']:
 		args['file_type'] = utility.auto_detect_file_type(args['m1'])
 		print("\nMapping reads to representative genomes")
 		args['log'].write("\nMapping reads to representative genomes\n")
 		start = time()
-		genome_align(args)
+		genome_align(args, species)
 		print("  %s minutes" % round((time() - start)/60, 2) )
 		print("  %s Gb maximum memory" % utility.max_mem_usage())
 
-	# Use mpileup to identify SNPs
-	if args['call']:
-		index_bam(args)
-		pysam_pileup(args, species, contigs)
+	# Only compute coverage stats for summary.txt; no allele counts are written
+	if args['call'] and args['coverage_only']:
+		args['input_sorted'] = False
+		args['bam_index'] = None
+		if args['input_bam']:
+			prepare_input_bam(args, contigs)
+		else:
+			index_bam(args)
+		sites = read_sites(args['sites'], contigs) if args['sites'] else None
+		coverage_pass(args, species, contigs, sites)
+		snps_summary(args, species)
+	
+	# Count alleles of pending species
+	elif pileup:
+		pending_contigs = dict([(id, c) for id, c in contigs.items() if c.species_id in pending])
+		# optionally count alleles at known sites only
+		sites = None
+		if pending and args['sites']:
+			print("\nReading known sites")
+			sites = read_sites(args['sites'], pending_contigs)
+		# directly from unsorted alignments
+		if pending and args['stream']:
+			stream_pileup(args, pending, pending_contigs, sites)
+		# from sorted, indexed alignments
+		elif pending:
+			args['input_sorted'] = False
+			args['bam_index'] = None
+			if args['input_bam']:
+				prepare_input_bam(args, pending_contigs)
+			else:
+				index_bam(args)
+			pysam_pileup(args, pending, pending_contigs, sites)
 		snps_summary(args, species)
 
 	# Optionally remove temporary files
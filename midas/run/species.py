@@ -165,7 +165,7 @@ def normalize_counts(species_alns, total_gene_length):
 def write_abundance(outdir, species_abundance, annotations):
 	""" Write species results to specified output file """
 	outpath = '%s/species/species_profile.txt' % outdir
-	outfile = open(outpath, 'w')
+	outfile = open(outpath+'.tmp', 'w')
 	fields = ['species_id', 'count_reads', 'coverage', 'relative_abundance']
 	outfile.write('\t'.join(fields)+'\n')
 	species_ids =  sorted([(x, y['count']) for x, y in species_abundance.items()], key=itemgetter(1), reverse=True)
@@ -173,6 +173,8 @@ def write_abundance(outdir, species_abundance, annotations):
 		values = species_abundance[species_id]
 		record = [species_id, values['count'], values['cov'], values['rel_abun']]
 		outfile.write('\t'.join([str(x) for x in record])+'\n')
+	outfile.close()
+	os.rename(outpath+'.tmp', outpath)
 
 def read_abundance(inpath):
 	""" Parse species abundance file """
@@ -226,9 +228,22 @@ def select_species(args):
 		sys.exit("\nError: no species sastisfied your selection criteria. \n")
 	return my_species
 
+PROFILE_PARAMS = ['db', 'word_size', 'mapid', 'aln_cov', 'max_reads', 'read_length']
+
+def profile_manifest(args):
+	""" Parameters and input that species_profile.txt depends on """
+	return {'params':utility.format_params(args, PROFILE_PARAMS), 'input':utility.file_identity([args['m1'], args['m2']])}
+
 def run_pipeline(args):
 	
 	""" Run entire pipeline """
+	# skip if profile was completed by a previous run with the same parameters and input
+	manifest_path = '%s/species/species_profile.manifest' % args['outdir']
+	if (os.path.isfile('%s/species/species_profile.txt' % args['outdir'])
+			and utility.read_manifest(manifest_path, profile_manifest(args))):
+		print("\nSpecies profile completed by a previous run; skipping")
+		return
+	
 	# read info files
 	species_info = read_annotations(args)
 	marker_info = read_marker_info(args)
@@ -262,6 +277,7 @@ def run_pipeline(args):
 	
 	# write results
 	write_abundance(args['outdir'], species_abundance, species_info)
+	utility.write_manifest(manifest_path, profile_manifest(args))
 
 	# clean up
 	if args['remove_temp']:
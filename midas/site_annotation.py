@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+# MIDAS: Metagenomic Intra-species Diversity Analysis System
+# Copyright (C) 2015 Stephen Nayfach
+# Freely distributed under the GNU General Public License (GPLv3)
+
+import os, numpy as np
+from midas import utility, snp_counts
+
+# per-position annotation of representative genome: rep_genomes/{SPECIES_ID}/annotation.npz
+#   arrays over genome coordinates (see snp_counts.genome_offsets); site_id of merge_midas.py snps is coordinate + 1
+#   locus_type: index into locus_types ('IGR' first)
+#   gene: index into gene_ids, -1 for intergenic sites
+#   codon_pos: position of site in codon (0-2), -1 if unknown
+#   degeneracy: 1-4 (site_type 1D-4D), 0 if unknown
+#   amino_acids: index into amino_acid_sets (amino acids for A,C,G,T), -1 if unknown
+#   source: version, size and modification time of genome and features; annotation is rebuilt when they change
+ANNOTATION_VERSION = 1
+
+def source_files(db, species_id):
+	""" Paths of genome and features files of representative genome """
+	paths = []
+	for name in ['genome.fna', 'genome.features']:
+		path = '%s/rep_genomes/%s/%s' % (db, species_id, name)
+		paths.append(path if os.path.exists(path) else path+'.gz')
+	return paths
+
+def source_key(db, species_id):
+	""" Identity of genome and features by file name, size and modification time; cheap enough to check on every merge
+		paths are left out, so moving the database (keeping modification times) keeps the annotation valid
+	"""
+	key = ['version=%s' % ANNOTATION_VERSION]
+	for path in source_files(db, species_id):
+		if not os.path.exists(path):
+			return None
+		stat = os.stat(path)
+		key.append('%s:%s:%s' % (os.path.basename(path), stat.st_size, int(stat.st_mtime)))
+	return ','.join(key)
+
+def codon_table():
+	""" Degeneracy and amino acids for A,C,G,T at each codon (0-63; ACGT = 0-3), codon position and strand (+, -) """
+	degeneracy = np.zeros((64, 3, 2), dtype=np.uint8)
+	amino_acids = np.zeros((64, 3, 2), dtype=object)
+	for code in range(64):
+		codon = ''.join(['ACGT'[(code >> shift) & 3] for shift in [4, 2, 0]])
+		for codon_pos in range(3):
+			for strand_index, strand in enumerate(['+', '-']):
+				aas = [utility.translate(utility.index_replace(codon, allele, codon_pos, strand)) for allele in 'ACGT']
+				# AA's identical: degeneracy = 4 - 1 + 1 = 4
+				# AA's all different, degeneracy = 4 - 4 + 1 = 1
+				degeneracy[code, codon_pos, strand_index] = 4 - len(set(aas)) + 1
+				amino_acids[code, codon_pos, strand_index] = ','.join(aas)
+	return degeneracy, amino_acids
+
+def build_annotation(db, species_id):
+	""" Annotate every position of representative genome as merge_midas.py snps does: site in the first gene (sorted
+		by scaffold, start, -end) that does not end before it, if it is within that gene; intergenic otherwise
+	"""
+	genome = utility.read_genome(db, species_id)
+	genes = utility.read_genes(species_id, db)['list']
+	offsets, genome_length = snp_counts.genome_offsets(genome)
+	gene_ids = [gene['gene_id'] for gene in genes]
+	locus_types = ['IGR'] + sorted(set([gene.get('gene_type', 'CDS') for gene in genes]))
+	codon_degeneracy, codon_amino_acids = codon_table()
+	amino_acid_sets = sorted(set(codon_amino_acids.flatten().tolist()))
+	codon_amino_acids = np.vectorize(amino_acid_sets.index, otypes=[np.int16])(codon_amino_acids)
+	base_codes = np.full(256, 4, dtype=np.int64)
+	for i, base in enumerate('ACGT'):
+		base_codes[ord(base)] = i
+
+	annotation = {
+		'locus_type': np.zeros(genome_length, dtype=np.uint8),
+		'gene': np.full(genome_length, -1, dtype=np.int32),
+		'codon_pos': np.full(genome_length, -1, dtype=np.int8),
+		'degeneracy': np.zeros(genome_length, dtype=np.uint8),
+		'amino_acids': np.full(genome_length, -1, dtype=np.int16)}
+	gene_index = dict([(id(gene), i) for i, gene in enumerate(genes)])
+	for contig_id in sorted(genome.keys()):
+		contig_genes = [gene for gene in genes if gene['scaffold_id'] == contig_id]
+		if len(contig_genes) == 0:
+			continue
+		# first gene not ending before each position: genes whose prefix maximum of ends reaches it
+		positions = np.arange(1, len(genome[contig_id])+1)
+		first = np.searchsorted(np.maximum.accumulate([gene['end'] for gene in contig_genes]), positions, 'left')
+		for i, gene in enumerate(contig_genes):
+			lo, hi = np.searchsorted(first, [i, i+1])
+			lo = max(lo, gene['start']-1)
+			if lo >= hi:
+				continue
+			sites = positions[lo:hi]
+			coords = offsets[contig_id] + sites - 1
+			annotation['locus_type'][coords] = locus_types.index(gene.get('gene_type', 'CDS'))
+			annotation['gene'][coords] = gene_index[id(gene)]
+			seq = str(gene['seq'])
+			if gene.get('gene_type', 'CDS') != 'CDS' or len(seq) % 3 != 0: # gene must by divisible by 3 to id codons
+				continue
+			# codon of site in gene sequence (oriented start to stop)
+			gene_pos = sites - gene['start'] if gene['strand'] == '+' else gene['end'] - sites
+			codon_pos = gene_pos % 3
+			annotation['codon_pos'][coords] = codon_pos
+			codon_start = gene_pos - codon_pos
+			inside = codon_start + 3 <= len(seq)
+			bases = base_codes[np.frombuffer(seq.encode('ascii'), dtype=np.uint8)]
+			codons = np.full((len(sites), 3), 4, dtype=np.int64)
+			for j in range(3):
+				codons[inside, j] = bases[codon_start[inside]+j]
+			# codon can't contain weird characters
+			valid = (codons < 4).all(axis=1)
+			code = codons[valid, 0]*16 + codons[valid, 1]*4 + codons[valid, 2]
+			strand_index = 0 if gene['strand'] == '+' else 1
+			annotation['degeneracy'][coords[valid]] = codon_degeneracy[code, codon_pos[valid], strand_index]
+			annotation['amino_acids'][coords[valid]] = codon_amino_acids[code, codon_pos[valid], strand_index]
+	annotation['gene_ids'] = np.array(gene_ids, dtype='U')
+	annotation['locus_types'] = np.array(locus_types, dtype='U')
+	annotation['amino_acid_sets'] = np.array(amino_acid_sets, dtype='U')
+	return annotation
+
+def annotation_path(db, species_id):
+	return '%s/rep_genomes/%s/annotation.npz' % (db, species_id)
+
+def read_annotation(path):
+	""" Load annotation arrays written by write_annotation; tables are lists, with None at index -1 """
+	with np.load(path, allow_pickle=False) as data:
+		annotation = dict([(key, data[key]) for key in data.files])
+	annotation['locus_types'] = annotation['locus_types'].tolist()
+	annotation['gene_ids'] = annotation['gene_ids'].tolist() + [None]
+	annotation['amino_acid_sets'] = annotation['amino_acid_sets'].tolist() + [None]
+	annotation['site_types'] = [None, '1D', '2D', '3D', '4D']
+	return annotation
+
+def write_annotation(db, species_id, path=None, key=None):
+	""" Build annotation of representative genome and save it, by default to the database
+		key: source_key of genome and features, if already computed
+	"""
+	path = path if path else annotation_path(db, species_id)
+	annotation = build_annotation(db, species_id)
+	annotation['source'] = np.array(key if key else source_key(db, species_id))
+	# np.savez adds .npz to names without it
+	np.savez_compressed(path+'.tmp.npz', **annotation)
+	os.rename(path+'.tmp.npz', path)
+
+def annotation_file(db, species_id, cachedir):
+	""" Path of an up-to-date annotation of representative genome, built on first use
+		cached in the database, or in cachedir (kept across runs) if the database is not writable
+	"""
+	key = source_key(db, species_id)
+	for path in [annotation_path(db, species_id), '%s/annotation.npz' % cachedir]:
+		if os.path.isfile(path):
+			with np.load(path, allow_pickle=False) as data:
+				if 'source' in data.files and str(data['source']) == key:
+					return path
+	path = annotation_path(db, species_id)
+	if not os.access(os.path.dirname(path), os.W_OK):
+		path = '%s/annotation.npz' % cachedir
+	write_annotation(db, species_id, path, key)
+	return path
+
+def annotate_sites(annotation, site_ids):
+	""" Columns locus_type, gene_id, site_type, amino_acids (None where not annotated) for list of site ids """
+	coords = np.array(site_ids, dtype=np.int64) - 1
+	columns = []
+	for values, table in [('locus_type', 'locus_types'), ('gene', 'gene_ids'), ('degeneracy', 'site_types'), ('amino_acids', 'amino_acid_sets')]:
+		columns.append([annotation[table][i] for i in annotation[values][coords].tolist()])
+	return columns
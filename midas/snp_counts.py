@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+
+# MIDAS: Metagenomic Intra-species Diversity Analysis System
+# Copyright (C) 2015 Stephen Nayfach
+# Freely distributed under the GNU General Public License (GPLv3)
+
+import os, sys, io, gzip, itertools, shutil, struct, zlib, numpy as np
+from midas import utility
+
+# run_midas.py snps output formats
+#   version 1: no format line; one row per genome position (dense)
+#   version 2: '## format=midas_snps; version=2; layout=sparse|dense|sites' before header; sparse omits zero-depth rows,
+#              sites only has rows at known sites (run_midas.py snps --sites)
+#   text output is a series of gzip members indexed by {SPECIES_ID}.snps.gz.idx; see TextCountWriter
+#   binary: {SPECIES_ID}.snps.bin; see BinaryCountWriter
+FORMAT_VERSION = 2
+FIELDS = ['ref_id', 'ref_pos', 'ref_allele', 'depth', 'count_a', 'count_c', 'count_g', 'count_t']
+
+def write_header(file, layout):
+	""" Write format line and field names to run_midas.py snps output """
+	if layout != 'dense':
+		file.write('## format=midas_snps; version=%s; layout=%s\n' % (FORMAT_VERSION, layout))
+	file.write('\t'.join(FIELDS)+'\n')
+
+def read_header(file):
+	""" Read format line(s) and field names from run_midas.py snps output """
+	format = {'format':'midas_snps', 'version':'1', 'layout':'dense'}
+	for line in file:
+		if not line.startswith('##'):
+			break
+		for field in line[2:].split(';'):
+			key, value = field.strip().split('=', 1)
+			format[key] = value
+	return format
+
+def genome_offsets(genome):
+	""" Map contig id to coordinate of first position, with contigs in the order used by run_midas.py snps """
+	offsets, total = {}, 0
+	for contig_id in sorted(genome.keys()):
+		offsets[contig_id] = total
+		total += len(genome[contig_id])
+	return offsets, total
+
+class CountReader:
+	""" Stream allele counts from dense or sparse run_midas.py snps output as arrays
+
+	Sites are identified by genome coordinate: offset of contig (see genome_offsets) + ref_pos - 1
+	"""
+	def __init__(self, path, offsets, chunk_size=100000):
+		self.path = path
+		self.raw = None
+		self.file = utility.iopen(path)
+		self.format = read_header(self.file)
+		index = read_index(path)
+		self.index_keys = np.array([offsets[ref_id]+ref_pos-1 for ref_id, ref_pos, offset in index], dtype=np.int64)
+		self.index_offsets = [offset for ref_id, ref_pos, offset in index]
+		self.read_to = -1 # coordinate of last row read from file
+		self.offsets = offsets
+		self.chunk_size = chunk_size
+		self.dtype = [('ref_id', 'U%s' % max([len(_) for _ in offsets] + [1])), ('ref_pos', 'i8'), ('ref_allele', 'U1'),
+			('depth', 'i8'), ('count_a', 'i8'), ('count_c', 'i8'), ('count_g', 'i8'), ('count_t', 'i8')]
+		self.keys = np.zeros(0, dtype=np.int64)
+		self.counts = np.zeros((0, 4), dtype=np.int64)
+		self.pending = []
+		self.eof = False
+
+	def read_chunk(self):
+		lines = self.pending + list(itertools.islice(self.file, self.chunk_size - len(self.pending)))
+		self.pending = []
+		if len(lines) == 0:
+			self.eof = True
+			return
+		table = np.loadtxt(lines, delimiter='\t', dtype=self.dtype, ndmin=1)
+		contig_ids, index = np.unique(table['ref_id'], return_inverse=True)
+		offsets = np.array([self.offsets[_] for _ in contig_ids], dtype=np.int64)
+		keys = offsets[index] + table['ref_pos'] - 1
+		counts = np.column_stack([table['count_a'], table['count_c'], table['count_g'], table['count_t']])
+		self.keys = np.concatenate([self.keys, keys])
+		self.counts = np.concatenate([self.counts, counts])
+		self.read_to = int(keys[-1])
+
+	def seek(self, key):
+		""" Reopen file at the last indexed gzip member starting at or before key, if rows before it are still unread """
+		i = np.searchsorted(self.index_keys, key, 'right') - 1
+		if i < 0 or self.index_keys[i] <= self.read_to + 1 or len(self.pending) > 0:
+			return
+		self.close()
+		self.raw = open(self.path, 'rb')
+		self.raw.seek(self.index_offsets[i])
+		file = gzip.GzipFile(fileobj=self.raw, mode='rb')
+		self.file = io.TextIOWrapper(file) if sys.version_info[0] == 3 else file
+		self.read_to = int(self.index_keys[i]) - 1
+
+	def skip(self, key):
+		""" Discard sites with coordinate < key; seek to nearest indexed member, then rows are only split, not parsed """
+		n = np.searchsorted(self.keys, key)
+		self.keys, self.counts = self.keys[n:], self.counts[n:]
+		if len(self.keys) > 0 or self.eof:
+			return
+		self.seek(key)
+		for line in self.file:
+			contig_id, ref_pos = line.split('\t', 2)[:2]
+			self.read_to = self.offsets[contig_id] + int(ref_pos) - 1
+			if self.read_to >= key:
+				self.pending = [line]
+				return
+		self.eof = True
+
+	def fetch(self, contig_id, start, end):
+		""" Return ACGT counts (n x 4) for 0-based positions start..end-1 of contig; windows must be requested in order """
+		offset = self.offsets[contig_id]
+		self.skip(offset+start)
+		keys, counts = self.read_until(offset+end)
+		keep = keys >= offset+start
+		window = np.zeros((end-start, 4), dtype=np.int64)
+		window[keys[keep]-offset-start] = counts[keep]
+		return window
+
+	def read_until(self, end):
+		""" Return coordinates and ACGT counts (n x 4) of all remaining sites with coordinate < end """
+		while not self.eof and (len(self.keys) == 0 or self.keys[-1] < end):
+			self.read_chunk()
+		n = np.searchsorted(self.keys, end)
+		keys, counts = self.keys[:n], self.counts[:n]
+		self.keys, self.counts = self.keys[n:], self.counts[n:]
+		return keys, counts
+
+	def close(self):
+		self.file.close()
+		if self.raw is not None:
+			self.raw.close()
+
+def index_path(path):
+	return path+'.idx'
+
+def write_index(path, size, index):
+	""" Write member index of text output: size of output in bytes, then ref_id, ref_pos of first row and byte offset of each member """
+	with open(index_path(path)+'.tmp', 'w') as file:
+		file.write('## size=%s\n' % size)
+		file.write('ref_id\tref_pos\toffset\n')
+		for ref_id, ref_pos, offset in index:
+			file.write('%s\t%s\t%s\n' % (ref_id, ref_pos, offset))
+	os.rename(index_path(path)+'.tmp', index_path(path))
+
+def read_index(path):
+	""" Read member index of text output; empty if missing or written for a different file """
+	if not os.path.isfile(index_path(path)):
+		return []
+	with open(index_path(path)) as file:
+		size = int(next(file).split('=')[1])
+		if size != os.path.getsize(path):
+			return []
+		next(file)
+		return [(ref_id, int(ref_pos), int(offset)) for ref_id, ref_pos, offset in [line.rstrip('\n').split('\t') for line in file]]
+
+class TextCountWriter:
+	""" Write text output as concatenated gzip members (a valid gzip file) and record where rows start
+
+	write(text, ref_id, ref_pos) compresses text as one member starting with row ref_id, ref_pos;
+	the index ({path}.idx) lets readers seek to the member containing a site instead of reading all preceding rows
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.file = open(path+'.tmp', 'wb')
+		self.index = []
+
+	def write(self, text, ref_id=None, ref_pos=None):
+		if ref_id is not None:
+			self.index.append((ref_id, ref_pos, self.file.tell()))
+		compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+		self.file.write(compressor.compress(text.encode('ascii')) + compressor.flush())
+
+	def append(self, path):
+		""" Copy output of another TextCountWriter, keeping its index """
+		start = self.file.tell()
+		self.index += [(ref_id, ref_pos, start+offset) for ref_id, ref_pos, offset in read_index(path)]
+		with open(path, 'rb') as file:
+			shutil.copyfileobj(file, self.file)
+
+	def close(self):
+		size = self.file.tell()
+		self.file.close()
+		write_index(self.path, size, self.index)
+		os.rename(self.path+'.tmp', self.path)
+
+# binary container
+#   header: MAGIC, uint32 version
+#   blocks: zlib-compressed ACGT counts (sites x 4) for up to BLOCK_SITES consecutive positions of one contig,
+#           stored as uint16 or uint32 depending on the largest count in the block
+#   index: uint32 number of contigs, uint32 number of blocks,
+#          per contig: uint16 length of id, uint64 contig length, id; then BLOCK_DTYPE records
+#   footer: uint64 offset of index, MAGIC
+MAGIC = b'MIDASACG'
+BINARY_VERSION = 1
+BLOCK_SITES = 65536
+BLOCK_DTYPE = np.dtype([('contig', '<u4'), ('start', '<u8'), ('size', '<u4'), ('width', '<u1'), ('offset', '<u8'), ('length', '<u4')])
+
+class BinaryCountWriter:
+	""" Write per-contig ACGT counts to binary container """
+	def __init__(self, path):
+		self.path = path
+		self.file = open(path+'.tmp', 'wb')
+		self.file.write(MAGIC + struct.pack('<I', BINARY_VERSION))
+		self.contigs = []
+		self.blocks = []
+
+	def write_contig(self, contig_id, counts):
+		""" Write counts (4 x contig length) for one contig """
+		index = len(self.contigs)
+		self.contigs.append((contig_id, counts.shape[1]))
+		for start in range(0, counts.shape[1], BLOCK_SITES):
+			block = counts[:, start:start+BLOCK_SITES].T
+			width = 2 if block.size == 0 or block.max() < 2**16 else 4
+			data = zlib.compress(np.ascontiguousarray(block, dtype='<u%s' % width).tobytes())
+			self.blocks.append((index, start, block.shape[0], width, self.file.tell(), len(data)))
+			self.file.write(data)
+
+	def close(self):
+		index_offset = self.file.tell()
+		self.file.write(struct.pack('<II', len(self.contigs), len(self.blocks)))
+		for contig_id, length in self.contigs:
+			name = contig_id.encode('ascii')
+			self.file.write(struct.pack('<HQ', len(name), length) + name)
+		self.file.write(np.array(self.blocks, dtype=BLOCK_DTYPE).tobytes())
+		self.file.write(struct.pack('<Q', index_offset) + MAGIC)
+		self.file.close()
+		os.rename(self.path+'.tmp', self.path)
+
+class BinaryCountReader:
+	""" Random access to ACGT counts in binary container
+
+	reader.contigs: list of (contig_id, length) in file order
+	reader.fetch(contig_id, start, end): ACGT counts (n x 4) for 0-based positions start..end-1
+	"""
+	def __init__(self, path):
+		self.file = open(path, 'rb')
+		if self.file.read(len(MAGIC)) != MAGIC:
+			raise ValueError("Not a MIDAS allele count file: %s" % path)
+		self.file.seek(-8-len(MAGIC), 2)
+		index_offset = struct.unpack('<Q', self.file.read(8))[0]
+		if self.file.read(len(MAGIC)) != MAGIC:
+			raise ValueError("Truncated MIDAS allele count file: %s" % path)
+		self.file.seek(index_offset)
+		num_contigs, num_blocks = struct.unpack('<II', self.file.read(8))
+		self.contigs = []
+		for i in range(num_contigs):
+			size, length = struct.unpack('<HQ', self.file.read(10))
+			self.contigs.append((self.file.read(size).decode('ascii'), length))
+		self.contig_index = dict([(contig[0], i) for i, contig in enumerate(self.contigs)])
+		self.blocks = np.frombuffer(self.file.read(num_blocks*BLOCK_DTYPE.itemsize), dtype=BLOCK_DTYPE)
+		self.cache = (None, None) # last block read; consecutive windows usually fall in the same block
+
+	def read_block(self, block):
+		if self.cache[0] == int(block['offset']):
+			return self.cache[1]
+		self.file.seek(int(block['offset']))
+		data = zlib.decompress(self.file.read(int(block['length'])))
+		counts = np.frombuffer(data, dtype='<u%s' % block['width']).reshape(-1, 4)
+		self.cache = (int(block['offset']), counts)
+		return counts
+
+	def fetch(self, contig_id, start=0, end=None):
+		""" Return ACGT counts (n x 4) for 0-based positions start..end-1 of contig (end=None: contig length)
+			zeros if contig is absent; no positions if it is absent and end is None
+		"""
+		if contig_id not in self.contig_index:
+			return np.zeros((0 if end is None else end-start, 4), dtype=np.int64)
+		if end is None:
+			end = self.contigs[self.contig_index[contig_id]][1]
+		window = np.zeros((end-start, 4), dtype=np.int64)
+		blocks = self.blocks[self.blocks['contig'] == self.contig_index[contig_id]]
+		blocks = blocks[(blocks['start'] < end) & (blocks['start'] + blocks['size'] > start)]
+		for block in blocks:
+			block_start = int(block['start'])
+			counts = self.read_block(block)
+			lo, hi = max(start, block_start), min(end, block_start+int(block['size']))
+			window[lo-start:hi-start] = counts[lo-block_start:hi-block_start]
+		return window
+
+	def close(self):
+		self.file.close()
+
+# count matrix: intermediate file of merge_midas.py snps, written and read sequentially
+#   header: MATRIX_MAGIC, uint32 version, uint32 number of samples
+#   blocks: uint64 coordinate of first site, uint32 number of sites, uint8 width, uint32 length,
+#           then zlib-compressed ACGT counts (sites x samples x 4) as uint16 or uint32
+MATRIX_MAGIC = b'MIDASMTX'
+MATRIX_HEADER = struct.Struct('<QIBI')
+
+class MatrixCountWriter:
+	""" Write ACGT counts of several samples for consecutive windows of sites """
+	def __init__(self, path, num_samples):
+		self.path = path
+		self.file = open(path+'.tmp', 'wb')
+		self.file.write(MATRIX_MAGIC + struct.pack('<II', BINARY_VERSION, num_samples))
+
+	def write(self, key, counts):
+		""" Write counts (sites x samples x 4) of sites with coordinates key..key+sites-1 """
+		width = 2 if counts.size == 0 or counts.max() < 2**16 else 4
+		data = zlib.compress(np.ascontiguousarray(counts, dtype='<u%s' % width).tobytes(), 1)
+		self.file.write(MATRIX_HEADER.pack(key, counts.shape[0], width, len(data)) + data)
+
+	def close(self):
+		self.file.close()
+		os.rename(self.path+'.tmp', self.path)
+
+class MatrixCountReader:
+	""" Read count matrix written by MatrixCountWriter; windows must be requested in order
+
+	reader.fetch(contig_id, start, end): ACGT counts (n x samples x 4) for 0-based positions start..end-1
+	"""
+	def __init__(self, path, offsets):
+		self.file = open(path, 'rb')
+		if self.file.read(len(MATRIX_MAGIC)) != MATRIX_MAGIC:
+			raise ValueError("Not a MIDAS count matrix: %s" % path)
+		self.num_samples = struct.unpack('<II', self.file.read(8))[1]
+		self.offsets = offsets
+		self.block = self.read_block()
+
+	def read_block(self):
+		""" Next block as (coordinate of first site, counts), None at end of file """
+		header = self.file.read(MATRIX_HEADER.size)
+		if len(header) < MATRIX_HEADER.size:
+			return None
+		key, sites, width, length = MATRIX_HEADER.unpack(header)
+		data = zlib.decompress(self.file.read(length))
+		return key, np.frombuffer(data, dtype='<u%s' % width).reshape(sites, self.num_samples, 4)
+
+	def fetch(self, contig_id, start, end):
+		lo, hi = self.offsets[contig_id]+start, self.offsets[contig_id]+end
+		window = np.zeros((hi-lo, self.num_samples, 4), dtype=np.int64)
+		while self.block is not None and self.block[0] < hi:
+			key, counts = self.block
+			a, b = max(lo, key), min(hi, key+len(counts))
+			if a < b:
+				window[a-lo:b-lo] = counts[a-key:b-key]
+			if key+len(counts) > hi:
+				break
+			self.block = self.read_block()
+		return window
+
+	def close(self):
+		self.file.close()
+
+def open_counts(basepath, offsets):
+	""" Open binary ({basepath}.snps.bin) or text ({basepath}.snps.gz) allele counts """
+	if os.path.isfile(basepath+'.snps.bin'):
+		return BinaryCountReader(basepath+'.snps.bin')
+	else:
+		return CountReader(basepath+'.snps.gz', offsets)
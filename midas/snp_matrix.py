@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+# MIDAS: Metagenomic Intra-species Diversity Analysis System
+# Copyright (C) 2015 Stephen Nayfach
+# Freely distributed under the GNU General Public License (GPLv3)
+
+import os, glob, numpy as np
+
+# binary matrix store of merge_midas.py snps --matrix: {OUTDIR}/{SPECIES_ID}/snps_matrix
+#   {part}.{n}.{info,freq,depth}.npy: chunks of up to CHUNK_SITES rows (sites) of snps_info, snps_freq and snps_depth
+#     info: structured array with the fields of snps_info.txt; '' where snps_info.txt has NA
+#     freq: float16 or float32 (sites x samples)
+#     depth: uint16 or uint32 (sites x samples), depending on the largest depth in the chunk
+#   samples.txt: sample ids in column order
+#   index.txt: format line, then name, number of rows, first and last site_id of each chunk in site order;
+#              written last, so its presence marks a complete store
+MATRIX_VERSION = 1
+CHUNK_SITES = 65536
+
+def matrix_dir(species_dir):
+	return '%s/snps_matrix' % species_dir
+
+def is_matrix(dir):
+	return os.path.isfile('%s/index.txt' % dir)
+
+def info_dtype(ref_ids, gene_ids, locus_types):
+	""" Fields of snps_info.txt, with string widths fitting the contigs, genes and locus types of a species """
+	width = lambda values: max([len(_) for _ in values if _ is not None] + [1])
+	return np.dtype([('site_id', '<i8'), ('ref_id', 'U%s' % width(ref_ids)), ('ref_pos', '<i8'), ('ref_allele', 'U1'),
+		('major_allele', 'U1'), ('minor_allele', 'U1'), ('count_samples', '<i4'),
+		('count_a', '<i8'), ('count_c', '<i8'), ('count_g', '<i8'), ('count_t', '<i8'),
+		('locus_type', 'U%s' % width(locus_types)), ('gene_id', 'U%s' % width(gene_ids)), ('snp_type', 'U4'),
+		('site_type', 'U2'), ('amino_acids', 'U7')])
+
+class MatrixWriter:
+	""" Write rows of snps_info, snps_freq and snps_depth to chunks of a matrix store
+
+	info_dtype: see info_dtype
+	part: identifies the writer when several write to one store (e.g. one per thread); chunks are ordered by part
+	"""
+	def __init__(self, dir, part, info_dtype, freq_dtype='float32'):
+		self.prefix = '%s/%s' % (dir, part)
+		self.info_dtype = info_dtype
+		self.freq_dtype = freq_dtype
+		self.buffers = {'info':[], 'freq':[], 'depth':[]}
+		self.rows = 0
+		self.chunks = 0
+
+	def write(self, info, freqs, depths):
+		""" Add rows: info (structured array), freqs and depths (sites x samples) """
+		if len(info) == 0:
+			return
+		for name, values in [('info', info), ('freq', freqs), ('depth', depths)]:
+			self.buffers[name].append(values)
+		self.rows += len(info)
+		while self.rows >= CHUNK_SITES:
+			self.flush(CHUNK_SITES)
+
+	def flush(self, rows):
+		""" Write first rows of buffer as next chunk """
+		buffers = dict([(name, np.concatenate(values)) for name, values in self.buffers.items()])
+		freqs = buffers['freq'][:rows].astype(self.freq_dtype)
+		depths = buffers['depth'][:rows]
+		depths = depths.astype('<u2' if depths.size == 0 or depths.max() < 2**16 else '<u4')
+		for name, values in [('info', buffers['info'][:rows]), ('freq', freqs), ('depth', depths)]:
+			np.save('%s.%s.%s.npy' % (self.prefix, self.chunks, name), values)
+		self.buffers = dict([(name, [values[rows:]]) for name, values in buffers.items()])
+		self.rows -= rows
+		self.chunks += 1
+
+	def close(self):
+		if self.rows > 0:
+			self.flush(self.rows)
+
+def write_index(dir, sample_ids, freq_dtype):
+	""" Record samples and chunks written by MatrixWriters to dir, which completes the store """
+	with open('%s/samples.txt' % dir, 'w') as file:
+		file.write(''.join(['%s\n' % sample_id for sample_id in sample_ids]))
+	names = [os.path.basename(path)[:-len('.info.npy')] for path in glob.glob('%s/*.info.npy' % dir)]
+	names.sort(key=lambda name: [int(_) for _ in name.split('.')])
+	with open('%s/index.txt' % dir+'.tmp', 'w') as file:
+		file.write('## format=midas_snps_matrix; version=%s; freq=%s\n' % (MATRIX_VERSION, freq_dtype))
+		file.write('name\trows\tfirst_site\tlast_site\n')
+		for name in names:
+			site_ids = np.load('%s/%s.info.npy' % (dir, name), mmap_mode='r')['site_id']
+			file.write('%s\t%s\t%s\t%s\n' % (name, len(site_ids), site_ids[0], site_ids[-1]))
+	os.rename('%s/index.txt' % dir+'.tmp', '%s/index.txt' % dir)
+
+class SnpMatrix:
+	""" Read a matrix store; chunks are memory-mapped and only the rows of requested sites are read
+
+	matrix.sample_ids: sample ids in column order
+	matrix.num_sites: number of sites (rows)
+	matrix.fetch(ftype, site_from, site_to, samples): freq or depth values (sites x samples)
+	matrix.info(site_from, site_to): snps_info rows (structured array)
+	matrix.chunks(site_from, site_to, samples): yield info, freqs, depths of each chunk
+	sites are those with site_from <= site_id < site_to (None: unbounded); samples are ids or column indexes
+	"""
+	def __init__(self, dir):
+		if not is_matrix(dir):
+			raise ValueError("Not a MIDAS SNP matrix store: %s" % dir)
+		self.dir = dir
+		self.sample_ids = [line.rstrip('\n') for line in open('%s/samples.txt' % dir)]
+		with open('%s/index.txt' % dir) as file:
+			self.format = dict([field.strip().split('=') for field in next(file)[2:].split(';')])
+			next(file)
+			index = [line.rstrip('\n').split('\t') for line in file]
+		self.names = [name for name, rows, first, last in index]
+		self.first_sites = np.array([int(first) for name, rows, first, last in index], dtype=np.int64)
+		self.last_sites = np.array([int(last) for name, rows, first, last in index], dtype=np.int64)
+		self.num_sites = sum([int(rows) for name, rows, first, last in index])
+
+	def load(self, i, name):
+		return np.load('%s/%s.%s.npy' % (self.dir, self.names[i], name), mmap_mode='r')
+
+	def columns(self, samples):
+		""" Column indexes of samples given by id or index; all columns if None """
+		if samples is None:
+			return slice(None)
+		lookup = dict([(sample_id, i) for i, sample_id in enumerate(self.sample_ids)])
+		return [lookup[sample] if sample in lookup else int(sample) for sample in samples]
+
+	def select(self, site_from=None, site_to=None):
+		""" Yield chunk index and row range of sites in each chunk containing some of them """
+		lo = 0 if site_from is None else np.searchsorted(self.last_sites, site_from, 'left')
+		hi = len(self.names) if site_to is None else np.searchsorted(self.first_sites, site_to, 'left')
+		for i in range(lo, hi):
+			site_ids = self.load(i, 'info')['site_id']
+			start = 0 if site_from is None else np.searchsorted(site_ids, site_from, 'left')
+			end = len(site_ids) if site_to is None else np.searchsorted(site_ids, site_to, 'left')
+			if start < end:
+				yield i, start, end
+
+	def chunks(self, site_from=None, site_to=None, samples=None):
+		columns = self.columns(samples)
+		for i, start, end in self.select(site_from, site_to):
+			yield (np.array(self.load(i, 'info')[start:end]), self.load(i, 'freq')[start:end][:, columns],
+				self.load(i, 'depth')[start:end][:, columns])
+
+	def fetch(self, ftype, site_from=None, site_to=None, samples=None):
+		columns = self.columns(samples)
+		values = [self.load(i, ftype)[start:end][:, columns] for i, start, end in self.select(site_from, site_to)]
+		if len(values) == 0:
+			dtype = self.format['freq'] if ftype == 'freq' else '<u2'
+			return np.zeros((0, len(self.sample_ids) if samples is None else len(columns)), dtype=dtype)
+		return np.concatenate(values)
+
+	def info(self, site_from=None, site_to=None):
+		values = [self.load(i, 'info')[start:end] for i, start, end in self.select(site_from, site_to)]
+		if len(values) == 0:
+			return np.zeros(0, dtype=self.load(0, 'info').dtype if len(self.names) > 0 else [('site_id', '<i8')])
+		return np.concatenate(values)
+
+def info_rows(info):
+	""" snps_info rows of structured array as dicts of strings, as read from snps_info.txt """
+	fields = info.dtype.names
+	return [dict([(field, str(value) if value != '' else 'NA') for field, value in zip(fields, row)]) for row in info.tolist()]
@@ -4,7 +4,7 @@
 # Copyright (C) 2015 Stephen Nayfach
 # Freely distributed under the GNU General Public License (GPLv3)
 
-import io, os, stat, sys, resource, gzip, platform, bz2, Bio.SeqIO
+import io, os, stat, sys, shutil, resource, gzip, platform, bz2, hashlib, Bio.SeqIO
 
 __version__ = '1.3.0'
 
@@ -35,26 +35,22 @@ def print_copyright(log=None):
 	if log is not None: log.write('\n'.join(lines)+'\n')
 	sys.stdout.write('\n'.join(lines)+'\n')
 
-def batch_samples(samples, threads):
-	""" Split up samples into batches
-		assert: batch_size * threads < max_open
-		assert: len(batches) == threads
-	"""
-	import resource
-	import math
+def max_open_files(threads, reserved=0):
+	""" Number of files each of <threads> processes may open, keeping <reserved> files per process for other uses """
 	max_open = int(0.8 * resource.getrlimit(resource.RLIMIT_NOFILE)[0]) # max open files on system
-	max_size = math.floor(max_open/threads) # max batch size to avoid exceeding max_open
-	min_size = math.ceil(len(samples)/float(threads)) # min batch size to use all threads
-	size = min(min_size, max_size)
-	batches = []
-	batch = []
-	for sample in samples:
-		batch.append(sample)
-		if len(batch) >= size:
-			batches.append(batch)
-			batch = []
-	if len(batch) > 0: batches.append(batch)
-	return batches
+	return max(1, max_open//threads - reserved)
+
+def available_memory():
+	""" Bytes of memory available to new processes, or None if unknown """
+	if os.path.isfile('/proc/meminfo'):
+		with open('/proc/meminfo') as file:
+			for line in file:
+				if line.startswith('MemAvailable:'):
+					return int(line.split()[1]) * 1024
+	try:
+		return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+	except (ValueError, OSError, AttributeError):
+		return None
 
 def parallel_old(function, list, threads):
 	""" Run function using multiple threads """
@@ -106,6 +102,99 @@ def parallel(function, argument_list, threads):
 		pool.join()
 		sys.exit("\nKeyboardInterrupt")
 
+def parallel_ordered(function, argument_list, threads):
+	""" Like parallel, but yield results in input order as soon as each is ready """
+	import multiprocessing as mp
+	import signal
+	
+	def init_worker():
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+	
+	pool = mp.Pool(int(threads), init_worker)
+	
+	try:
+		results = []
+		for arguments in argument_list:
+			results.append(pool.apply_async(function, args=arguments))
+		pool.close()
+		for r in results:
+			yield r.get()
+		pool.join()
+
+	except KeyboardInterrupt:
+		pool.terminate()
+		pool.join()
+		sys.exit("\nKeyboardInterrupt")
+
+def append_file(outfile, inpath, start=0):
+	""" Append bytes of inpath from offset start to end of outfile (opened in binary mode)
+		copied by the kernel (copy_file_range or sendfile) where available, otherwise through python
+	"""
+	outfile.flush()
+	copies = []
+	if hasattr(os, 'copy_file_range'):
+		copies.append(lambda fd_in, fd_out, offset, count: os.copy_file_range(fd_in, fd_out, count, offset))
+	if hasattr(os, 'sendfile') and platform.system() == 'Linux': # file to file sendfile is Linux only
+		copies.append(lambda fd_in, fd_out, offset, count: os.sendfile(fd_out, fd_in, offset, count))
+	with open(inpath, 'rb') as infile:
+		offset, end = start, os.fstat(infile.fileno()).st_size
+		for copy in copies:
+			try:
+				while offset < end:
+					copied = copy(infile.fileno(), outfile.fileno(), offset, end-offset)
+					if copied == 0:
+						break
+					offset += copied
+			except OSError: # e.g. not supported by file system
+				continue
+			if offset >= end:
+				break
+		# buffered position of outfile is behind bytes written to its descriptor
+		outfile.seek(0, 2)
+		if offset < end:
+			infile.seek(offset)
+			shutil.copyfileobj(infile, outfile)
+
+def file_identity(paths):
+	""" Identify input files by absolute path, size and modification time """
+	identity = []
+	for path in paths:
+		if path is None:
+			continue
+		stat = os.stat(path)
+		identity.append('%s:%s:%s' % (os.path.abspath(path), stat.st_size, int(stat.st_mtime)))
+	return ','.join(identity)
+
+def format_params(args, keys):
+	""" Parameters that determine outputs, as recorded in manifests """
+	return ','.join(['%s=%s' % (key, args.get(key)) for key in keys])
+
+ALIGN_PARAMS = ['mode', 'speed', 'max_reads', 'trim', 'interleaved', 'shards']
+
+def reads_identity(args, species_ids):
+	""" Identity of alignments that a run builds from input reads: read files, bowtie2 parameters and species in the database
+		used in place of the alignment file, which is rewritten by every run that aligns
+	"""
+	species_key = hashlib.md5(','.join(sorted(species_ids)).encode('ascii')).hexdigest()
+	return '%s;%s;species=%s' % (file_identity([args['m1'], args['m2']]), format_params(args, ALIGN_PARAMS), species_key)
+
+def write_manifest(path, values):
+	""" Write tab-delimited key/value completion manifest; written last, so its presence marks complete outputs """
+	with open(path+'.tmp', 'w') as file:
+		for key in sorted(values):
+			file.write('%s\t%s\n' % (key, values[key]))
+	os.rename(path+'.tmp', path)
+
+def read_manifest(path, expected):
+	""" Return manifest as dict if it exists and matches expected values, otherwise None """
+	if not os.path.isfile(path):
+		return None
+	manifest = dict([line.rstrip('\n').split('\t', 1) for line in open(path)])
+	for key, value in expected.items():
+		if manifest.get(key) != str(value):
+			return None
+	return manifest
+
 def add_executables(args):
 	""" Identify relative file and directory paths """
 	src_dir = os.path.dirname(os.path.abspath(__file__))
@@ -231,6 +320,25 @@ def check_exit_code(process, command):
 		err_message = "\nError encountered executing:\n%s\n\nError message:\n%s\n" % (command, err)
 		sys.exit(err_message)
 
+def bowtie2_command(args, index, threads, no_unal=True):
+	""" Build bowtie2 command line for aligning input reads to index """
+	command = '%s ' % args['bowtie2']
+	if no_unal: command += '--no-unal '
+	command += '-x %s ' % index
+	if args['max_reads']: command += '-u %s ' % args['max_reads'] # max num of reads
+	if args['trim']: command += '--trim3 %s ' % args['trim'] # trim 3'
+	command += '--%s' % args['speed'] # alignment speed
+	command += '-local ' if args['mode'] == 'local' else ' ' # global/local alignment
+	command += '--threads %s ' % threads
+	command += '-f ' if args['file_type'] == 'fasta' else '-q ' # input type
+	if args['m2']: # -1 and -2 contain paired reads
+		command += '-1 %s -2 %s ' % (args['m1'], args['m2'])
+	elif args['interleaved']: # -1 contains paired reads
+		command += '--interleaved %s ' % args['m1']
+	else: # -1 contains unpaired reads
+		command += '-U %s ' % args['m1']
+	return command
+
 def check_bamfile(args, bampath):
 	""" Use samtools to check bamfile integrity """
 	import subprocess as sp
@@ -241,6 +349,90 @@ def check_bamfile(args, bampath):
 		err_message = "\nWarning, bamfile may be corrupt: %s\nSamtools reported this error: %s\n" % (bampath, err.rstrip())
 		sys.exit(err_message)
 
+def is_cram(path):
+	""" Check if alignment file is CRAM based on file extension """
+	return path.split('.')[-1] == 'cram'
+
+def open_bam(path, index=None, reference=None):
+	""" Open BAM or CRAM file with pysam """
+	import pysam
+	mode = 'rc' if is_cram(path) else 'rb'
+	if mode == 'rc' and reference is not None:
+		return pysam.AlignmentFile(path, mode, index_filename=index, reference_filename=reference)
+	else:
+		return pysam.AlignmentFile(path, mode, index_filename=index)
+
+def is_sorted_bam(path):
+	""" Check if BAM/CRAM header declares coordinate sort order """
+	bamfile = open_bam(path)
+	header = bamfile.header.to_dict() if hasattr(bamfile.header, 'to_dict') else bamfile.header
+	bamfile.close()
+	return header.get('HD', {}).get('SO') == 'coordinate'
+
+def find_bam_index(path):
+	""" Return path to existing index of BAM/CRAM file, or None """
+	for index in [path+'.bai', path+'.csi', path+'.crai', path.rsplit('.', 1)[0]+'.bai']:
+		if os.path.isfile(index):
+			return index
+	return None
+
+def is_primary(aln):
+	""" Check that alignment is the primary alignment of a mapped read """
+	return not (aln.is_unmapped or aln.is_secondary or aln.is_supplementary)
+
+def check_bam_references(bampath, references, reference=None):
+	""" Check that BAM/CRAM header contains each selected reference with the expected length
+		references: dictionary of reference name to length
+	"""
+	bamfile = open_bam(bampath, reference=reference)
+	lengths = dict(zip(bamfile.references, bamfile.lengths))
+	bamfile.close()
+	missing = [name for name in references if name not in lengths]
+	different = [name for name in references if name in lengths and lengths[name] != references[name]]
+	if len(missing) > 0 or len(different) > 0:
+		error = "\nError: reference sequences in %s do not match the selected species\n" % bampath
+		if len(missing) > 0:
+			error += "%s reference(s) not found in header, e.g.: %s\n" % (len(missing), ', '.join(missing[:3]))
+		if len(different) > 0:
+			error += "%s reference(s) have different lengths, e.g.: %s\n" % (len(different), ', '.join(different[:3]))
+		error += "Make sure reads were aligned to the MIDAS reference database specified by -d\n"
+		sys.exit(error)
+
+def read_marker_map(db):
+	""" Map gene_id to marker_id for all marker genes in database """
+	markers = {}
+	for r in parse_file('%s/marker_genes/phyeco.map' % db):
+		markers[r['gene_id']] = r['marker_id']
+	return markers
+
+def write_gene_table(path, gene_ids, lengths, marker_ids, marker_list):
+	""" Write table of gene_id, length, and marker code for pangenome centroids
+		rows are sorted by gene_id; marker code is index into marker_list (-1 if not a marker)
+		stored as a .npy file so it can be memory-mapped by run_midas.py genes
+	"""
+	import numpy as np
+	order = sorted(range(len(gene_ids)), key=lambda i: gene_ids[i])
+	width = max([len(gene_id) for gene_id in gene_ids] + [1])
+	dtype = [('gene_id', 'S%s' % width), ('length', '<u4'), ('marker', '<i1')]
+	table = np.zeros(len(gene_ids), dtype=dtype)
+	table['gene_id'] = [gene_ids[i].encode('ascii') for i in order]
+	table['length'] = [lengths[i] for i in order]
+	table['marker'] = [marker_list.index(marker_ids[i]) if marker_ids[i] is not None else -1 for i in order]
+	# write to temp file and rename: tables may be built while other runs read the database
+	tmp_path = '%s.%s.tmp' % (path, os.getpid())
+	with open(tmp_path, 'wb') as file:
+		np.save(file, table)
+	os.rename(tmp_path, path)
+
+def read_gene_table(path):
+	""" Memory-map table of gene_id, length, and marker code written by write_gene_table """
+	import numpy as np
+	return np.load(path, mmap_mode='r')
+
+def gene_table_key(gene_ids):
+	""" Checksum of gene_id column of gene table, identifying the rows that binary gene outputs refer to """
+	return hashlib.md5(b'\n'.join(gene_ids.tolist())).hexdigest()
+
 def read_genes(species_id, db):
 	""" Read in gene coordinates from features file """
 	genome = read_genome(db, species_id)
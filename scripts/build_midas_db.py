@@ -39,6 +39,12 @@ The file should be tab-delimited file with a header and 3 fields:
 		help="Number of threads to use (1)")
 	parser.add_argument('--compress', action='store_true', default=False,
 		help="Compress output files with gzip (False)")
+	parser.add_argument('--genome_index', action='store_true', default=False,
+		help="""Build a bowtie2 index of all representative genomes (False).
+Used by run_midas.py snps --db_index instead of building an index for each sample""")
+	parser.add_argument('--index_partitions', type=int, default=1, metavar='INT',
+		help="""Split the index from --genome_index into INT partitions of similar size (1).
+Samples only search partitions that contain their selected species""")
 	parser.add_argument('--max_species', type=int, default=float('inf'), metavar='INT',
 		help="Maximum number of species to process from input (use all).\nUseful for quick tests")
 	parser.add_argument('--max_genomes', type=int, default=float('inf'), metavar='INT',
@@ -53,6 +59,8 @@ def check_args(args):
 		sys.exit("\nError: could not locate directory specified by --genomes: %s\n" % args['indir'])
 	if not os.path.isfile(args['mapfile']):
 		sys.exit("\nError: could not locate file specified by --mapping: %s\n" % args['mapfile'])
+	if args['index_partitions'] < 1:
+		sys.exit("\nError: --index_partitions must be at least 1\n")
 	for program in ['hmmsearch', 'vsearch']:
 		if not utility.which(program):
 			error = "\nError: program '%s' not found in your PATH" % program
@@ -44,6 +44,9 @@ call_consensus.py /path/to/snps --out /path/to/output --max_sites 10000
 directory should be named according to a species_id and contains files 'snps_*.txt')""")
 	parser.add_argument('--out', metavar='PATH', type=str, default="/dev/stdout",
 		help="""path to output file""")
+	parser.add_argument('--matrix', action='store_true', default=False,
+		help="""read the binary matrix store written by 'merge_midas.py snps --matrix' instead of 'snps_*.txt'
+allele frequencies in the store are not rounded to 3 digits, so results may differ slightly""")
 
 	sample = parser.add_argument_group("Sample filters (select subset of samples from INDIR)")
 	sample.add_argument('--sample_depth', dest='sample_depth', type=float, default=0.0, metavar='FLOAT',
@@ -180,7 +183,7 @@ if __name__ == '__main__':
 	print_args(args)
 	
 	# init species, samples, sequences, site list
-	species = parse_snps.Species(args['indir'])
+	species = parse_snps.Species(args['indir'], args['matrix'])
 	samples = parse_snps.fetch_samples(species, args['sample_depth'], args['fract_cov'], args['max_samples'])
 	if args['site_list']: 
 		site_list = set([_.rstrip() for _ in open(args['site_list'])])
@@ -195,6 +195,13 @@ merge_midas.py snps /path/to/outdir -i /path/to/samples -t dir --max_species 1 -
 	io.add_argument('-d', type=str, dest='db', default=os.environ['MIDAS_DB'] if 'MIDAS_DB' in os.environ else None,
 		help="""Path to reference database
 By default, the MIDAS_DB environmental variable is used""")
+	io.add_argument('--incremental', action='store_true', default=False,
+		help="""Keep a merge store in OUTDIR/SPECIES_ID/store (False).
+When rerun with the same site filters and additional samples, only new samples are read
+and their columns are added after those of samples merged before""")
+	io.add_argument('--matrix', choices=['float16', 'float32'], default=None, metavar='TYPE',
+		help="""Also write freq, depth and info to a binary store in OUTDIR/SPECIES_ID/snps_matrix (off)
+TYPE is float16 or float32 for allele frequencies; see midas.snp_matrix for reading it""")
 	presets = parser.add_argument_group("Presets (option groups for easily...)")
 
 	snps = parser.add_argument_group("Presets")
@@ -297,6 +304,9 @@ def check_arguments(program, args):
 		if arg in args and args[arg] and (args[arg] < 0):
 			sys.exit("\nError: --%s cannot be a negative value\n" % arg)
 
+	if 'matrix' in args and args['matrix'] and args['incremental']:
+		sys.exit("\nError: --matrix cannot be combined with --incremental\n")
+
 	check_input(args)
 
 	check_output(args)
@@ -414,6 +424,10 @@ def print_snps_arguments(args):
 		print ("  keep sites with depth <= %sx the mean-genome-wide-depth in >= %s%% of samples" % (args['site_ratio'], 100*args['site_prev']) )
 	if args['max_sites'] != float('Inf'):
 		print ("  keep <= %s sites" % (args['max_sites']))
+	if args['incremental']:
+		print ("Incremental merge: add new samples to merge store")
+	if args['matrix']:
+		print ("Write binary matrix store with %s allele frequencies" % args['matrix'])
 	print ("Number of CPUs to use: %s" % args['threads'])
 	print ("===============================")
 	print ("")
@@ -253,8 +253,11 @@ By default, the MIDAS_DB environmental variable is used""")
 	db.add_argument('--species_cov', type=float, dest='species_cov', metavar='FLOAT', help='Include species with >X coverage (3.0)')
 	db.add_argument('--species_topn', type=int, dest='species_topn', metavar='INT', help='Include top N most abundant species')
 	db.add_argument('--species_id', type=str, dest='species_id', metavar='CHAR', help='Include specified species. Separate ids with a comma')
+	db.add_argument('--shards', type=int, default=1, metavar='INT',
+		help="""Split bowtie2 database into INT size-balanced shards that are built and searched in parallel (1).
+Reads are assigned to the shard with the best alignment score. Use the same value with --align""")
 	align = parser.add_argument_group('Read alignment options (if using --align)')
-	align.add_argument('-1', type=str, dest='m1', required=True,
+	align.add_argument('-1', type=str, dest='m1',
 		help="""FASTA/FASTQ file containing 1st mate if using paired-end reads.
 Otherwise FASTA/FASTQ containing unpaired reads.
 Can be gzip'ed (extension: .gz) or bzip2'ed (extension: .bz2)""")
@@ -273,6 +276,9 @@ Can be gzip'ed (extension: .gz) or bzip2'ed (extension: .bz2)""")
 		help='# reads to use from input file(s) (use all)')
 	align.add_argument('-t', dest='threads', default=1,
 		help='Number of threads to use (1)')
+	align.add_argument('--input_bam', type=str, metavar='PATH',
+		help="""Use existing BAM/CRAM of reads aligned to MIDAS pangenomes instead of aligning reads.
+Reads are never realigned. Sorted and indexed input is read by region.""")
 	map = parser.add_argument_group('Quantify genes options (if using --call_genes)')
 	map.add_argument('--readq', type=int, metavar='INT',
 		default=20, help='Discard reads with mean quality < READQ (20)')
@@ -284,6 +290,12 @@ Can be gzip'ed (extension: .gz) or bzip2'ed (extension: .bz2)""")
 		default=0.75, help='Discard reads with alignment coverage < ALN_COV (0.75)')
 	map.add_argument('--trim', type=int, default=0, metavar='INT',
 		help='Trim N base-pairs from 3\'/right end of read (0)')
+	map.add_argument('--binary', default=False, action='store_true',
+		help="""Also write compact binary gene coverage files (False)
+output/{SPECIES_ID}.genes.npy is read by merge_midas.py genes without text parsing""")
+	map.add_argument('--refilter', default=False, action='store_true',
+		help="""Recompute gene coverage with new read filters from the alignment summary
+cached in temp/alignments.npz by a previous run, without reading the BAM file (False)""")
 	args = vars(parser.parse_args())
 	if args['species_id']: args['species_id'] = args['species_id'].split(',')
 	return args
@@ -311,6 +323,10 @@ def print_gene_arguments(args):
 			lines.append("  include all species with >=%sX genome coverage" % args['species_cov'])
 		if args['species_id']:
 			lines.append("  include specified species id(s): %s" % args['species_id'])
+		if args['shards'] > 1:
+			lines.append("  split bowtie2 database into %s shards" % args['shards'])
+	if args['input_bam']:
+		lines.append("Input alignments: %s" % args['input_bam'])
 	if args['align']:
 		lines.append("Read alignment options:")
 		if args['interleaved']: 
@@ -331,6 +347,8 @@ def print_gene_arguments(args):
 		lines.append("  minimum read quality score: %s" % args['readq'])
 		lines.append("  minimum mapping quality score: %s" % args['mapq'])
 		lines.append("  trim %s base-pairs from 3'/right end of read" % args['trim'])
+		if args['binary']: lines.append("  write binary gene coverage files")
+		if args['refilter']: lines.append("  recompute from cached alignment summary")
 	lines.append("================================")
 	args['log'].write('\n'.join(lines)+'\n')
 	sys.stdout.write('\n'.join(lines)+'\n')
@@ -380,6 +398,9 @@ Directory name should correspond to sample identifier""")
 		default=False, help='Align reads to pangenome database')
 	pipe.add_argument('--pileup', action='store_true', dest='call',
 		default=False, help='Run samtools mpileup and count 4 alleles across genome')
+	pipe.add_argument('--coverage_only', action='store_true', default=False,
+		help="""With --pileup (or the default pipeline), only compute genome coverage in summary.txt (False).
+Uses the same read filters, but no allele counts are written. Quick triage of samples""")
 	db = parser.add_argument_group('Database options (if using --build_db)')
 	db.add_argument('-d', type=str, dest='db', default=os.environ['MIDAS_DB'] if 'MIDAS_DB' in os.environ else None,
 		help="""Path to reference database
@@ -387,8 +408,14 @@ By default, the MIDAS_DB environmental variable is used""")
 	db.add_argument('--species_cov', type=float, dest='species_cov', metavar='FLOAT', help='Include species with >X coverage (3.0)')
 	db.add_argument('--species_topn', type=int, dest='species_topn', metavar='INT', help='Include top N most abundant species')
 	db.add_argument('--species_id', type=str, dest='species_id', metavar='CHAR', help='Include specified species. Separate ids with a comma')
+	db.add_argument('--shards', type=int, default=1, metavar='INT',
+		help="""Split bowtie2 database into INT size-balanced shards that are built and searched in parallel (1).
+Reads are assigned to the shard with the best alignment score. Use the same value with --align""")
+	db.add_argument('--db_index', action='store_true', default=False,
+		help="""Align reads to the prebuilt bowtie2 index of representative genomes in the reference database (False).
+Built once by build_midas_db.py --genome_index; only partitions with selected species are searched""")
 	align = parser.add_argument_group('Read alignment options (if using --align)')
-	align.add_argument('-1', type=str, dest='m1', required=True,
+	align.add_argument('-1', type=str, dest='m1',
 		help="""FASTA/FASTQ file containing 1st mate if using paired-end reads.
 Otherwise FASTA/FASTQ containing unpaired reads.
 Can be gzip'ed (extension: .gz) or bzip2'ed (extension: .bz2)""")
@@ -406,6 +433,9 @@ Can be gzip'ed (extension: .gz) or bzip2'ed (extension: .bz2)""")
 		help='Global/local read alignment (global)')
 	align.add_argument('-t', dest='threads', default=1, 
 		help='Number of threads to use (1)')
+	align.add_argument('--input_bam', type=str, metavar='PATH',
+		help="""Use existing BAM/CRAM of reads aligned to MIDAS representative genomes instead of aligning reads.
+Reads are never realigned. Unsorted input is sorted before the pileup.""")
 	snps = parser.add_argument_group('Pileup options (if using --pileup)')
 	snps.add_argument('--mapid', type=float, metavar='FLOAT',
 		default=94.0, help='Discard reads with alignment identity < MAPID (94.0)')
@@ -425,6 +455,27 @@ Can be gzip'ed (extension: .gz) or bzip2'ed (extension: .bz2)""")
 		help='Enable BAQ: per-base alignment quality (False)')
 	snps.add_argument('--adjust_mq', default=False, action='store_true',
 		help='Adjust MAPQ (False)')
+	snps.add_argument('--stream', default=False, action='store_true',
+		help="""Count alleles directly from unsorted alignments (False)
+With --align, reads are counted as bowtie2 reports them: no BAM file is sorted, indexed or written.
+Needs memory for 8 bytes per base-pair of the selected genomes; checked against available memory before counting""")
+	snps.add_argument('--keep_bam', default=False, action='store_true',
+		help='With --stream and --align, also write sorted alignments to temp/genomes.bam (False)')
+	snps.add_argument('--binary', default=False, action='store_true',
+		help="""Write allele counts to compact binary files instead of text (False)
+output/{SPECIES_ID}.snps.bin is read by merge_midas.py snps without text parsing""")
+	snps.add_argument('--sparse', default=False, action='store_true',
+		help="""Only write genome positions with at least 1 mapped read (False)
+Output files start with a format line and can be read by merge_midas.py snps""")
+	snps.add_argument('--max_depth', type=int, metavar='INT',
+		help="""Cap read depth at about INT (no cap). Reads at positions covered by more reads are randomly
+subsampled (fixed seed) before read filters; mates are kept or discarded together. Depth counts all
+alignments, including reads that read filters discard. aligned_reads in summary.txt also counts discarded
+reads, as without a cap; the cap is recorded in summary.txt""")
+	snps.add_argument('--sites', type=str, metavar='PATH',
+		help="""Only count alleles at known sites (use all positions).
+Tab-delimited file with header fields ref_id and ref_pos (1-based), e.g. snps_info.txt from merge_midas.py snps,
+or BED intervals without header: ref_id, start (0-based), end""")
 	args = vars(parser.parse_args())
 	if args['species_id']: args['species_id'] = args['species_id'].split(',')
 	return args
@@ -452,6 +503,12 @@ def print_snp_arguments(args):
 			lines.append("  include all species with >=%sX genome coverage" % args['species_cov'])
 		if args['species_id']:
 			lines.append("  include specified species id(s): %s" % args['species_id'])
+		if args['shards'] > 1:
+			lines.append("  split bowtie2 database into %s shards" % args['shards'])
+		if args['db_index']:
+			lines.append("  align to prebuilt bowtie2 database: %s/genome_index" % args['db'])
+	if args['input_bam']:
+		lines.append("Input alignments: %s" % args['input_bam'])
 	if args['align']:
 		lines.append("Read alignment options:")
 		if args['interleaved']: 
@@ -476,6 +533,13 @@ def print_snp_arguments(args):
 		if args['discard']: lines.append("  discard discordant read-pairs")
 		if args['baq']: lines.append("  enable BAQ (per-base alignment quality)")
 		if args['adjust_mq']: lines.append("  adjust MAPQ")
+		if args['stream']: lines.append("  count alleles from unsorted alignments")
+		if args['keep_bam']: lines.append("  keep sorted alignments")
+		if args['binary']: lines.append("  write binary allele count files")
+		if args['sparse']: lines.append("  only write covered genome positions")
+		if args['coverage_only']: lines.append("  only compute genome coverage; no allele counts are written")
+		if args['max_depth']: lines.append("  subsample reads to a depth of about %s" % args['max_depth'])
+		if args['sites']: lines.append("  only count alleles at known sites: %s" % args['sites'])
 	lines.append("================================")
 	args['log'].write('\n'.join(lines)+'\n')
 	sys.stdout.write('\n'.join(lines)+'\n')
@@ -492,6 +556,31 @@ def check_selected_species(args):
 			if not os.path.isdir(path):
 				sys.exit(error)
 
+def check_input_bam(args):
+	""" Check user-supplied BAM/CRAM """
+	if not args['input_bam']:
+		return
+	if not os.path.isfile(args['input_bam']):
+		sys.exit("\nError: Input file does not exist: '%s'\n" % args['input_bam'])
+	if args['input_bam'].split('.')[-1] not in ['bam', 'cram']:
+		sys.exit("\nError: --input_bam must be a BAM or CRAM file (extension: .bam or .cram)\n")
+	if args['align']:
+		sys.exit("\nError: Cannot specify --align together with --input_bam\n")
+	if not args['build_db'] and not os.path.isfile('%s/%s/species.txt' % (args['outdir'], args['program'])):
+		error = "\nError: You've specified --input_bam, but no species have been selected"
+		error += "\nTry running with --build_db\n"
+		sys.exit(error)
+
+def check_refilter(args):
+	""" Check that gene coverage can be recomputed from cached alignment summary """
+	if args['build_db'] or args['align']:
+		sys.exit("\nError: Cannot specify --build_db or --align together with --refilter\n")
+	if not os.path.isfile('%s/genes/temp/alignments.npz' % args['outdir']):
+		error = "\nError: You've specified --refilter, but no cached alignment summary was found"
+		error += "\nTry running with --call_genes first\n"
+		sys.exit(error)
+	args['cov'] = True
+
 def check_genes(args):
 	""" Check validity of command line arguments """
 	# check file type
@@ -504,10 +593,14 @@ def check_genes(args):
 	if not os.path.isdir('%s/genes' % args['outdir']):
 		os.makedirs('%s/genes' % args['outdir'])
 	# turn on pipeline options
-	if not any([args['build_db'], args['align'], args['cov']]):
+	if args['refilter']:
+		check_refilter(args)
+	elif not any([args['build_db'], args['align'], args['cov']]):
 		args['build_db'] = True
-		args['align'] = True
+		args['align'] = not args['input_bam']
 		args['cov'] = True
+	# check input alignments
+	check_input_bam(args)
 	# set default species selection
 	if not any([args['species_id'], args['species_topn'], args['species_cov']]):
 		args['species_cov'] = 3.0
@@ -525,9 +618,18 @@ Alternatively, you can manually specify one or more species using --species_id\n
 		error = "\nError: You've specified --align, but no database has been built"
 		error += "\nTry running with --build_db\n"
 		sys.exit(error)
+	if (args['align']
+		and not args['build_db']
+		and args['shards'] > 1
+		and not os.path.isfile('%s/genes/temp/shards.txt' % args['outdir'])):
+		error = "\nError: You've specified --shards, but no sharded database has been built"
+		error += "\nTry running with --build_db --shards %s\n" % args['shards']
+		sys.exit(error)
 	# no bamfile but --cov specified
 	if (args['cov']
 		and not args['align']
+		and not args['input_bam']
+		and not args['refilter']
 		and not os.path.isfile('%s/genes/temp/pangenomes.bam' % args['outdir'])):
 		error = "\nError: You've specified --call, but no alignments were found"
 		error += "\nTry running with --align\n"
@@ -567,8 +669,30 @@ def check_snps(args):
 	# pipeline options
 	if not any([args['build_db'], args['align'], args['call']]):
 		args['build_db'] = True
-		args['align'] = True
+		args['align'] = not args['input_bam']
 		args['call'] = True
+	if args['binary'] and args['sparse']:
+		sys.exit("\nError: Cannot specify --sparse together with --binary\n")
+	if args['keep_bam'] and not args['stream']:
+		sys.exit("\nError: --keep_bam can only be used with --stream\n")
+	if args['max_depth'] is not None and args['max_depth'] < 1:
+		sys.exit("\nError: --max_depth must be at least 1\n")
+	if args['coverage_only'] and args['stream']:
+		sys.exit("\nError: Cannot specify --coverage_only together with --stream\n")
+	if args['coverage_only'] and args['max_depth']:
+		sys.exit("\nError: Cannot specify --coverage_only together with --max_depth\n")
+	if args['max_depth'] and args['stream']:
+		sys.exit("\nError: Cannot specify --max_depth together with --stream\n")
+	if args['sites'] and not os.path.isfile(args['sites']):
+		sys.exit("\nError: Sites file does not exist: '%s'\n" % args['sites'])
+	if args['db_index'] and args['shards'] > 1:
+		sys.exit("\nError: Cannot specify --shards together with --db_index\n")
+	if args['db_index'] and args['align'] and not os.path.isfile('%s/genome_index/partitions.txt' % args['db']):
+		error = "\nError: You've specified --db_index, but no prebuilt bowtie2 database was found in %s" % args['db']
+		error += "\nTry running build_midas_db.py with --genome_index\n"
+		sys.exit(error)
+	# check input alignments
+	check_input_bam(args)
 	# set default species selection
 	if not any([args['species_id'], args['species_topn'], args['species_cov']]):
 		args['species_cov'] = 3.0
@@ -582,13 +706,22 @@ Alternatively, you can manually specify one or more species using --species_id\n
 	# no database but --align specified
 	if (args['align']
 		and not args['build_db']
+		and not args['db_index']
 		and not os.path.isfile('%s/snps/temp/genomes.fa' % args['outdir'])):
 		error = "\nError: You've specified --align, but no database has been built"
 		error += "\nTry running with --build_db\n"
 		sys.exit(error)
+	if (args['align']
+		and not args['build_db']
+		and args['shards'] > 1
+		and not os.path.isfile('%s/snps/temp/shards.txt' % args['outdir'])):
+		error = "\nError: You've specified --shards, but no sharded database has been built"
+		error += "\nTry running with --build_db --shards %s\n" % args['shards']
+		sys.exit(error)
 	# no bamfile but --call specified
 	if (args['call']
 		and not args['align']
+		and not args['input_bam']
 		and not os.path.isfile('%s/snps/temp/genomes.bam' % args['outdir'])
 		):
 		error = "\nError: You've specified --pileup, but no alignments were found"
@@ -597,6 +730,7 @@ Alternatively, you can manually specify one or more species using --species_id\n
 	# no genomes but --call specified
 	if (args['call']
 		and not args['build_db']
+		and not args['input_bam']
 		and not os.path.isfile('%s/snps/temp/genomes.fa' % args['outdir'])
 		):
 		error = "\nError: You've specified --pileup, but the no genome database was found"
@@ -685,6 +819,17 @@ output/{SPECIES_ID}.genes.gz
   coverage: average read-depth of gene_id based on aligned reads (# aligned bp / gene length in bp)
   copy_number: estimated copy-number of gene_id based on aligned reads (coverage of gene_id / median coverage of 15 universal single copy genes)
 
+output/{SPECIES_ID}.genes.npy (if run with --binary)
+  NumPy array with one record per gene with at least 1 mapped read
+  gene: row of gene_id in database file pan_genomes/{SPECIES_ID}/centroids.npy
+  reads, depth, copies: same as count_reads, coverage, and copy_number above
+  read by merge_midas.py genes if gene_table in output/{SPECIES_ID}.manifest matches centroids.npy of its database
+
+temp/alignments.npz
+  NumPy archive with one record per alignment to a selected gene, used by --refilter
+  references: reference names from the BAM header
+  alignments: ref (index into references), align_len, nm, qual_sum, mapq, query_len
+
 summary.txt
   species_id: species id
   pangenome_size: number of non-redundant genes in reference pan-genome
@@ -708,6 +853,7 @@ output
   directory of per-species output files
   files are tab-delimited, gzip-compressed, with header
   naming convention of each file is: {SPECIES_ID}.snps.gz
+  {SPECIES_ID}.snps.gz.idx lists byte offsets of blocks of rows, used by merge_midas.py snps to seek to sites
 species.txt
   list of species_ids included in local database
 summary.txt
@@ -730,6 +876,13 @@ output/{SPECIES_ID}.snps.gz
   count_c: count of C allele
   count_g: count of G allele
   count_t: count of T allele
+  if run with --sparse, positions with depth 0 are omitted and the file starts with the line:
+  ## format=midas_snps; version=2; layout=sparse
+  if run with --sites, only known sites are written (also omitting depth 0 with --sparse) and the format line has layout=sites
+
+output/{SPECIES_ID}.snps.bin (if run with --binary, instead of output/{SPECIES_ID}.snps.gz)
+  ACGT counts for every position of each contig in zlib-compressed blocks with a block index
+  read with midas.snp_counts.BinaryCountReader: fetch(contig_id, start, end) returns a NumPy array
 
 summary.txt
   species_id: species id
@@ -739,6 +892,7 @@ summary.txt
   mean_coverage: average read-depth across reference sites with at least 1 mapped read
   aligned_reads: number of aligned reads BEFORE quality filtering
   mapped_reads: number of aligned reads AFTER quality filtering
+  max_depth: depth cap (only if run with --max_depth)
   
 Additional information for each species can be found in the reference database:
  %s/rep_genomes
@@ -51,6 +51,9 @@ snp_diversity.py /path/to/snps --max_sites 10000  --out /path/to/output
 directory should be named according to a species_id and contains files 'snps_*.txt')""")
 	parser.add_argument('--out', metavar='PATH', type=str, default='/dev/stdout',
 		help="""path to output file (/dev/stdout)""")
+	parser.add_argument('--matrix', action='store_true', default=False,
+		help="""read the binary matrix store written by 'merge_midas.py snps --matrix' instead of 'snps_*.txt'
+allele frequencies in the store are not rounded to 3 digits, so results may differ slightly""")
 
 	diversity = parser.add_argument_group("Diversity options")
 	diversity.add_argument('--genomic_type', choices=['genome-wide', 'per-gene'], default='genome-wide',
@@ -372,7 +375,7 @@ if __name__ == '__main__':
 	print_args(args)
 
 	print("\nSelecting subset of samples...")
-	species = parse_snps.Species(args['indir'])
+	species = parse_snps.Species(args['indir'], args['matrix'])
 	samples = parse_snps.fetch_samples(species, args['sample_depth'], args['fract_cov'], args['max_samples'],
 						    		   args['keep_samples'], args['exclude_samples'], args['rand_samples'])
 	print(" %s samples selected" % len(samples))
@@ -68,6 +68,9 @@ Output fields:
 requires having run 'merge_midas.py snps'""")
 	parser.add_argument('--out', metavar='PATH', type=str, required=True,
 		help="""path to output file containing list of markers""")
+	parser.add_argument('--matrix', action='store_true', default=False,
+		help="""read the binary matrix store written by 'merge_midas.py snps --matrix' instead of 'snps_*.txt'
+allele frequencies in the store are not rounded to 3 digits, so results may differ slightly""")
 	parser.add_argument('--samples', metavar='PATH', type=str,
 		help="""comma-separated list of training samples\nby default, all samples are used""")
 	parser.add_argument('--min_freq', type=float, metavar='FLOAT', default=0.10,
@@ -116,6 +119,9 @@ Output fields:
 requires having run 'merge_midas.py snps'""")
 	parser.add_argument('--out', metavar='PATH', type=str,
 		help="""path to output file with marker sharing between all sample-pairs""")
+	parser.add_argument('--matrix', action='store_true', default=False,
+		help="""read the binary matrix store written by 'merge_midas.py snps --matrix' instead of 'snps_*.txt'
+allele frequencies in the store are not rounded to 3 digits, so results may differ slightly""")
 	parser.add_argument('--markers', metavar='PATH', type=str,
 		help="""path to list of marker alleles output by 'strain_tracking.py id_markers'""")
 	parser.add_argument('--min_freq', type=float, metavar='FLOAT', default=0.10,
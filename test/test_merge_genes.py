@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+from midas import utility
+from midas.run import genes as run_genes
+from midas.merge import genes as merge_genes, merge
+
+MARKERS = ['B000032', 'B000039', 'B000041']
+
+def make_pangenome(db, species_id, num_genes=60, extra_genes=0, seed=1):
+	""" Pangenome of species with gene clusters, marker genes and gene table; return gene ids, lengths and marker ids
+		extra_genes: genes added to the pangenome, which shift rows of the gene table
+	"""
+	random = np.random.RandomState(seed)
+	gene_ids = ['%s.peg.%s' % (species_id, i) for i in random.permutation(num_genes)]
+	gene_ids += ['%s.rna.%s' % (species_id, i) for i in range(extra_genes)]
+	lengths = [int(_) for _ in random.randint(100, 2000, len(gene_ids))]
+	marker_ids = [MARKERS[i % 3] if i < 9 else None for i in range(len(gene_ids))]
+	dir = '%s/pan_genomes/%s' % (db, species_id)
+	if not os.path.isdir(dir): os.makedirs(dir)
+	with open('%s/gene_info.txt' % dir, 'w') as file:
+		file.write('gene_id\tcentroid_99\tcentroid_95\tcentroid_90\n')
+		for i, gene_id in enumerate(gene_ids):
+			file.write('%s\t%s\t%s\t%s\n' % (gene_id, gene_id, gene_ids[i - i % 3], gene_ids[i - i % 5]))
+	with open('%s/centroids.ffn' % dir, 'w') as file:
+		for gene_id, length in zip(gene_ids, lengths):
+			file.write('>%s\n%s\n' % (gene_id, ''.join(random.choice(list('ACGT'), length))))
+	utility.write_gene_table('%s/centroids.npy' % dir, gene_ids, lengths, marker_ids, MARKERS)
+	return gene_ids, lengths, marker_ids
+
+def write_sample(db, outdir, species_id, seed=2):
+	""" Outputs of run_midas.py genes --binary with random coverage of genes of species """
+	random = np.random.RandomState(seed)
+	sp = run_genes.Species(species_id)
+	sp.init_ref_db(db)
+	genes = run_genes.GeneTable([sp])
+	covered = random.rand(genes.size) < 0.7
+	genes.mapped_reads[:] = covered * random.randint(1, 50, genes.size)
+	genes.depth[:] = covered * random.rand(genes.size) * 5
+	genes.copies[:] = genes.depth / 1.7
+	for field in run_genes.SUMMARY_FIELDS[2:]:
+		setattr(sp, field, 0)
+	os.makedirs('%s/genes/output' % outdir)
+	args = {'outdir': outdir, 'threads': 1, 'binary': True, 'coverage_input': ''}
+	run_genes.write_results(args, {species_id: sp}, genes)
+	run_genes.write_summary(args, {species_id: sp})
+
+class BinaryGenes(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.db = '%s/db' % self.dir
+		make_pangenome(self.db, 'sp')
+		write_sample(self.db, '%s/sample' % self.dir, 'sp')
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def merge(self, binary):
+		""" Gene matrices of sample: from the binary sidecar if it is used, or from text output """
+		sp = merge.Species('sp', {'sp': {'rep_genome': 'g1'}}, {'g1': {}})
+		sp.samples = [merge.Sample('%s/sample' % self.dir, 'genes')]
+		merge_genes.read_cluster_map(sp, self.db, '95')
+		self.assertEqual(merge_genes.read_binary_genes(sp, sp.samples[0]) is not None, binary)
+		merge_genes.build_gene_matrices(sp, min_copy=0.35)
+		return sp.samples[0].genes
+
+	def assertSameGenes(self, binary, text):
+		self.assertEqual(sorted(binary['reads'].items()), sorted(text['reads'].items()))
+		self.assertEqual(sorted(binary['presabs'].items()), sorted(text['presabs'].items()))
+		for field in ['copynum', 'depth']:
+			self.assertEqual(sorted(binary[field]), sorted(text[field]))
+			for gene_id, value in text[field].items():
+				self.assertAlmostEqual(binary[field][gene_id], value, places=5)
+
+	def test_same_as_text(self):
+		binary = self.merge(True)
+		self.assertEqual(len(binary['reads']), 20)
+		os.remove('%s/sample/genes/output/sp.genes.npy' % self.dir)
+		self.assertSameGenes(binary, self.merge(False))
+
+	def test_other_gene_table(self):
+		""" Rows of the sidecar are not used with another gene table in the database """
+		expected = self.merge(True)
+		make_pangenome(self.db, 'sp', extra_genes=3)
+		self.assertSameGenes(expected, self.merge(False))
+
+	def test_without_manifest(self):
+		os.remove('%s/sample/genes/output/sp.manifest' % self.dir)
+		self.merge(False)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,523 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import shutil
+import tempfile
+import csv
+import numpy as np
+from operator import itemgetter
+from midas import utility, snp_counts, snp_matrix, site_annotation
+from midas.analyze import parse_snps
+from midas.merge import snps as merge_snps, snps_store
+from test_snp_counts import write_text
+import test_snp_counts
+
+def reference_site(counts, snp_freq, mean_depths, min_depth, max_ratio):
+	""" Allele calls and per-sample statistics of one site (samples x 4), as computed site by site before SiteBlock """
+	pooled_counts = [sum([sample[i] for sample in counts]) for i in range(4)]
+	pooled_depth = sum(pooled_counts)
+	site = {'major': None, 'minor': None, 'snp_type': None}
+	if pooled_depth > 0:
+		alleles = list('ACGT')
+		freqs = [float(count)/pooled_depth for count in pooled_counts]
+		allele_freqs = sorted(zip(alleles, freqs), key=itemgetter(1), reverse=True)
+		if allele_freqs[0][1] > 0:
+			site['major'] = allele_freqs[0][0]
+		if allele_freqs[1][1] > 0:
+			site['minor'] = allele_freqs[1][0]
+		for snp_type, (allele, freq) in zip(['quad', 'tri', 'bi', 'mono'], allele_freqs[::-1]):
+			if freq >= snp_freq:
+				site['snp_type'] = snp_type
+				break
+	if site['major'] is None:
+		site['mafs'], site['depths'] = [0.0]*len(counts), [0]*len(counts)
+	elif site['minor'] is None:
+		site['mafs'], site['depths'] = [0.0]*len(counts), [sample['ACGT'.index(site['major'])] for sample in counts]
+	else:
+		site['mafs'], site['depths'] = [], []
+		for sample in counts:
+			depth = sample['ACGT'.index(site['major'])] + sample['ACGT'.index(site['minor'])]
+			site['mafs'].append(float(sample['ACGT'.index(site['minor'])])/depth if depth > 0 else 0.0)
+			site['depths'].append(depth)
+	site['count_samples'] = sum([1 for mean_depth, depth in zip(mean_depths, site['depths'])
+		if depth >= min_depth and not depth/mean_depth > max_ratio])
+	site['prevalence'] = site['count_samples']/float(len(counts))
+	return site
+
+def random_counts(sites, samples, seed):
+	""" Counts (sites x samples x 4) with ties, single alleles and sites without reads """
+	random = np.random.RandomState(seed)
+	counts = random.randint(0, 6, size=(sites, samples, 4))
+	counts[random.rand(sites) < 0.2] = 0
+	counts[random.rand(sites) < 0.2, :, 1:] = 0
+	counts[random.rand(sites, samples) < 0.3] = 0
+	return counts
+
+class SiteBlockCalls(unittest.TestCase):
+	def setUp(self):
+		self.counts = random_counts(500, 6, 1)
+		self.mean_depths = [1.5, 2.0, 0.5, 3.0, 1.0, 10.0]
+
+	def block(self, counts, pooled_counts=None):
+		return merge_snps.SiteBlock(101, 'c1', 11, 'A'*counts.shape[0], counts, pooled_counts)
+
+	def test_same_as_reference(self):
+		for snp_freq, min_depth, max_ratio in [(0.01, 1, 2.0), (0.2, 2, 5.0), (0.5, 0, 1.0)]:
+			block = self.block(self.counts)
+			block.call_alleles(snp_freq)
+			block.compute_per_sample_mafs()
+			block.compute_prevalence(self.mean_depths, min_depth, max_ratio)
+			alleles = ['A', 'C', 'G', 'T', None]
+			for i, counts in enumerate(self.counts.tolist()):
+				site = reference_site(counts, snp_freq, self.mean_depths, min_depth, max_ratio)
+				self.assertEqual(alleles[block.major_index[i]], site['major'])
+				self.assertEqual(alleles[block.minor_index[i]], site['minor'])
+				self.assertEqual(merge_snps.SNP_TYPES[block.snp_type[i]], site['snp_type'])
+				self.assertEqual(block.sample_depths[i].tolist(), site['depths'])
+				self.assertEqual(block.sample_mafs[i].tolist(), site['mafs'])
+				self.assertEqual(block.count_samples[i], site['count_samples'])
+				self.assertEqual(block.prevalence[i], site['prevalence'])
+			freqs = block.format_samples('freq', np.arange(len(self.counts)))
+			self.assertEqual(freqs[0], ''.join(['\t{0:.3g}'.format(maf) for maf in block.sample_mafs[0].tolist()]))
+
+	def test_flag(self):
+		block = self.block(self.counts)
+		block.call_alleles(0.1)
+		block.compute_per_sample_mafs()
+		block.compute_prevalence(self.mean_depths, 1, 2.0)
+		for min_prev, snp_types in [(0.0, ['any']), (0.5, ['any']), (0.0, ['bi', 'tri']), (0.3, ['mono'])]:
+			block.flag(min_prev, snp_types)
+			for i in range(len(self.counts)):
+				snp_type = merge_snps.SNP_TYPES[block.snp_type[i]]
+				keep = block.prevalence[i] >= min_prev and ('any' in snp_types or snp_type in snp_types)
+				self.assertEqual(block.keep[i], keep)
+
+	def test_pooled_counts(self):
+		""" Alleles are called from pooled counts of all samples when the block only has some of them """
+		full = self.block(self.counts)
+		part = self.block(self.counts[:, 4:], self.counts.sum(axis=1))
+		for block in [full, part]:
+			block.call_alleles(0.01)
+			block.compute_per_sample_mafs()
+		self.assertTrue((full.major_index == part.major_index).all())
+		self.assertTrue((full.minor_index == part.minor_index).all())
+		self.assertTrue((full.sample_mafs[:, 4:] == part.sample_mafs).all())
+		self.assertTrue((full.sample_depths[:, 4:] == part.sample_depths).all())
+
+def reference_annotation(genes, ref_id, ref_pos):
+	""" Annotation of one site as computed site by site before site_annotation; sites must be visited in order
+		genes: utility.read_genes; returns locus_type, gene_id, site_type, amino_acids
+	"""
+	while True:
+		if genes['index'] >= len(genes['list']):
+			return 'IGR', None, None, None
+		gene = genes['list'][genes['index']]
+		if ref_id < gene['scaffold_id'] or (ref_id == gene['scaffold_id'] and ref_pos < gene['start']):
+			return 'IGR', None, None, None
+		if ref_id > gene['scaffold_id'] or (ref_id == gene['scaffold_id'] and ref_pos > gene['end']):
+			genes['index'] += 1
+			continue
+		if gene['gene_type'] != 'CDS' or len(gene['seq']) % 3 != 0:
+			return gene['gene_type'], gene['gene_id'], None, None
+		gene_pos = ref_pos - gene['start'] if gene['strand'] == '+' else gene['end'] - ref_pos
+		codon_pos = gene_pos % 3
+		codon = gene['seq'][gene_pos-codon_pos:gene_pos-codon_pos+3]
+		if not all([_ in ['A', 'T', 'C', 'G'] for _ in codon]):
+			return gene['gene_type'], gene['gene_id'], None, None
+		amino_acids = [utility.translate(utility.index_replace(codon, allele, codon_pos, gene['strand'])) for allele in 'ACGT']
+		return gene['gene_type'], gene['gene_id'], '%sD' % (4 - len(set(amino_acids)) + 1), ','.join(amino_acids)
+
+def make_genome(db, species_id, seed=1):
+	""" Representative genome of species with overlapping, nested and partial genes on both strands; return contigs """
+	random = np.random.RandomState(seed)
+	contigs = {'c1': 900, 'c2': 400, 'c10': 300}
+	genome = dict([(contig_id, ''.join(random.choice(list('ACGTACGTACGTN'), length))) for contig_id, length in contigs.items()])
+	genes = [('g1', 'c1', 1, 300, '+', 'CDS'), ('g2', 'c1', 250, 450, '-', 'CDS'), ('g3', 'c1', 280, 340, '+', 'CDS'),
+		('g4', 'c1', 500, 601, '-', 'CDS'), ('g5', 'c1', 610, 700, '+', 'rRNA'), ('g6', 'c1', 705, 900, '+', 'CDS'),
+		('g7', 'c2', 10, 99, '-', 'CDS'), ('g8', 'c2', 10, 60, '+', 'CDS'), ('g9', 'c10', 100, 129, '+', 'tRNA')]
+	dir = '%s/rep_genomes/%s' % (db, species_id)
+	os.makedirs(dir)
+	with open('%s/genome.fna' % dir, 'w') as file:
+		file.write(''.join(['>%s\n%s\n' % (contig_id, seq) for contig_id, seq in sorted(genome.items())]))
+	with open('%s/genome.features' % dir, 'w') as file:
+		file.write('gene_id\tscaffold_id\tstart\tend\tstrand\tgene_type\n')
+		file.write(''.join(['%s\t%s\t%s\t%s\t%s\t%s\n' % gene for gene in genes]))
+	return genome
+
+class Annotation(unittest.TestCase):
+	def setUp(self):
+		self.db = tempfile.mkdtemp()
+		self.genome = make_genome(self.db, 'sp')
+
+	def tearDown(self):
+		shutil.rmtree(self.db)
+
+	def test_same_as_reference(self):
+		path = site_annotation.annotation_file(self.db, 'sp', self.db)
+		annotation = site_annotation.read_annotation(path)
+		offsets, genome_length = snp_counts.genome_offsets(self.genome)
+		columns = list(zip(*site_annotation.annotate_sites(annotation, range(1, genome_length+1))))
+		genes = utility.read_genes('sp', self.db)
+		for contig_id in sorted(self.genome):
+			for ref_pos in range(1, len(self.genome[contig_id])+1):
+				expected = reference_annotation(genes, contig_id, ref_pos)
+				self.assertEqual(columns[offsets[contig_id]+ref_pos-1], expected, msg='%s:%s' % (contig_id, ref_pos))
+
+	def test_rebuilt_when_source_changes(self):
+		path = site_annotation.annotation_file(self.db, 'sp', self.db)
+		self.assertEqual(site_annotation.annotation_file(self.db, 'sp', self.db), path)
+		key = site_annotation.source_key(self.db, 'sp')
+		with open('%s/rep_genomes/sp/genome.features' % self.db, 'a') as file:
+			file.write('g10\tc10\t1\t30\t+\tCDS\n')
+		self.assertNotEqual(site_annotation.source_key(self.db, 'sp'), key)
+		annotation = site_annotation.read_annotation(site_annotation.annotation_file(self.db, 'sp', self.db))
+		self.assertTrue('g10' in annotation['gene_ids'])
+
+	def test_cache(self):
+		""" Annotation of a database that is not writable is kept in cachedir and reused until the source changes """
+		cachedir = tempfile.mkdtemp(dir=self.db)
+		access = os.access
+		os.access = lambda path, mode: False
+		try:
+			path = site_annotation.annotation_file(self.db, 'sp', cachedir)
+		finally:
+			os.access = access
+		self.assertEqual(path, '%s/annotation.npz' % cachedir)
+		self.assertFalse(os.path.exists(site_annotation.annotation_path(self.db, 'sp')))
+		with np.load(path) as data:
+			self.assertEqual(str(data['source']), site_annotation.source_key(self.db, 'sp'))
+		mtime = os.stat(path).st_mtime_ns
+		self.assertEqual(site_annotation.annotation_file(self.db, 'sp', cachedir), path)
+		self.assertEqual(os.stat(path).st_mtime_ns, mtime)
+		os.utime('%s/rep_genomes/sp/genome.fna' % self.db, (0, 0))
+		self.assertEqual(site_annotation.annotation_file(self.db, 'sp', cachedir), site_annotation.annotation_path(self.db, 'sp'))
+
+def make_db(db, species_id):
+	""" Database with one species and its representative genome (see make_genome); return contigs """
+	genome = make_genome(db, species_id)
+	with open('%s/species_info.txt' % db, 'w') as file:
+		file.write('species_id\trep_genome\tcount_genomes\n%s\tg1\t1\n' % species_id)
+	with open('%s/genome_info.txt' % db, 'w') as file:
+		file.write('genome_id\tspecies_id\trep_genome\tlength\tcontigs\n')
+		file.write('g1\t%s\t1\t%s\t%s\n' % (species_id, sum([len(seq) for seq in genome.values()]), len(genome)))
+	return genome
+
+def make_sample(dir, species_id, genome, seed):
+	""" Output of run_midas.py snps for species: dense or sparse text allele counts, or binary, depending on seed """
+	random = np.random.RandomState(seed)
+	contigs = dict([(contig_id, test_snp_counts.random_counts(len(seq), seed, high=int(random.randint(2, 30))))
+		for contig_id, seq in genome.items()])
+	os.makedirs('%s/snps/output' % dir)
+	basepath = '%s/snps/output/%s' % (dir, species_id)
+	if seed % 3 == 2:
+		writer = snp_counts.BinaryCountWriter(basepath+'.snps.bin')
+		for contig_id in sorted(contigs):
+			writer.write_contig(contig_id, contigs[contig_id])
+		writer.close()
+	else:
+		write_text(basepath+'.snps.gz', contigs, ['dense', 'sparse'][seed % 3])
+	genome_length = sum([len(seq) for seq in genome.values()])
+	depth = sum([counts.sum() for counts in contigs.values()])
+	covered = sum([(counts.sum(axis=0) > 0).sum() for counts in contigs.values()])
+	with open('%s/snps/summary.txt' % dir, 'w') as file:
+		file.write('species_id\tgenome_length\tcovered_bases\tfraction_covered\tmean_coverage\taligned_reads\tmapped_reads\n')
+		file.write('%s\t%s\t%s\t%s\t%s\t%s\t%s\n' % (species_id, genome_length, covered, float(covered)/genome_length,
+			float(depth)/covered, depth//100, depth//100))
+
+class MergeTest(unittest.TestCase):
+	""" Merges of a species with 1600 sites in several tasks and samples with text and binary allele counts """
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.db = '%s/db' % self.dir
+		os.makedirs(self.db)
+		self.genome = make_db(self.db, 'sp')
+		self.samples = ['%s/samples/s%s' % (self.dir, seed) for seed in range(7)]
+		for seed, sample in enumerate(self.samples):
+			make_sample(sample, 'sp', self.genome, seed)
+		self.min_task_sites = merge_snps.MIN_TASK_SITES
+		merge_snps.MIN_TASK_SITES = 500
+
+	def tearDown(self):
+		merge_snps.MIN_TASK_SITES = self.min_task_sites
+		shutil.rmtree(self.dir)
+
+	def merge(self, outdir, samples, **kwargs):
+		""" Run merge_midas.py snps; return contents of its text outputs """
+		args = {'outdir': '%s/%s' % (self.dir, outdir), 'db': self.db, 'indirs': samples, 'species_id': None,
+			'max_samples': None, 'sample_depth': 0.0, 'fract_cov': 0.0, 'min_samples': 1, 'max_species': None,
+			'threads': 2, 'max_sites': float('inf'), 'allele_freq': 0.01, 'site_depth': 1, 'site_ratio': 2.0,
+			'site_prev': 0.0, 'snp_type': ['any'], 'cluster_pid': '95', 'min_copy': 0.35, 'incremental': False, 'matrix': None}
+		args.update(kwargs)
+		if not os.path.isdir(args['outdir']): os.makedirs(args['outdir'])
+		merge_snps.run_pipeline(args)
+		return dict([(ftype, open('%s/sp/snps_%s.txt' % (args['outdir'], ftype)).read()) for ftype in ['info', 'freq', 'depth', 'summary']])
+
+	def assertSameOutputs(self, outputs, expected):
+		for ftype in ['info', 'freq', 'depth', 'summary']:
+			self.assertEqual(outputs[ftype], expected[ftype], msg=ftype)
+
+class MergePlan(MergeTest):
+	def test_bounds(self):
+		""" Every level merges consecutive ranges covering its inputs, and no more than max_open inputs are read at once """
+		for num_samples in [1, 2, 3, 10, 17, 100, 1000]:
+			for max_open in [2, 3, 16, 1000]:
+				for memory in [2**40, merge_snps.READER_MEMORY*5]:
+					num_inputs, fan_in = num_samples, min(max_open, memory//merge_snps.READER_MEMORY)
+					for groups in merge_snps.merge_plan(num_samples, 1000, max_open, memory):
+						self.assertEqual(groups[0][0], 0)
+						self.assertEqual(groups[-1][1], num_inputs)
+						self.assertTrue(all([end == start for (_, end), (start, _) in zip(groups[:-1], groups[1:])]))
+						self.assertTrue(all([1 <= last - first <= fan_in for first, last in groups]))
+						# readers of count matrices of later levels are small
+						num_inputs, fan_in = len(groups), max_open
+					self.assertTrue(num_inputs <= max_open)
+
+	def test_same_as_single_level(self):
+		""" Merges with few open files, in several levels, give the same outputs """
+		expected = self.merge('full', self.samples)
+		max_open_files = utility.max_open_files
+		try:
+			for max_open, levels in [(2, 2), (3, 1)]:
+				utility.max_open_files = lambda threads, reserved=0: max_open
+				self.assertEqual(len(merge_snps.merge_plan(len(self.samples), 1000, max_open, 2**40)), levels)
+				self.assertSameOutputs(self.merge('levels', self.samples), expected)
+				self.merge('incremental', self.samples[:3], incremental=True)
+				self.assertSameOutputs(self.merge('incremental', self.samples, incremental=True), expected)
+				shutil.rmtree('%s/incremental' % self.dir)
+		finally:
+			utility.max_open_files = max_open_files
+
+class IncrementalMerge(MergeTest):
+	def setUp(self):
+		MergeTest.setUp(self)
+		self.row_block = snps_store.ROW_BLOCK
+		snps_store.ROW_BLOCK = 7 # rows of previous merge are found from several indexed rows per task
+
+	def tearDown(self):
+		snps_store.ROW_BLOCK = self.row_block
+		MergeTest.tearDown(self)
+
+	def test_same_as_full(self):
+		for kwargs in [{}, {'site_depth': 3, 'site_prev': 0.6, 'allele_freq': 0.22, 'snp_type': ['mono', 'bi', 'tri']}]:
+			for count in [2, 3, 7]:
+				full = self.merge('full', self.samples[:count], **kwargs)
+				self.assertSameOutputs(self.merge('incremental', self.samples[:count], incremental=True, **kwargs), full)
+			shutil.rmtree('%s/incremental' % self.dir)
+
+	def test_rerun_sample(self):
+		self.merge('incremental', self.samples[:4], incremental=True)
+		shutil.rmtree(self.samples[1])
+		make_sample(self.samples[1], 'sp', self.genome, 8)
+		full = self.merge('full', self.samples[:5])
+		self.assertSameOutputs(self.merge('incremental', self.samples[:5], incremental=True), full)
+
+	def test_removed_sample(self):
+		self.merge('incremental', self.samples[:4], incremental=True)
+		samples = self.samples[:1] + self.samples[2:5]
+		self.assertSameOutputs(self.merge('incremental', samples, incremental=True), self.merge('full', samples))
+
+	def test_params_change(self):
+		self.merge('incremental', self.samples[:4], incremental=True)
+		self.assertSameOutputs(self.merge('incremental', self.samples, incremental=True, allele_freq=0.2),
+			self.merge('full', self.samples, allele_freq=0.2))
+
+class MatrixStore(MergeTest):
+	""" Binary matrix store of merge_midas.py snps --matrix, in several chunks per task, against the text outputs """
+	def setUp(self):
+		MergeTest.setUp(self)
+		self.chunk_sites = snp_matrix.CHUNK_SITES
+		snp_matrix.CHUNK_SITES = 100
+		self.outputs = self.merge('out', self.samples, matrix='float32', site_depth=3, site_prev=0.6)
+		self.species_dir = '%s/out/sp' % self.dir
+		self.matrix = snp_matrix.SnpMatrix(snp_matrix.matrix_dir(self.species_dir))
+		self.info = list(csv.DictReader(open('%s/snps_info.txt' % self.species_dir), delimiter='\t'))
+		self.tables = {}
+		for ftype in ['freq', 'depth']:
+			rows = [line.split('\t') for line in self.outputs[ftype].splitlines()]
+			self.tables[ftype] = (rows[0][1:], np.array([[int(row[0])] + [float(_) for _ in row[1:]] for row in rows[1:]]))
+
+	def tearDown(self):
+		snp_matrix.CHUNK_SITES = self.chunk_sites
+		MergeTest.tearDown(self)
+
+	def expected(self, ftype, site_from, site_to, columns):
+		""" Values of text output for sites site_from <= site_id < site_to and samples at column indexes """
+		table = self.tables[ftype][1]
+		rows = (table[:, 0] >= (site_from or 0)) & (table[:, 0] < (site_to or float('inf')))
+		return table[rows][:, [1+i for i in columns]]
+
+	def assertSameValues(self, ftype, values, expected):
+		self.assertEqual(values.shape, expected.shape)
+		if ftype == 'depth':
+			self.assertTrue((values == expected).all())
+		else:
+			# snps_freq.txt is rounded to 3 significant digits
+			self.assertTrue(np.allclose(values, expected, rtol=0, atol=5.01e-4))
+
+	def test_same_as_text(self):
+		self.assertEqual(self.matrix.sample_ids, self.tables['freq'][0])
+		self.assertEqual(self.matrix.num_sites, len(self.info))
+		self.assertTrue(len(self.matrix.names) > 2)
+		self.assertEqual(snp_matrix.info_rows(self.matrix.info()), self.info)
+		for ftype in ['freq', 'depth']:
+			self.assertSameValues(ftype, self.matrix.fetch(ftype), self.expected(ftype, None, None, range(len(self.samples))))
+
+	def test_sites_and_samples(self):
+		for site_from, site_to in [(None, 101), (150, 900), (899, 903), (1500, None), (500, 500), (1601, None)]:
+			info = [row for row in self.info if (site_from or 0) <= int(row['site_id']) < (site_to or float('inf'))]
+			self.assertEqual(snp_matrix.info_rows(self.matrix.info(site_from, site_to)), info)
+			for samples, columns in [(None, range(len(self.samples))), (['s3', 's0'], [3, 0]), ([6, 2], [6, 2])]:
+				chunks = list(self.matrix.chunks(site_from, site_to, samples))
+				for ftype, i in [('freq', 1), ('depth', 2)]:
+					expected = self.expected(ftype, site_from, site_to, columns)
+					self.assertSameValues(ftype, self.matrix.fetch(ftype, site_from, site_to, samples), expected)
+					if len(chunks) > 0:
+						self.assertSameValues(ftype, np.concatenate([chunk[i] for chunk in chunks]), expected)
+				self.assertEqual(snp_matrix.info_rows(np.concatenate([chunk[0] for chunk in chunks])) if chunks else [], info)
+
+	def test_parse_snps(self):
+		""" Sites read by parse_snps from the store are those read from the text outputs """
+		text, matrix = parse_snps.Species(self.species_dir), parse_snps.Species(self.species_dir, True)
+		self.assertEqual(matrix.sample_ids, text.sample_ids)
+		count = 0
+		for (info, freqs, depths), (matrix_info, matrix_freqs, matrix_depths) in zip(text.rows, matrix.rows):
+			self.assertEqual(matrix_info, info)
+			self.assertEqual(matrix_depths, [int(_) for _ in depths])
+			self.assertTrue(np.allclose(matrix_freqs, [float(_) for _ in freqs], rtol=0, atol=5.01e-4))
+			count += 1
+		self.assertEqual(count, len(self.info))
+		self.assertRaises(StopIteration, next, matrix.rows)
+
+	def test_removed_without_matrix(self):
+		self.merge('out', self.samples)
+		self.assertFalse(os.path.isdir(snp_matrix.matrix_dir(self.species_dir)))
+		self.assertRaises(SystemExit, parse_snps.Species, self.species_dir, True)
+
+class AppendFile(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.data = np.random.RandomState(1).bytes(3*2**20+17)
+		with open('%s/in' % self.dir, 'wb') as file:
+			file.write(self.data)
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def check(self):
+		""" Bytes from each start offset follow buffered writes before them, and precede writes after them """
+		for start in [0, 1, 2**20+5, len(self.data)-1, len(self.data)]:
+			with open('%s/out' % self.dir, 'wb') as file:
+				file.write(b'header\n')
+			with open('%s/out' % self.dir, 'ab') as outfile:
+				outfile.write(b'before\n')
+				utility.append_file(outfile, '%s/in' % self.dir, start)
+				outfile.write(b'after\n')
+			self.assertEqual(open('%s/out' % self.dir, 'rb').read(), b'header\nbefore\n' + self.data[start:] + b'after\n')
+
+	def test_append(self):
+		self.check()
+
+	def test_short_copies(self):
+		""" Kernel copies may copy fewer bytes than requested """
+		if not hasattr(os, 'copy_file_range'):
+			self.skipTest('no os.copy_file_range')
+		copy_file_range = os.copy_file_range
+		os.copy_file_range = lambda fd_in, fd_out, count, offset: copy_file_range(fd_in, fd_out, min(count, 4099), offset)
+		try:
+			self.check()
+		finally:
+			os.copy_file_range = copy_file_range
+
+	def test_without_kernel_copy(self):
+		""" Bytes are copied through python when the file system supports no kernel copy """
+		def unsupported(*args):
+			raise OSError('not supported')
+		functions = dict([(name, getattr(os, name)) for name in ['copy_file_range', 'sendfile'] if hasattr(os, name)])
+		for name in functions:
+			setattr(os, name, unsupported)
+		try:
+			self.check()
+		finally:
+			for name, function in functions.items():
+				setattr(os, name, function)
+
+def logged_task(path, name, seconds=0.05):
+	""" Task of Schedule tests: log start and end of task name to path """
+	import time
+	with open(path, 'a') as file:
+		file.write('start\t%s\n' % name)
+	time.sleep(seconds)
+	if name == 'error':
+		raise ValueError(name)
+	with open(path, 'a') as file:
+		file.write('end\t%s\n' % name)
+	return name
+
+class Schedule(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.log = '%s/log' % self.dir
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def phases(self, tasks, received):
+		""" Generator of phases: tasks is a list of phases, each a list of (name, cost, memory); results are added to received """
+		for phase in tasks:
+			received.append((yield [(logged_task, (self.log, name), cost, memory) for name, cost, memory in phase]))
+
+	def events(self):
+		return [line.rstrip('\n').split('\t') for line in open(self.log)]
+
+	def test_order(self):
+		""" Ready tasks start largest cost first, then in order of phases; results are sent in order of tasks, [] for empty phases """
+		received = [[], []]
+		generators = [self.phases([[('a', 1, 0), ('b', 3, 0), ('c', 2, 0)], [('d', 1, 0)], []], received[0]),
+			self.phases([[('e', 2, 0)], [('f', 5, 0)]], received[1])]
+		merge_snps.schedule(generators, 1, 100)
+		starts = [name for event, name in self.events() if event == 'start']
+		self.assertEqual(starts, ['b', 'c', 'e', 'f', 'a', 'd'])
+		self.assertEqual(received, [[['a', 'b', 'c'], ['d'], []], [['e'], ['f']]])
+
+	def test_memory(self):
+		""" Tasks start while their estimated memory fits in the budget; a task over budget runs alone """
+		memory = {'a': 6, 'b': 6, 'c': 3, 'd': 1, 'e': 20, 'f': 4, 'g': 4}
+		tasks = [[(name, 10-i, memory[name]) for i, name in enumerate(sorted(memory))]]
+		merge_snps.schedule([self.phases(tasks, [])], 3, 10)
+		running, concurrent = set(), []
+		for event, name in self.events():
+			if event == 'start':
+				running.add(name)
+				concurrent.append(sorted(running))
+				self.assertTrue(len(running) == 1 or sum([memory[_] for _ in running]) <= 10, msg=str(running))
+			else:
+				running.remove(name)
+		self.assertTrue(['e'] in concurrent)
+		self.assertTrue(max([len(names) for names in concurrent]) == 3)
+
+	def test_error(self):
+		""" Errors of tasks are raised by schedule """
+		self.assertRaises(ValueError, merge_snps.schedule, [self.phases([[('a', 1, 0), ('error', 1, 0)]], [])], 2, 10)
+
+class ShardedTables(MergeTest):
+	def test_threads(self):
+		""" Outputs concatenated from the sharded tables of any number of tasks are the same """
+		expected = self.merge('1', self.samples, threads=1)
+		for threads in [2, 3]:
+			self.assertSameOutputs(self.merge(str(threads), self.samples, threads=threads), expected)
+
+	def test_row_index(self):
+		""" Rows of a previous incremental merge are found in outputs concatenated from shards of another number of tasks """
+		row_block = snps_store.ROW_BLOCK
+		snps_store.ROW_BLOCK = 5
+		try:
+			expected = self.merge('full', self.samples, threads=1)
+			self.merge('incremental', self.samples[:3], incremental=True, threads=3)
+			self.merge('incremental', self.samples[:5], incremental=True, threads=1)
+			self.assertSameOutputs(self.merge('incremental', self.samples, incremental=True, threads=2), expected)
+		finally:
+			snps_store.ROW_BLOCK = row_block
+
+if __name__ == '__main__':
+	unittest.main()
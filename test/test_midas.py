@@ -58,7 +58,7 @@ class _03_CheckVersions(unittest.TestCase):
 	def setUp(self):
 		self.modules = ['numpy', 'pandas', 'pysam', 'Bio.SeqIO']
 		self.installeds = [module.__version__ for module in map(__import__, self.modules)]
-		self.requireds = ['1.7.0', '0.17.1', '0.8.1', '1.6.2']
+		self.requireds = ['1.15.0', '0.17.1', '0.8.1', '1.6.2']
 		
 	def test_class(self):
 		for module, installed, required in zip(self.modules, self.installeds, self.requireds):
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+import pysam
+from collections import defaultdict
+from midas import utility
+from midas.run import genes as run_genes
+from test_merge_genes import make_pangenome
+
+def make_bam(path, pangenomes, num_reads=500, seed=1):
+	""" Unsorted BAM of reads aligned to genes of pangenomes with mismatches, clips, indels, low qualities and secondary alignments """
+	random = np.random.RandomState(seed)
+	references = [(gene_id, length) for species_id in sorted(pangenomes) for gene_id, length in zip(*pangenomes[species_id][:2])]
+	header = {'HD': {'VN': '1.0', 'SO': 'unsorted'}, 'SQ': [{'SN': gene_id, 'LN': length} for gene_id, length in references]}
+	cigars = [[(0, 100)], [(4, 10), (0, 90)], [(0, 40), (1, 2), (0, 58)], [(4, 30), (0, 60), (4, 10)]]
+	with pysam.AlignmentFile(path, 'wb', header=header) as file:
+		for i in range(num_reads):
+			# reads are concentrated on a few genes, so that genes have a range of depths
+			tid = int(min(random.zipf(1.5) - 1, len(references) - 1)) if random.rand() < 0.5 else random.randint(len(references))
+			aln = pysam.AlignedSegment()
+			aln.query_name = 'r%s' % i
+			aln.query_sequence = ''.join(random.choice(list('ACGT'), 100))
+			aln.flag = int(random.choice([0, 16, 0, 16, 256]))
+			aln.reference_id = tid
+			aln.reference_start = int(random.randint(references[tid][1] - 100))
+			aln.mapping_quality = int(random.choice([0, 10, 30, 42, 42]))
+			aln.cigartuples = cigars[random.randint(len(cigars))]
+			aln.query_qualities = pysam.qualitystring_to_array(''.join(random.choice(list('?I5+#'), 100)))
+			aln.set_tag('NM', int(random.choice([0, 1, 2, 3, 10])))
+			file.write(aln)
+
+def reference_coverage(path, pangenomes, args):
+	""" Coverage of genes and summary of species, as computed read by read before GeneTable
+		pangenomes: species_id -> (gene_ids, lengths, marker_ids)
+		returns gene_id -> [count_reads, coverage, copy_number] and species_id -> summary fields
+	"""
+	gene_info = {}
+	for species_id, (gene_ids, lengths, marker_ids) in pangenomes.items():
+		for gene_id, length, marker_id in zip(gene_ids, lengths, marker_ids):
+			gene_info[gene_id] = (species_id, length, marker_id)
+	genes = dict([(gene_id, [0, 0.0, 0.0]) for gene_id in gene_info])
+	species = dict([(species_id, {'pangenome_size': len(pangenomes[species_id][0]), 'aligned_reads': 0, 'mapped_reads': 0}) for species_id in pangenomes])
+	with pysam.AlignmentFile(path) as bamfile:
+		for aln in bamfile.fetch(until_eof=True):
+			gene_id = bamfile.get_reference_name(aln.reference_id)
+			species_id, length, marker_id = gene_info[gene_id]
+			species[species_id]['aligned_reads'] += 1
+			align_len = len(aln.query_alignment_sequence)
+			if (100*(align_len-dict(aln.tags)['NM'])/float(align_len) < args['mapid']
+				or np.mean(aln.query_qualities) < args['readq']
+				or aln.mapping_quality < args['mapq']
+				or align_len/float(aln.query_length) < args['aln_cov']):
+				continue
+			species[species_id]['mapped_reads'] += 1
+			genes[gene_id][0] += 1
+			genes[gene_id][1] += align_len/float(length)
+	for species_id, sp in species.items():
+		gene_ids, lengths, marker_ids = pangenomes[species_id]
+		covered = [genes[gene_id][1] for gene_id in gene_ids if genes[gene_id][1] > 0]
+		sp['covered_genes'] = len(covered)
+		sp['mean_coverage'] = np.mean(covered) if len(covered) > 0 else 0
+		sp['fraction_covered'] = len(covered)/float(sp['pangenome_size'])
+		markers = defaultdict(float)
+		for gene_id, marker_id in zip(gene_ids, marker_ids):
+			if marker_id is not None: markers[marker_id] += genes[gene_id][1]
+		sp['marker_coverage'] = np.median(list(markers.values()))
+		for gene_id in gene_ids:
+			if sp['marker_coverage'] > 0: genes[gene_id][2] = genes[gene_id][1]/sp['marker_coverage']
+	return genes, species
+
+class RunGenesTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.db = '%s/db' % self.dir
+		self.pangenomes = {'s1': make_pangenome(self.db, 's1', 60, seed=1), 's2': make_pangenome(self.db, 's2', 40, seed=2)}
+		# markers of other species shift marker codes of gene tables built from phyeco.map
+		os.makedirs('%s/marker_genes' % self.db)
+		with open('%s/marker_genes/phyeco.map' % self.db, 'w') as file:
+			file.write('gene_id\tmarker_id\n')
+			file.write('s0.peg.1\tB000001\n')
+			for gene_ids, lengths, marker_ids in self.pangenomes.values():
+				for gene_id, marker_id in zip(gene_ids, marker_ids):
+					if marker_id is not None: file.write('%s\t%s\n' % (gene_id, marker_id))
+		os.makedirs('%s/genes/temp' % self.dir)
+		os.makedirs('%s/genes/output' % self.dir)
+		make_bam('%s/genes/temp/pangenomes.bam' % self.dir, self.pangenomes)
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def species(self):
+		species = {}
+		for species_id in sorted(self.pangenomes):
+			species[species_id] = run_genes.Species(species_id)
+			species[species_id].init_ref_db(self.db)
+		return species
+
+	def args(self, **kwargs):
+		args = {'db': self.db, 'outdir': self.dir, 'input_bam': None, 'bam_index': None, 'refilter': False, 'binary': False,
+			'threads': 1, 'coverage_input': '', 'mapid': 94.0, 'readq': 20, 'mapq': 0, 'aln_cov': 0.75}
+		args.update(kwargs)
+		return args
+
+	def coverage(self, args):
+		""" Rows of genes output and summary of species computed by run_midas.py genes """
+		species = self.species()
+		genes = run_genes.initialize_genes(args, species)
+		if args['input_bam']:
+			run_genes.check_input_bam(args, genes)
+			run_genes.prepare_input_bam(args)
+		run_genes.pangenome_coverage(args, species, genes, species)
+		run_genes.write_summary(args, species)
+		rows = {}
+		for species_id in species:
+			for r in utility.parse_file('%s/genes/output/%s.genes.gz' % (self.dir, species_id)):
+				rows[r['gene_id']] = [int(r['count_reads']), float(r['coverage']), float(r['copy_number'])]
+		summary = dict([(r['species_id'], r) for r in utility.parse_file('%s/genes/summary.txt' % self.dir)])
+		return rows, summary
+
+	def assertSameCoverage(self, coverage, expected):
+		rows, summary = coverage
+		genes, species = expected
+		self.assertEqual(sorted(rows), sorted(genes))
+		for gene_id, values in genes.items():
+			self.assertEqual(rows[gene_id][0], values[0])
+			for value, expected_value in zip(rows[gene_id][1:], values[1:]):
+				self.assertAlmostEqual(value, expected_value, places=10)
+		self.assertEqual(sorted(summary), sorted(species))
+		for species_id, fields in species.items():
+			for field, value in fields.items():
+				if field in ['pangenome_size', 'covered_genes', 'aligned_reads', 'mapped_reads']:
+					self.assertEqual(int(summary[species_id][field]), value, msg=field)
+				else:
+					self.assertAlmostEqual(float(summary[species_id][field]), value, places=10, msg=field)
+
+class GeneTable(RunGenesTest):
+	def test_build_gene_table(self):
+		""" Gene table built from centroids.ffn and phyeco.map is sorted by gene_id, with codes of markers in the database """
+		marker_map = utility.read_marker_map(self.db)
+		marker_list = sorted(set(marker_map.values()))
+		for species_id, sp in self.species().items():
+			os.remove(sp.paths['centroids.npy'])
+			run_genes.build_gene_table({'outdir': self.dir}, sp, marker_map)
+			table = utility.read_gene_table(sp.paths['centroids.npy'])
+			gene_ids, lengths, marker_ids = self.pangenomes[species_id]
+			order = sorted(range(len(gene_ids)), key=lambda i: gene_ids[i])
+			self.assertEqual(table['gene_id'].astype(str).tolist(), [gene_ids[i] for i in order])
+			self.assertEqual(table['length'].tolist(), [lengths[i] for i in order])
+			self.assertEqual(table['marker'].tolist(), [marker_list.index(marker_ids[i]) if marker_ids[i] else -1 for i in order])
+		self.assertEqual(marker_list[0], 'B000001')
+
+	def test_lookup(self):
+		""" Rows of species are contiguous, in order of species; names are looked up across species """
+		species = self.species()
+		genes = run_genes.initialize_genes({'db': self.db, 'outdir': self.dir}, species)
+		self.assertEqual([(sp.start, sp.end, sp.pangenome_size) for sp in species.values()], [(0, 60, 60), (60, 100, 40)])
+		names = self.pangenomes['s2'][0][:5] + ['s3.peg.0'] + self.pangenomes['s1'][0][-5:]
+		rows = genes.lookup(names)
+		self.assertEqual(rows[5], -1)
+		ids = np.concatenate(genes.gene_ids).astype(str)
+		self.assertEqual(ids[rows[rows >= 0]].tolist(), names[:5] + names[6:])
+		self.assertEqual(genes.species[rows[:5]].tolist(), [1]*5)
+		lengths = dict(zip(self.pangenomes['s1'][0] + self.pangenomes['s2'][0], self.pangenomes['s1'][1] + self.pangenomes['s2'][1]))
+		self.assertEqual(genes.length.tolist(), [lengths[gene_id] for gene_id in ids])
+
+class Coverage(RunGenesTest):
+	def test_same_as_reference(self):
+		""" Coverage of genes and species summary are those computed read by read """
+		path = '%s/genes/temp/pangenomes.bam' % self.dir
+		for kwargs in [{}, {'mapid': 0, 'readq': 0, 'mapq': 0, 'aln_cov': 0}, {'mapid': 98.0, 'mapq': 30, 'aln_cov': 0.9}]:
+			args = self.args(**kwargs)
+			expected = reference_coverage(path, self.pangenomes, args)
+			self.assertTrue(0 < sum([sp['mapped_reads'] for sp in expected[1].values()]) <= 500)
+			self.assertSameCoverage(self.coverage(args), expected)
+
+	def test_keep_reads(self):
+		""" Each filter of keep_reads keeps alignments at its threshold """
+		alns = np.zeros(4, dtype=run_genes.ALIGNMENT_DTYPE)
+		alns['align_len'], alns['query_len'], alns['nm'], alns['qual_sum'], alns['mapq'] = 100, 100, 0, 3000, 30
+		alns['nm'][0], alns['qual_sum'][1], alns['mapq'][2], alns['align_len'][3] = 6, 2000, 20, 75
+		self.assertEqual(run_genes.keep_reads(alns, 94.0, 20, 20, 0.75).tolist(), [True]*4)
+		for i, thresholds in enumerate([(94.01, 20, 20, 0.75), (94.0, 20.01, 20, 0.75), (94.0, 20, 21, 0.75), (94.0, 20, 20, 0.76)]):
+			self.assertEqual(run_genes.keep_reads(alns, *thresholds).tolist(), [j != i for j in range(4)])
+
+	def test_refilter(self):
+		""" With --refilter, coverage is recomputed with new filters from the alignment summary, without the BAM """
+		path = '%s/genes/temp/pangenomes.bam' % self.dir
+		expected = reference_coverage(path, self.pangenomes, self.args(mapid=98.0, readq=25))
+		self.coverage(self.args())
+		os.remove(path)
+		self.assertSameCoverage(self.coverage(self.args(mapid=98.0, readq=25, refilter=True)), expected)
+
+	def test_chunks(self):
+		""" Alignment summary collected in several chunks is the same """
+		summary = run_genes.summarize_alignments(self.args(), run_genes.initialize_genes(self.args(), self.species()))
+		alignment_chunk = run_genes.ALIGNMENT_CHUNK
+		run_genes.ALIGNMENT_CHUNK = 7
+		try:
+			chunks = run_genes.summarize_alignments(self.args(), run_genes.initialize_genes(self.args(), self.species()))
+		finally:
+			run_genes.ALIGNMENT_CHUNK = alignment_chunk
+		self.assertEqual(summary[0].tolist(), chunks[0].tolist())
+		self.assertTrue(len(summary[1]) == 500 and (summary[1] == chunks[1]).all())
+		references, alns = run_genes.read_alignments(self.args())
+		self.assertTrue((alns == summary[1]).all())
+
+class InputBam(RunGenesTest):
+	def setUp(self):
+		RunGenesTest.setUp(self)
+		# input aligned to a database with another species, which is not selected
+		pangenomes = dict(self.pangenomes, s3=make_pangenome('%s/other' % self.dir, 's3', 30, seed=3))
+		make_bam('%s/unsorted.bam' % self.dir, pangenomes, num_reads=800)
+		pysam.sort('-o', '%s/sorted.bam' % self.dir, '%s/unsorted.bam' % self.dir)
+		pysam.index('%s/sorted.bam' % self.dir)
+		# primary alignments to selected species, for reference_coverage
+		with pysam.AlignmentFile('%s/unsorted.bam' % self.dir) as infile:
+			with pysam.AlignmentFile('%s/primary.bam' % self.dir, 'wb', template=infile) as outfile:
+				for aln in infile.fetch(until_eof=True):
+					if utility.is_primary(aln) and not aln.reference_name.startswith('s3.'):
+						outfile.write(aln)
+
+	def test_primary(self):
+		""" Only primary alignments to selected species are counted, the same from unsorted and from sorted, indexed input """
+		expected = reference_coverage('%s/primary.bam' % self.dir, self.pangenomes, self.args())
+		for name, indexed in [('unsorted', False), ('sorted', True)]:
+			args = self.args(input_bam='%s/%s.bam' % (self.dir, name))
+			self.assertSameCoverage(self.coverage(args), expected)
+			self.assertEqual(args['bam_index'] is not None, indexed)
+
+	def test_fetch_alignments(self):
+		""" Alignments to selected genes are fetched by region from indexed input; unindexed input is read in full """
+		genes = run_genes.initialize_genes(self.args(), self.species())
+		with pysam.AlignmentFile('%s/unsorted.bam' % self.dir) as bamfile:
+			s1 = len([aln for aln in bamfile.fetch(until_eof=True) if aln.reference_name.startswith('s1.')])
+		for name, index, expected in [('unsorted', None, 800), ('sorted', '%s/sorted.bam.bai' % self.dir, s1)]:
+			with utility.open_bam('%s/%s.bam' % (self.dir, name), index=index) as bamfile:
+				rows = genes.lookup(bamfile.references)
+				rows[genes.species[np.maximum(rows, 0)] != 0] = -1 # select genes of s1
+				names = [aln.reference_name for aln in run_genes.fetch_alignments({'bam_index': index}, bamfile, rows)]
+			self.assertEqual(len(names), expected)
+		self.assertTrue(all([name.startswith('s1.') for name in names]))
+
+	def test_other_references(self):
+		""" Input aligned to pangenomes of other species or to genes of other lengths is rejected """
+		run_genes.check_input_bam(self.args(input_bam='%s/sorted.bam' % self.dir), run_genes.initialize_genes(self.args(), self.species()))
+		make_pangenome(self.db, 's2', 45, seed=2)
+		genes = run_genes.initialize_genes(self.args(), self.species())
+		self.assertRaises(SystemExit, run_genes.check_input_bam, self.args(input_bam='%s/sorted.bam' % self.dir), genes)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,488 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import shutil
+import tempfile
+import io
+import gzip
+import numpy as np
+import pysam
+from midas import utility
+from midas.run import snps
+
+CONTIGS = [('c1', 's1', 3000), ('c2', 's1', 1500), ('c3', 's2', 2000)]
+
+def make_bam(dir, num_reads=3000, seed=1):
+	""" Sorted, indexed BAM of random reads with mismatches, Ns, clips, indels, low qualities and secondary alignments """
+	random = np.random.RandomState(seed)
+	genomes = dict([(contig_id, ''.join(random.choice(list('ACGT'), length))) for contig_id, species_id, length in CONTIGS])
+	header = {'HD': {'VN': '1.0', 'SO': 'unsorted'}, 'SQ': [{'SN': contig_id, 'LN': length} for contig_id, species_id, length in CONTIGS]}
+	cigars = [[(0, 100)], [(4, 10), (0, 90)], [(0, 40), (1, 2), (0, 30), (2, 3), (0, 28)], [(0, 60), (3, 50), (0, 40)]]
+	with pysam.AlignmentFile('%s/unsorted.bam' % dir, 'wb', header=header) as file:
+		for i in range(num_reads):
+			tid = random.randint(len(CONTIGS))
+			contig_id, species_id, length = CONTIGS[tid]
+			start = random.randint(length - 160)
+			bases = list(genomes[contig_id][start:start+100])
+			for j in np.flatnonzero(random.rand(100) < 0.02):
+				bases[j] = random.choice(list('ACGTN'))
+			aln = pysam.AlignedSegment()
+			aln.query_name = 'r%s' % i
+			aln.query_sequence = ''.join(bases)
+			aln.flag = int(random.choice([0, 16, 0, 16, 256]))
+			aln.reference_id = int(tid)
+			aln.reference_start = int(start)
+			aln.mapping_quality = int(random.choice([0, 10, 30, 42, 42]))
+			aln.cigartuples = cigars[random.randint(len(cigars))]
+			aln.query_qualities = pysam.qualitystring_to_array(''.join(random.choice(list('?I5+#'), 100)))
+			aln.set_tag('NM', int(random.choice([0, 1, 2, 3, 10])))
+			file.write(aln)
+	pysam.sort('-o', '%s/sorted.bam' % dir, '%s/unsorted.bam' % dir)
+	pysam.index('%s/sorted.bam' % dir)
+
+def make_contigs():
+	contigs = {}
+	for contig_id, species_id, length in CONTIGS:
+		contig = snps.Contig(contig_id)
+		contig.length = length
+		contig.species_id = species_id
+		contigs[contig_id] = contig
+	return contigs
+
+class RunSnpsTest(unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.dir = tempfile.mkdtemp()
+		make_bam(cls.dir)
+		# alignments of run_midas.py snps, used without --input_bam (secondary alignments are not skipped)
+		os.makedirs('%s/snps/temp/pileup' % cls.dir)
+		shutil.copy('%s/sorted.bam' % cls.dir, '%s/snps/temp/genomes.bam' % cls.dir)
+		shutil.copy('%s/sorted.bam.bai' % cls.dir, '%s/snps/temp/genomes.bam.bai' % cls.dir)
+		cls.contigs = make_contigs()
+		cls.species = dict([(species_id, snps.Species(species_id)) for contig_id, species_id, length in CONTIGS])
+
+	@classmethod
+	def tearDownClass(cls):
+		shutil.rmtree(cls.dir)
+
+	def args(self, **kwargs):
+		args = {'input_bam': '%s/sorted.bam' % self.dir, 'input_sorted': True, 'bam_index': None, 'outdir': self.dir,
+			'mapid': 94.0, 'readq': 20, 'mapq': 20, 'aln_cov': 0.75, 'baseq': 30, 'binary': True, 'sparse': False,
+			'max_depth': None, 'threads': 1}
+		args.update(kwargs)
+		return args
+
+	def pileup(self, args, contig_id, size=None):
+		""" Allele counts (4 x contig length) and stats of task_pileup over windows of size (one window if None) covering contig """
+		length = self.contigs[contig_id].length
+		size = size or length
+		windows = [(contig_id, start, min(length, start+size)) for start in range(0, length, size)]
+		species_id, stats = snps.task_pileup(args, self.contigs[contig_id].species_id, 0, snps.pileup_windows(windows, self.contigs, None, {}))
+		counts = np.load(snps.task_path(args, species_id, 0))
+		os.remove(snps.task_path(args, species_id, 0))
+		return counts, stats
+
+class StreamCounts(RunSnpsTest):
+	def test_same_as_pileup(self):
+		for kwargs in [{}, {'mapid': 0, 'readq': 0, 'mapq': 0, 'aln_cov': 0, 'baseq': 0}, {'input_bam': None}]:
+			args = self.args(**kwargs)
+			pileup = dict([(contig_id, self.pileup(args, contig_id)) for contig_id in self.contigs])
+			with utility.open_bam('%s/unsorted.bam' % self.dir) as bamfile:
+				counts, stats = snps.stream_counts(args, bamfile, self.species, self.contigs)
+			for contig_id in self.contigs:
+				self.assertTrue((counts[contig_id] == pileup[contig_id][0]).all())
+			for species_id in self.species:
+				for key in ['aligned_reads', 'mapped_reads']:
+					total = sum([pileup[contig_id][1][key] for contig_id in self.contigs if self.contigs[contig_id].species_id == species_id])
+					self.assertEqual(stats[species_id][key], total)
+
+	def test_batches(self):
+		args = self.args()
+		with utility.open_bam('%s/unsorted.bam' % self.dir) as bamfile:
+			counts, stats = snps.stream_counts(args, bamfile, self.species, self.contigs)
+		stream_batch = snps.STREAM_BATCH
+		snps.STREAM_BATCH = 7
+		try:
+			with utility.open_bam('%s/unsorted.bam' % self.dir) as bamfile:
+				batch_counts, batch_stats = snps.stream_counts(args, bamfile, self.species, self.contigs)
+		finally:
+			snps.STREAM_BATCH = stream_batch
+		self.assertEqual(stats, batch_stats)
+		for contig_id in self.contigs:
+			self.assertTrue((counts[contig_id] == batch_counts[contig_id]).all())
+
+	def test_overflow(self):
+		counts = {'c1': np.zeros((4, 10), dtype=np.uint16)}
+		snps.add_counts(counts, 'c1', np.array([1]*(2**16-1) + [2]), np.array([3]*(2**16-1) + [9]))
+		self.assertEqual((counts['c1'].dtype, counts['c1'][1, 3], counts['c1'][2, 9]), (np.uint16, 2**16-1, 1))
+		snps.add_counts(counts, 'c1', np.array([1]), np.array([3]))
+		self.assertEqual((counts['c1'].dtype, counts['c1'][1, 3], counts['c1'].sum()), (np.uint32, 2**16, 2**16+1))
+
+	def test_memory(self):
+		available_memory = utility.available_memory
+		utility.available_memory = lambda: 8*6500 - 1
+		try:
+			self.assertRaises(SystemExit, snps.stream_memory, self.contigs)
+		finally:
+			utility.available_memory = available_memory
+		snps.stream_memory(self.contigs)
+
+def make_paired_bam(path, seed=1):
+	""" Sorted, indexed BAM of read pairs on contig p1 (20 kb)
+		80 pairs with one mate at 1000 and the other at 1200+100*i, then deep pairs with nearby mates and
+		secondary alignments from 10 kb on
+	"""
+	random = np.random.RandomState(seed)
+	genome = ''.join(random.choice(list('ACGT'), 20000))
+	pairs = [(1000, 1200+100*i) for i in range(80)]
+	for i in range(3000):
+		start = int(random.randint(10000, 19500))
+		pairs.append((start, int(min(19900, start + random.randint(-300, 400)))))
+	alns = []
+	for i, (start, mate_start) in enumerate(pairs):
+		for first, (pos, mate_pos) in enumerate([(start, mate_start), (mate_start, start)]):
+			aln = pysam.AlignedSegment()
+			aln.query_name = 'p%s' % i
+			aln.query_sequence = genome[pos:pos+100]
+			aln.flag = 0x1 | (0x40 if first == 0 else 0x80) | (0x100 if i >= 80 and random.rand() < 0.2 else 0)
+			aln.reference_id = 0
+			aln.reference_start = pos
+			aln.next_reference_id = 0
+			aln.next_reference_start = mate_pos
+			aln.mapping_quality = 42
+			aln.cigartuples = [(0, 100)]
+			aln.query_qualities = pysam.qualitystring_to_array('I'*100)
+			aln.set_tag('NM', 0)
+			alns.append(aln)
+	alns.sort(key=lambda aln: aln.reference_start)
+	with pysam.AlignmentFile(path, 'wb', header={'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': 'p1', 'LN': 20000}]}) as file:
+		for aln in alns:
+			file.write(aln)
+	pysam.index(path)
+
+class CappedCounts(RunSnpsTest):
+	@classmethod
+	def setUpClass(cls):
+		RunSnpsTest.setUpClass()
+		cls.dir, cls.contigs = RunSnpsTest.dir, dict(RunSnpsTest.contigs)
+		make_paired_bam('%s/paired.bam' % cls.dir)
+		contig = snps.Contig('p1')
+		contig.length, contig.species_id = 20000, 's3'
+		cls.contigs['p1'] = contig
+
+	@classmethod
+	def tearDownClass(cls):
+		RunSnpsTest.tearDownClass()
+
+	def setUp(self):
+		self.stream_batch = snps.STREAM_BATCH
+
+	def tearDown(self):
+		snps.STREAM_BATCH = self.stream_batch
+
+	def test_below_cap(self):
+		""" Counts and stats are exact when max_depth is not below depth """
+		for kwargs in [{}, {'input_bam': None}, {'input_bam': '%s/paired.bam' % self.dir}]:
+			args = self.args(**kwargs)
+			for contig_id in ['c1', 'c3'] if args['input_bam'] != '%s/paired.bam' % self.dir else ['p1']:
+				counts, stats = self.pileup(self.args(max_depth=10**6, **kwargs), contig_id)
+				expected_counts, expected_stats = self.pileup(args, contig_id)
+				self.assertTrue((counts == expected_counts).all())
+				self.assertEqual(stats, expected_stats)
+
+	def test_stats(self):
+		""" aligned_reads counts primary alignments whether they are kept or not, as without a cap """
+		for kwargs in [{}, {'input_bam': None}]:
+			args = self.args(**kwargs)
+			for contig_id in ['c1', 'c3']:
+				expected_counts, expected_stats = self.pileup(args, contig_id)
+				counts, stats = self.pileup(self.args(max_depth=5, **kwargs), contig_id)
+				self.assertEqual(stats['aligned_reads'], expected_stats['aligned_reads'])
+				self.assertTrue(0 < stats['mapped_reads'] < expected_stats['mapped_reads'])
+				self.assertTrue((counts <= expected_counts).all())
+				self.assertTrue(counts.sum(axis=0).mean() < expected_counts.sum(axis=0).mean())
+
+	def test_windows(self):
+		""" Kept reads do not depend on how contigs are split into windows, nor on batches of reads """
+		for contig_id, kwargs in [('c1', {}), ('p1', {'input_bam': '%s/paired.bam' % self.dir}), ('p1', {'input_bam': None})]:
+			if kwargs.get('input_bam', '') is None:
+				shutil.copy('%s/paired.bam' % self.dir, '%s/snps/temp/genomes.bam' % self.dir)
+				shutil.copy('%s/paired.bam.bai' % self.dir, '%s/snps/temp/genomes.bam.bai' % self.dir)
+			args = self.args(max_depth=20, **kwargs)
+			counts, stats = self.pileup(args, contig_id)
+			for size, stream_batch in [(1000, 100000), (None, 50), (2500, 7)]:
+				snps.STREAM_BATCH = stream_batch
+				window_counts, window_stats = self.pileup(args, contig_id, size)
+				self.assertEqual(window_stats, stats)
+				self.assertTrue((window_counts == counts).all())
+		shutil.copy('%s/sorted.bam' % self.dir, '%s/snps/temp/genomes.bam' % self.dir)
+		shutil.copy('%s/sorted.bam.bai' % self.dir, '%s/snps/temp/genomes.bam.bai' % self.dir)
+
+	def test_mates(self):
+		""" Mates are kept or skipped together, also when they are in other windows than the leftmost mate """
+		args = self.args(max_depth=10, input_bam='%s/paired.bam' % self.dir)
+		for size, stream_batch in [(None, 100000), (1150, 100000), (2000, 3)]:
+			snps.STREAM_BATCH = stream_batch
+			counts = self.pileup(args, 'p1', size)[0].sum(axis=0)
+			kept = [counts[1200+100*i:1300+100*i].min() for i in range(80)]
+			self.assertTrue(set(kept) <= set([0, 1]))
+			self.assertTrue(0 < sum(kept) < 40)
+			self.assertEqual(counts[1000], sum(kept))
+
+class CoverageOnly(RunSnpsTest):
+	def coverage(self, args, windows, sites=None):
+		""" Total stats of task_coverage over tasks, each a list of (contig_id, start, end) windows """
+		totals, last_end = dict([(key, 0) for key in snps.STATS]), {}
+		for task_num, task in enumerate(windows):
+			species_id = self.contigs[task[0][0]].species_id
+			stats = snps.task_coverage(args, species_id, task_num, snps.pileup_windows(task, self.contigs, sites, last_end))[1]
+			for key in snps.STATS:
+				totals[key] += stats[key]
+		return totals
+
+	def test_same_as_pileup(self):
+		for kwargs in [{}, {'mapid': 0, 'readq': 0, 'mapq': 0, 'aln_cov': 0, 'baseq': 0}, {'input_bam': None}]:
+			args = self.args(**kwargs)
+			for contig_id, contig in self.contigs.items():
+				self.assertEqual(self.coverage(args, [[(contig_id, 0, contig.length)]]), self.pileup(args, contig_id)[1])
+
+	def test_windows(self):
+		""" Reads overlapping several windows are counted once """
+		args = self.args()
+		with pysam.AlignmentFile('%s/sorted.bam' % self.dir) as bamfile:
+			primary = len([aln for aln in bamfile.fetch('c1') if utility.is_primary(aln)])
+		whole = self.coverage(args, [[('c1', 0, 3000)]])
+		self.assertEqual(whole['aligned_reads'], primary)
+		for size in [7, 100, 1000]:
+			windows = [('c1', start, min(3000, start+size)) for start in range(0, 3000, size)]
+			self.assertEqual(self.coverage(args, [windows]), whole)
+			self.assertEqual(self.coverage(args, [[window] for window in windows]), whole)
+
+	def test_sites(self):
+		args = self.args()
+		sites = {'c1': np.arange(5, 3000, 7)}
+		windows = snps.pileup_windows([('c1', 0, 3000)], self.contigs, sites, {})
+		expected = snps.task_pileup(args, 's1', 0, windows)[1]
+		os.remove(snps.task_path(args, 's1', 0))
+		self.assertEqual(self.coverage(args, [[('c1', 0, 1000), ('c1', 1000, 3000)]], sites), expected)
+
+	def test_tasks(self):
+		""" Windows of pileup_tasks cover each contig once, in order """
+		args = self.args(threads=4)
+		tasks = snps.pileup_tasks(args, self.species, self.contigs)
+		for contig_id, contig in self.contigs.items():
+			windows = [(start, end) for species_id, windows in tasks for window_id, start, end in windows if window_id == contig_id]
+			self.assertEqual(windows[0][0], 0)
+			self.assertEqual(windows[-1][1], contig.length)
+			self.assertTrue(all([end == start for (_, end), (start, _) in zip(windows[:-1], windows[1:])]))
+
+class ChunkWriter:
+	""" Collects chunks written by write_pileup, in place of snp_counts.TextCountWriter """
+	def __init__(self):
+		self.chunks = []
+
+	def write(self, text, contig_id, ref_pos):
+		self.chunks.append((contig_id, ref_pos, text))
+
+def reference_pileup(contig, depth, counts, sparse, offset=0, sites=None):
+	""" Rows of write_pileup, as written position by position before rows were formatted in bulk """
+	rows = []
+	for i in (range(len(depth)) if sites is None else sites):
+		if sparse and depth[i] == 0:
+			continue
+		row = [contig.id, offset+i+1, contig.seq[offset+i], depth[i], counts[0][i], counts[1][i], counts[2][i], counts[3][i]]
+		rows.append('\t'.join([str(_) for _ in row])+'\n')
+	return rows
+
+class WritePileup(unittest.TestCase):
+	def setUp(self):
+		random = np.random.RandomState(1)
+		self.contig = snps.Contig('c1')
+		self.contig.length = 2500
+		self.contig.seq = ''.join(random.choice(list('ACGTN'), self.contig.length))
+		self.counts = random.randint(0, 300, (4, self.contig.length)) * (random.rand(self.contig.length) < 0.6)
+		self.depth = self.counts.sum(axis=0)
+
+	def check(self, sparse, offset=0, end=None, sites=None, chunk_size=100000):
+		end = end or self.contig.length
+		depth, counts = self.depth[offset:end], self.counts[:, offset:end]
+		out_file = ChunkWriter()
+		snps.write_pileup(out_file, self.contig, depth, counts, sparse, offset, sites, chunk_size)
+		rows = reference_pileup(self.contig, depth, counts, sparse, offset, sites)
+		self.assertEqual(''.join([text for contig_id, ref_pos, text in out_file.chunks]), ''.join(rows))
+		# chunks of at most chunk_size rows, each indexed by its first position
+		self.assertEqual(len(out_file.chunks), (len(rows) + chunk_size - 1)//chunk_size)
+		for i, (contig_id, ref_pos, text) in enumerate(out_file.chunks):
+			self.assertEqual((contig_id, ref_pos), ('c1', int(rows[i*chunk_size].split('\t')[1])))
+			self.assertEqual(text.count('\n'), min(chunk_size, len(rows) - i*chunk_size))
+
+	def test_dense(self):
+		self.check(False)
+		self.check(False, 700, 1700)
+
+	def test_sparse(self):
+		self.check(True)
+		self.check(True, 700, 1700)
+
+	def test_sites(self):
+		sites = np.array([0, 3, 4, 5, 250, 251, 999])
+		for sparse in [False, True]:
+			self.check(sparse, sites=sites)
+			self.check(sparse, 1000, 2000, sites=sites)
+
+	def test_chunks(self):
+		""" Rows of a contig longer than chunk_size are written in several chunks """
+		for chunk_size in [1, 7, 300, 2499]:
+			self.check(False, chunk_size=chunk_size)
+			self.check(True, 700, 1700, chunk_size=chunk_size)
+		self.check(False, sites=np.arange(0, 2500, 3), chunk_size=100)
+
+class ReadSites(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.contigs = make_contigs()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def read_sites(self, text, name='sites.txt'):
+		path = '%s/%s' % (self.dir, name)
+		with (gzip.open(path, 'wt') if name.endswith('.gz') else open(path, 'w')) as file:
+			file.write(text)
+		sites = snps.read_sites(path, self.contigs)
+		return dict([(contig_id, positions.tolist()) for contig_id, positions in sites.items()])
+
+	def test_header(self):
+		""" Tab-delimited sites with header fields ref_id and ref_pos (1-based), in any column; duplicates are merged """
+		text = '# known sites\nsite_id\tref_pos\tref_id\n1\t5\tc1\n2\t1\tc3\n\n3\t5\tc1\n4\t3000\tc1\n5\t2\tc1\n'
+		self.assertEqual(self.read_sites(text), {'c1': [1, 4, 2999], 'c3': [0]})
+		self.assertEqual(self.read_sites(text, 'sites.txt.gz'), {'c1': [1, 4, 2999], 'c3': [0]})
+
+	def test_bed(self):
+		""" BED intervals without header (0-based, end exclusive); overlapping intervals are merged """
+		text = 'c2\t10\t15\tname\nc2\t12\t20\nc1\t2999\t3000\nc2\t0\t1\n'
+		self.assertEqual(self.read_sites(text), {'c1': [2999], 'c2': [0] + list(range(10, 20))})
+
+	def test_other_contigs(self):
+		""" Sites on contigs of other species are ignored, even outside of selected contigs """
+		self.assertEqual(self.read_sites('c1\t0\t2\nx1\t5\t10\nx1\t-5\t99999999\n'), {'c1': [0, 1]})
+		self.assertEqual(self.read_sites('ref_id\tref_pos\nx1\t0\n'), {})
+
+	def test_errors(self):
+		""" Sites outside of contigs, empty intervals and lines that cannot be parsed are errors """
+		for text in ['ref_id\tref_pos\nc1\t0\n', 'ref_id\tref_pos\nc2\t1501\n', 'ref_id\tref_pos\nc2\tx\n', 'ref_id\tref_pos\nc2\n',
+			'c1\t-1\t5\n', 'c1\t2990\t3001\n', 'c1\t5\t5\n', 'c1\t5\n', 'c1\t5\t6.5\n']:
+			self.assertRaises(SystemExit, self.read_sites, text)
+
+	def test_intervals(self):
+		""" Sites within max_gap of each other share an interval """
+		intervals = snps.site_intervals({'c1': np.array([3, 4, 10, 2000, 2500, 2990]), 'c2': np.array([], dtype=np.int64)}, max_gap=500)
+		self.assertEqual(intervals, {'c1': [(3, 11), (2000, 2991)]})
+
+class DbIndex(unittest.TestCase):
+	def setUp(self):
+		self.db = tempfile.mkdtemp()
+		os.makedirs('%s/genome_index' % self.db)
+		with open('%s/genome_index/partitions.txt' % self.db, 'w') as file:
+			file.write('species_id\tpartition\n')
+			file.write(''.join(['s%s\t%s\n' % (i, partition) for i, partition in enumerate([0, 10, 2, 2, 1, 10])]))
+
+	def tearDown(self):
+		shutil.rmtree(self.db)
+
+	def args(self, **kwargs):
+		args = {'db': self.db, 'db_index': True, 'shards': 1, 'outdir': self.db}
+		args.update(kwargs)
+		return args
+
+	def test_prefixes(self):
+		""" Each partition with selected species is aligned to once, in order of partition number """
+		prefixes = snps.index_prefixes(self.args(), {'s5': None, 's2': None, 's3': None, 's0': None, 's1': None})
+		self.assertEqual(prefixes, ['%s/genome_index/part.%s' % (self.db, p) for p in [0, 2, 10]])
+		self.assertEqual(snps.db_index_prefixes(self.args(), {'s4': None}), ['%s/genome_index/part.1' % self.db])
+		self.assertEqual(snps.index_prefixes(self.args(db_index=False), {'s4': None}), ['%s/snps/temp/genomes' % self.db])
+
+	def test_missing(self):
+		""" Species not in the prebuilt database, and databases without one, are errors """
+		self.assertRaises(SystemExit, snps.db_index_prefixes, self.args(), {'s1': None, 's6': None})
+		os.remove('%s/genome_index/partitions.txt' % self.db)
+		self.assertRaises(SystemExit, snps.db_index_prefixes, self.args(), {'s1': None})
+
+class Manifests(RunSnpsTest):
+	def setUp(self):
+		os.makedirs('%s/snps/output' % self.dir)
+
+	def tearDown(self):
+		shutil.rmtree('%s/snps/output' % self.dir)
+
+	def args(self, **kwargs):
+		values = {'input_bam': None, 'align': False, 'sites': None, 'log': io.StringIO(), 'db': 'db', 'trim': 0}
+		values.update(kwargs)
+		args = RunSnpsTest.args(self, **values)
+		args['pileup_input'] = snps.pileup_input(args, self.species)
+		return args
+
+	def new_species(self):
+		return dict([(species_id, snps.Species(species_id)) for species_id in self.species])
+
+	def run_pileup(self, args):
+		""" Species stats and summary.txt of a pileup of pending species """
+		species = self.new_species()
+		for contig in self.contigs.values():
+			species[contig.species_id].genome_length += contig.length
+		pending = snps.pending_species(args, species)
+		if pending:
+			snps.pysam_pileup(args, pending, dict([(id, c) for id, c in self.contigs.items() if c.species_id in pending]))
+		snps.snps_summary(args, species)
+		return pending, open('%s/snps/summary.txt' % self.dir).read()
+
+	def test_summary(self):
+		""" Species completed by a previous run are skipped and their stats restored in summary.txt """
+		args = self.args()
+		pending, summary = self.run_pileup(args)
+		self.assertEqual(sorted(pending), sorted(self.species))
+		self.assertEqual(len(summary.split('\n')), 4)
+		self.assertEqual(self.run_pileup(args), ({}, summary))
+		# species whose output is missing are rerun
+		os.remove('%s/snps/output/s2.snps.bin' % self.dir)
+		pending, rerun = self.run_pileup(args)
+		self.assertEqual((list(pending), rerun), (['s2'], summary))
+
+	def test_changes(self):
+		""" Outputs of a previous run are not reused with other parameters or input """
+		args = self.args()
+		self.run_pileup(args)
+		for kwargs in [{'mapid': 90.0}, {'max_depth': 100}, {'input_bam': '%s/sorted.bam' % self.dir}]:
+			self.assertEqual(sorted(self.run_pileup(self.args(**kwargs))[0]), sorted(self.species))
+		os.utime('%s/snps/temp/genomes.bam' % self.dir, (0, 0))
+		self.assertEqual(sorted(snps.pending_species(self.args(), self.new_species())), sorted(self.species))
+
+	def test_commit(self):
+		""" Manifest records parameters, input and stats of species """
+		args = self.args()
+		sp = self.new_species()['s1']
+		snps.update_species_stats(sp, {'genome_length': 4500, 'covered_bases': 100, 'total_depth': 250, 'aligned_reads': 7, 'mapped_reads': 5})
+		snps.commit_species(args, sp)
+		open('%s/snps/output/s1.snps.bin' % self.dir, 'w').close()
+		pending = snps.pending_species(args, self.new_species())
+		self.assertEqual(list(pending), ['s2'])
+		manifest = utility.read_manifest('%s/snps/output/s1.manifest' % self.dir, {})
+		self.assertEqual((manifest['total_depth'], manifest['input']), ('250', args['pileup_input']))
+		self.assertTrue('mapid=94.0' in manifest['params'])
+
+	def test_realign(self):
+		""" Runs that align key outputs on the reads, so rewriting the alignments of the same reads does not invalidate them """
+		reads = '%s/reads.fq' % self.dir
+		with open(reads, 'w') as file:
+			file.write('@r1\nACGT\n+\nIIII\n')
+		align = {'align': True, 'm1': reads, 'm2': None, 'mode': 'global', 'speed': 'very-sensitive', 'max_reads': None, 'interleaved': False, 'shards': 1}
+		self.assertEqual(sorted(self.run_pileup(self.args(**align))[0]), sorted(self.species))
+		os.utime('%s/snps/temp/genomes.bam' % self.dir, None)
+		self.assertEqual(self.run_pileup(self.args(**align))[0], {})
+		align['speed'] = 'sensitive'
+		self.assertEqual(sorted(snps.pending_species(self.args(**align), self.new_species())), sorted(self.species))
+		os.remove(reads)
+
+if __name__ == '__main__':
+	unittest.main()
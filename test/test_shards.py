@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+import unittest
+import shutil
+import tempfile
+import zlib
+import pysam
+from midas.run import shards
+
+def make_shard(path, contigs, records):
+	""" Unsorted BAM of bowtie2 output against one index shard
+		records: (name, flag, contig index or -1, position, mate contig index or -1, mate position, alignment score)
+	"""
+	header = {'HD': {'VN': '1.0', 'SO': 'unsorted'}, 'SQ': [{'SN': contig_id, 'LN': 1000} for contig_id in contigs]}
+	with pysam.AlignmentFile(path, 'wb', header=header) as file:
+		for name, flag, reference_id, position, mate_id, mate_position, score in records:
+			aln = pysam.AlignedSegment()
+			aln.query_name = name
+			aln.query_sequence = 'ACGT'*5
+			aln.query_qualities = pysam.qualitystring_to_array('I'*20)
+			aln.flag = flag
+			aln.reference_id = reference_id
+			aln.reference_start = position
+			aln.next_reference_id = mate_id
+			aln.next_reference_start = mate_position
+			if not flag & 0x4:
+				aln.mapping_quality = 42
+				aln.cigartuples = [(0, 20)]
+				aln.set_tag('AS', score)
+			file.write(aln)
+
+def unpaired(name, reference_id=-1, position=0, score=0):
+	flag = 0x4 if reference_id < 0 else 0
+	return (name, flag, reference_id, position if reference_id >= 0 else -1, -1, -1, score)
+
+def pair(name, first, second):
+	""" Records of read pair; first and second: (contig index or -1, position, score) """
+	records = []
+	for mate, (reference_id, position, score), (mate_id, mate_position, mate_score) in [(0x40, first, second), (0x80, second, first)]:
+		flag = 0x1 | mate | (0x4 if reference_id < 0 else 0) | (0x8 if mate_id < 0 else 0)
+		# unaligned mates are placed at the position of an aligned mate
+		if reference_id < 0 and mate_id >= 0: reference_id, position = mate_id, mate_position
+		if mate_id < 0 and reference_id >= 0 and flag & 0x4 == 0: mate_id, mate_position = reference_id, position
+		records.append((name, flag, reference_id, position, mate_id, mate_position, score))
+	return records
+
+class Partition(unittest.TestCase):
+	def test_balanced(self):
+		sizes = {'a': 10, 'b': 7, 'c': 5, 'd': 4, 'e': 1}
+		self.assertEqual(shards.partition(sizes, 2), [['a', 'd'], ['b', 'c', 'e']])
+		self.assertEqual(shards.partition(sizes, 1), [['a', 'b', 'c', 'd', 'e']])
+		self.assertEqual(shards.partition(sizes, 10), [['a'], ['b'], ['c'], ['d'], ['e']])
+
+	def test_ties(self):
+		""" Species of equal size are placed by id, so groups do not depend on input order """
+		sizes = dict([('s%s' % i, 5) for i in range(7)])
+		groups = shards.partition(sizes, 3)
+		self.assertEqual(groups, shards.partition(dict(reversed(list(sizes.items()))), 3))
+		self.assertEqual(sorted(sum(groups, [])), sorted(sizes))
+		self.assertEqual(sorted([len(group) for group in groups]), [2, 2, 3])
+
+class MergeAlignments(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		# shard 0 has contigs a1, a2 and shard 1 has b1, b2; reads are in the same order in both
+		self.records = [[], []]
+		self.add([unpaired('only1')], [unpaired('only1', 0, 100, -5)])
+		self.records[0].append(('only1', 0x100, 1, 50, -1, -1, -9)) # secondary alignment, skipped
+		self.add(pair('half0', (0, 10, -3), (-1, 0, 0)), pair('half0', (-1, 0, 0), (-1, 0, 0)))
+		self.add(pair('both1', (1, 10, -1), (-1, 0, 0)), pair('both1', (1, 200, -20), (1, 400, -20)))
+		self.add([unpaired('unal')], [unpaired('unal')])
+		self.add(pair('better0', (0, 500, -2), (0, 700, -2)), pair('better0', (0, 600, -5), (0, 800, -2)))
+		self.ties = ['tie%s' % i for i in range(200)]
+		for name in self.ties:
+			self.add([unpaired(name, 1, 300, -4)], [unpaired(name, 1, 300, -4)])
+		for i, records in enumerate(self.records):
+			make_shard('%s/shard.%s.bam' % (self.dir, i), [['a1', 'a2'], ['b1', 'b2']][i], records)
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def add(self, shard0, shard1):
+		self.records[0] += shard0
+		self.records[1] += shard1
+
+	def merge(self):
+		stats = shards.merge_alignments(['%s/shard.%s.bam' % (self.dir, i) for i in range(2)], '%s/merged.bam' % self.dir)
+		with pysam.AlignmentFile('%s/merged.bam' % self.dir, check_sq=False) as file:
+			self.assertEqual(list(file.references), ['a1', 'a2', 'b1', 'b2'])
+			alns = {}
+			for aln in file.fetch(until_eof=True):
+				alns.setdefault(aln.query_name, []).append(aln)
+		return stats, alns
+
+	def test_best_shard(self):
+		stats, alns = self.merge()
+		self.assertEqual(stats, {'aligned': 4 + len(self.ties), 'tied': len(self.ties)})
+		self.assertFalse('unal' in alns)
+		self.assertEqual([(aln.reference_name, aln.reference_start, aln.mapping_quality) for aln in alns['only1']], [('b1', 100, 42)])
+		# more aligned mates rank before alignment score
+		self.assertEqual([(aln.reference_name, aln.next_reference_name) for aln in alns['both1']], [('b2', 'b2'), ('b2', 'b2')])
+		self.assertEqual([aln.get_tag('AS') for aln in alns['better0']], [-2, -2])
+		self.assertEqual([aln.reference_name for aln in alns['better0']], ['a1', 'a1'])
+
+	def test_half_aligned(self):
+		""" Unaligned mates of a pair aligned in one shard are kept with it, placed at their mate """
+		stats, alns = self.merge()
+		self.assertEqual([(aln.is_unmapped, aln.reference_name, aln.next_reference_name) for aln in alns['half0']],
+			[(False, 'a1', 'a1'), (True, 'a1', 'a1')])
+
+	def test_ties(self):
+		""" Reads tied across shards get mapping quality 0 and are spread over shards by read name """
+		stats, alns = self.merge()
+		picked = [alns[name][0].reference_name for name in self.ties]
+		self.assertTrue(all([alns[name][0].mapping_quality == 0 for name in self.ties]))
+		self.assertEqual(picked, [['a2', 'b2'][zlib.crc32(name.encode('ascii')) % 2] for name in self.ties])
+		self.assertTrue(60 < picked.count('a2') < 140)
+		self.assertEqual(self.merge()[1].keys(), alns.keys())
+
+class ReadGroups(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def test_groups(self):
+		records = [unpaired('r1', 0, 5, -1), ('r1', 0x800, 1, 7, -1, -1, -1)] + pair('p1', (0, 10, -2), (0, 90, -3))
+		records += [('p1', 0x100 | 0x1 | 0x40, 1, 50, 0, 90, -8)] + pair('p2', (-1, 0, 0), (-1, 0, 0)) + [unpaired('r2')]
+		make_shard('%s/shard.bam' % self.dir, ['a1', 'a2'], records)
+		with pysam.AlignmentFile('%s/shard.bam' % self.dir, check_sq=False) as file:
+			groups = [(group[0].query_name, len(group), shards.score(group)) for group in shards.read_groups(file)]
+		self.assertEqual(groups, [('r1', 1, (1, -1)), ('p1', 2, (2, -5)), ('p2', 2, (0, 0)), ('r2', 1, (0, 0))])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+from midas import snp_counts
+from midas.merge import snps as merge_snps
+
+def random_counts(length, seed, high=50):
+	""" ACGT counts (4 x length) with some zero-depth positions """
+	random = np.random.RandomState(seed)
+	counts = random.randint(0, high, size=(4, length))
+	counts[:, random.rand(length) < 0.3] = 0
+	return counts
+
+class BinaryCounts(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.path = '%s/sp.snps.bin' % self.dir
+		self.block_sites = snp_counts.BLOCK_SITES
+		snp_counts.BLOCK_SITES = 100 # several blocks per contig
+		self.contigs = {'c1': random_counts(250, 1), 'c2': random_counts(100, 2, high=2**17), 'c3': random_counts(0, 3)}
+		writer = snp_counts.BinaryCountWriter(self.path)
+		for contig_id in sorted(self.contigs):
+			writer.write_contig(contig_id, self.contigs[contig_id])
+		writer.close()
+
+	def tearDown(self):
+		snp_counts.BLOCK_SITES = self.block_sites
+		shutil.rmtree(self.dir)
+
+	def test_round_trip(self):
+		reader = snp_counts.BinaryCountReader(self.path)
+		self.assertEqual(reader.contigs, [(contig_id, self.contigs[contig_id].shape[1]) for contig_id in sorted(self.contigs)])
+		for contig_id, counts in self.contigs.items():
+			self.assertTrue((reader.fetch(contig_id) == counts.T).all())
+		reader.close()
+
+	def test_windows(self):
+		reader = snp_counts.BinaryCountReader(self.path)
+		for start, end in [(0, 1), (95, 205), (199, 200), (240, 250), (100, 100)]:
+			self.assertTrue((reader.fetch('c1', start, end) == self.contigs['c1'][:, start:end].T).all())
+		reader.close()
+
+	def test_absent_contig(self):
+		reader = snp_counts.BinaryCountReader(self.path)
+		self.assertEqual(reader.fetch('c4', 10, 20).tolist(), [[0, 0, 0, 0]]*10)
+		self.assertEqual(reader.fetch('c4').shape, (0, 4))
+		reader.close()
+
+	def test_not_a_container(self):
+		with open(self.path, 'wb') as file:
+			file.write(b'ref_id\tref_pos\n')
+		self.assertRaises(ValueError, snp_counts.BinaryCountReader, self.path)
+
+def write_text(path, contigs, layout, sites=None, member_rows=40):
+	""" Write counts of contigs as run_midas.py snps text output, one indexed gzip member per member_rows rows """
+	writer = snp_counts.TextCountWriter(path)
+	snp_counts.write_header(writer, layout)
+	for contig_id in sorted(contigs):
+		counts = contigs[contig_id]
+		positions = np.arange(counts.shape[1]) if sites is None else sites[contig_id]
+		if layout == 'sparse':
+			positions = positions[counts[:, positions].sum(axis=0) > 0]
+		for start in range(0, len(positions), member_rows):
+			rows = ['%s\t%s\tA\t%s\t%s\n' % (contig_id, i+1, counts[:, i].sum(), '\t'.join([str(_) for _ in counts[:, i]]))
+				for i in positions[start:start+member_rows]]
+			writer.write(''.join(rows), contig_id, positions[start]+1)
+	writer.close()
+
+class TextCounts(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.contigs = {'c1': random_counts(250, 1), 'c2': random_counts(100, 2), 'c3': random_counts(30, 3)}
+		self.genome = dict([(contig_id, 'A'*counts.shape[1]) for contig_id, counts in self.contigs.items()])
+		self.offsets = snp_counts.genome_offsets(self.genome)[0]
+		self.windows = [('c1', 0, 10), ('c1', 10, 11), ('c1', 120, 250), ('c2', 50, 100), ('c3', 0, 30)]
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def check(self, reader, contigs):
+		for contig_id, start, end in self.windows:
+			self.assertTrue((reader.fetch(contig_id, start, end) == contigs[contig_id][:, start:end].T).all())
+		reader.close()
+
+	def test_dense(self):
+		write_text('%s/sp.snps.gz' % self.dir, self.contigs, 'dense')
+		self.check(snp_counts.CountReader('%s/sp.snps.gz' % self.dir, self.offsets), self.contigs)
+
+	def test_sparse(self):
+		write_text('%s/sp.snps.gz' % self.dir, self.contigs, 'sparse')
+		reader = snp_counts.CountReader('%s/sp.snps.gz' % self.dir, self.offsets)
+		self.assertEqual(reader.format['layout'], 'sparse')
+		self.check(reader, self.contigs)
+
+	def test_sites(self):
+		sites = dict([(contig_id, np.arange(3, counts.shape[1], 4)) for contig_id, counts in self.contigs.items()])
+		write_text('%s/sp.snps.gz' % self.dir, self.contigs, 'sites', sites)
+		contigs = {}
+		for contig_id, counts in self.contigs.items():
+			contigs[contig_id] = np.zeros_like(counts)
+			contigs[contig_id][:, sites[contig_id]] = counts[:, sites[contig_id]]
+		self.check(snp_counts.CountReader('%s/sp.snps.gz' % self.dir, self.offsets), contigs)
+
+	def test_without_index(self):
+		write_text('%s/sp.snps.gz' % self.dir, self.contigs, 'dense')
+		os.remove(snp_counts.index_path('%s/sp.snps.gz' % self.dir))
+		self.check(snp_counts.CountReader('%s/sp.snps.gz' % self.dir, self.offsets), self.contigs)
+
+	def test_read_count_window(self):
+		""" Text and binary outputs of several samples merged into one window """
+		samples = [dict([(contig_id, random_counts(counts.shape[1], seed)) for contig_id, counts in self.contigs.items()]) for seed in [4, 5, 6]]
+		write_text('%s/s0.snps.gz' % self.dir, samples[0], 'dense')
+		write_text('%s/s1.snps.gz' % self.dir, samples[1], 'sparse')
+		writer = snp_counts.BinaryCountWriter('%s/s2.snps.bin' % self.dir)
+		for contig_id in sorted(samples[2]):
+			writer.write_contig(contig_id, samples[2][contig_id])
+		writer.close()
+		readers = [snp_counts.open_counts('%s/s%s' % (self.dir, i), self.offsets) for i in range(3)]
+		self.assertTrue(isinstance(readers[2], snp_counts.BinaryCountReader))
+		for contig_id, start, end in self.windows:
+			window = merge_snps.read_count_window(readers, contig_id, start, end)
+			self.assertEqual(window.shape, (end-start, 3, 4))
+			for i, sample in enumerate(samples):
+				self.assertTrue((window[:, i] == sample[contig_id][:, start:end].T).all())
+		self.assertEqual(merge_snps.read_count_window([], 'c1', 0, 5).shape, (5, 0, 4))
+
+class MatrixCounts(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.genome = {'c1': 'A'*250, 'c2': 'A'*100}
+		self.offsets = snp_counts.genome_offsets(self.genome)[0]
+		random = np.random.RandomState(1)
+		self.counts = random.randint(0, 50, size=(350, 3, 4))
+		self.counts[300:320, 1] = 2**17
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def test_round_trip(self):
+		""" Windows written in order are read back in other windows; sites of no written window have no counts """
+		writer = snp_counts.MatrixCountWriter('%s/counts' % self.dir, 3)
+		for start, end in [(0, 100), (100, 240), (260, 310), (310, 350)]:
+			writer.write(start, self.counts[start:end])
+		writer.close()
+		self.assertFalse(os.path.exists('%s/counts.tmp' % self.dir))
+		expected = self.counts.copy()
+		expected[240:260] = 0
+		reader = snp_counts.MatrixCountReader('%s/counts' % self.dir, self.offsets)
+		for contig_id, start, end in [('c1', 0, 10), ('c1', 10, 150), ('c1', 150, 250), ('c2', 0, 55), ('c2', 55, 100)]:
+			lo = self.offsets[contig_id]+start
+			self.assertTrue((reader.fetch(contig_id, start, end) == expected[lo:lo+end-start]).all())
+		reader.close()
+
+	def test_not_a_matrix(self):
+		write_text('%s/sp.snps.gz' % self.dir, {'c1': random_counts(10, 1)}, 'dense')
+		self.assertRaises(ValueError, snp_counts.MatrixCountReader, '%s/sp.snps.gz' % self.dir, self.offsets)
+
+if __name__ == '__main__':
+	unittest.main()
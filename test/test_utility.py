@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import unittest
+import shutil
+import tempfile
+import numpy as np
+import pysam
+from midas import utility
+
+REFERENCES = [('g1', 500), ('g2', 300)]
+
+def write_alignments(path, mode='wb', sort_order='unsorted', reference=None, seed=1):
+	""" Alignments of reads to references: primary, secondary, supplementary and unmapped records; return their flags """
+	random = np.random.RandomState(seed)
+	sequences = dict([(name, ''.join(random.choice(list('ACGT'), length))) for name, length in REFERENCES])
+	if reference:
+		with open(reference, 'w') as file:
+			file.write(''.join(['>%s\n%s\n' % (name, sequences[name]) for name, length in REFERENCES]))
+		pysam.faidx(reference)
+	header = {'HD': {'VN': '1.0', 'SO': sort_order}, 'SQ': [{'SN': name, 'LN': length} for name, length in REFERENCES]}
+	flags = [0, 16, 256, 2048, 4, 0, 256]
+	with pysam.AlignmentFile(path, mode, header=header, reference_filename=reference) as file:
+		for i, flag in enumerate(flags):
+			aln = pysam.AlignedSegment()
+			aln.query_name = 'r%s' % i
+			aln.flag = flag
+			if flag & 4:
+				aln.query_sequence = 'A'*50
+				aln.reference_id, aln.reference_start = -1, -1
+			else:
+				aln.reference_id, aln.reference_start = i % 2, 10*i
+				aln.query_sequence = sequences[REFERENCES[i % 2][0]][10*i:10*i+50]
+				aln.cigartuples = [(0, 50)]
+				aln.mapping_quality = 30
+			aln.query_qualities = pysam.qualitystring_to_array('I'*50)
+			file.write(aln)
+	return flags
+
+class BamInput(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def test_is_primary(self):
+		flags = write_alignments('%s/input.bam' % self.dir)
+		with utility.open_bam('%s/input.bam' % self.dir) as bamfile:
+			primary = [utility.is_primary(aln) for aln in bamfile.fetch(until_eof=True)]
+		self.assertEqual(primary, [flag in [0, 16] for flag in flags])
+
+	def test_open_cram(self):
+		""" CRAM input is decoded with the FASTA reference of the database """
+		reference = '%s/genomes.fa' % self.dir
+		flags = write_alignments('%s/input.cram' % self.dir, 'wc', reference=reference)
+		self.assertTrue(utility.is_cram('%s/input.cram' % self.dir))
+		with utility.open_bam('%s/input.cram' % self.dir, reference=reference) as bamfile:
+			alns = list(bamfile.fetch(until_eof=True))
+		self.assertEqual([aln.flag for aln in alns], flags)
+		self.assertEqual(alns[1].query_sequence, open(reference).read().split('\n')[3][10:60])
+
+	def test_sorted(self):
+		""" Sort order is read from the header; indexes are found next to the input """
+		write_alignments('%s/unsorted.bam' % self.dir)
+		pysam.sort('-o', '%s/sorted.bam' % self.dir, '%s/unsorted.bam' % self.dir)
+		self.assertEqual([utility.is_sorted_bam('%s/%s.bam' % (self.dir, _)) for _ in ['unsorted', 'sorted']], [False, True])
+		self.assertEqual(utility.find_bam_index('%s/sorted.bam' % self.dir), None)
+		pysam.index('%s/sorted.bam' % self.dir)
+		self.assertEqual(utility.find_bam_index('%s/sorted.bam' % self.dir), '%s/sorted.bam.bai' % self.dir)
+		with utility.open_bam('%s/sorted.bam' % self.dir, index='%s/sorted.bam.bai' % self.dir) as bamfile:
+			self.assertEqual([aln.query_name for aln in bamfile.fetch('g2')], ['r1', 'r3', 'r5'])
+
+	def test_check_references(self):
+		""" Each selected reference must be in the header with the same length; other references are allowed """
+		write_alignments('%s/input.bam' % self.dir)
+		utility.check_bam_references('%s/input.bam' % self.dir, {'g1': 500})
+		utility.check_bam_references('%s/input.bam' % self.dir, dict(REFERENCES))
+		for references in [{'g1': 500, 'g3': 100}, {'g1': 501, 'g2': 300}]:
+			self.assertRaises(SystemExit, utility.check_bam_references, '%s/input.bam' % self.dir, references)
+
+if __name__ == '__main__':
+	unittest.main()